@@ -0,0 +1,249 @@
+"""Gemini 模型選擇與用量記帳
+
+每次模型呼叫（googleAI.generate_content）都會記錄 model、prompt / output token、延遲與估算費用，
+設定 configure(engine) 後寫入 ai_usage 表。choose_model() 依輸入大小挑模型：
+
+  文字 ≤ AI_SMALL_TEXT_CHARS      最輕的模型（AI_MODEL_TIERS 第一個）
+  文字 ≤ AI_LARGE_TEXT_CHARS      中間的模型
+  更大的文字、圖片與其他檔案      最重的模型
+
+再依兩個條件往輕的模型退：
+  當日花費超過 AI_DAILY_BUDGET_USD（0 = 不限）      直接改用最輕的模型
+  該模型近期 p95 延遲超過 AI_LATENCY_SLO_MS（0 = 不檢查）  往下退一級，直到符合或已是最輕
+
+環境變數：
+  AI_MODEL_TIERS     由輕到重，逗號分隔（預設 gemini-2.0-flash-lite,gemini-2.0-flash,gemini-2.5-flash）
+  AI_MODEL_PRICES    JSON {model: [每百萬 input token 美元, 每百萬 output token 美元]}，覆寫預設價格
+  AI_SMALL_TEXT_CHARS / AI_LARGE_TEXT_CHARS（預設 8000 / 60000）
+  AI_DAILY_BUDGET_USD / AI_LATENCY_SLO_MS（預設 0）
+
+「當日」以台灣時間計算。花費在各 worker 記憶體中累加，並每分鐘從 ai_usage 表重新讀取，
+因此多個 worker 或多台機器共用同一份預算。
+"""
+import collections
+import contextlib
+import contextvars
+import datetime
+import json
+import os
+import threading
+import time
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from sqlalchemy import text
+
+import metrics
+
+# 公開牌價（美元 / 百萬 token），實際價格以 AI_MODEL_PRICES 覆寫
+DEFAULT_PRICES = {
+    "gemini-2.0-flash-lite": (0.075, 0.30),
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-pro": (1.25, 10.00),
+}
+
+MODEL_TIERS = [m.strip() for m in os.getenv(
+    "AI_MODEL_TIERS", "gemini-2.0-flash-lite,gemini-2.0-flash,gemini-2.5-flash"
+).split(",") if m.strip()]
+MODEL_PRICES = {**DEFAULT_PRICES, **{k: tuple(v) for k, v in json.loads(os.getenv("AI_MODEL_PRICES", "{}")).items()}}
+SMALL_TEXT_CHARS = int(os.getenv("AI_SMALL_TEXT_CHARS", "8000"))
+LARGE_TEXT_CHARS = int(os.getenv("AI_LARGE_TEXT_CHARS", "60000"))
+DAILY_BUDGET_USD = float(os.getenv("AI_DAILY_BUDGET_USD", "0"))
+LATENCY_SLO_MS = float(os.getenv("AI_LATENCY_SLO_MS", "0"))
+
+LOCAL_TZ = ZoneInfo("Asia/Taipei")
+# 近期延遲：每個模型保留最近 LATENCY_WINDOW 次、且在 LATENCY_WINDOW_SECONDS 內的呼叫，
+# 至少要有 LATENCY_MIN_SAMPLES 筆才判斷 SLO；因退級而沒有流量的模型，舊資料過期後會重新被選用
+LATENCY_WINDOW = 50
+LATENCY_WINDOW_SECONDS = 600
+LATENCY_MIN_SAMPLES = 10
+SPEND_REFRESH_SECONDS = 60
+
+# 目前這次呼叫是為了哪個系所（由呼叫端以 usage_context 設定）
+_context = contextvars.ContextVar("ai_usage_context", default={})
+
+
+@contextlib.contextmanager
+def usage_context(school=None, department=None, degree=None):
+    """在此區塊內的模型呼叫都記在指定系所名下"""
+    token = _context.set({"school": school, "department": department, "degree": degree})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def estimate_cost(model, prompt_tokens, output_tokens):
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+def _day_start():
+    now = datetime.datetime.now(LOCAL_TZ)
+    return now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class UsageLedger:
+    def __init__(self):
+        self.engine = None
+        self._lock = threading.Lock()
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW))
+        self._day = None
+        self._spent = 0.0
+        self._refreshed_at = 0.0
+
+    def configure(self, engine):
+        self.engine = engine
+
+    # ---------- 花費 ----------
+    def spent_today(self):
+        day = _day_start()
+        with self._lock:
+            if self._day != day:
+                self._day, self._spent, self._refreshed_at = day, 0.0, 0.0
+            stale = time.monotonic() - self._refreshed_at > SPEND_REFRESH_SECONDS
+        if stale and self.engine is not None:
+            try:
+                with self.engine.connect() as conn:
+                    spent = conn.execute(text("""
+                        SELECT COALESCE(SUM(cost_usd), 0) FROM ai_usage WHERE created_at >= :since
+                    """), {"since": day}).scalar()
+                with self._lock:
+                    self._spent = float(spent)
+                    self._refreshed_at = time.monotonic()
+            except Exception as e:
+                metrics.log_event("ai_spend_refresh_failed", level="warning", error=str(e))
+        return self._spent
+
+    def over_budget(self):
+        return DAILY_BUDGET_USD > 0 and self.spent_today() >= DAILY_BUDGET_USD
+
+    # ---------- 延遲 ----------
+    def p95_latency_ms(self, model):
+        since = time.monotonic() - LATENCY_WINDOW_SECONDS
+        with self._lock:
+            values = [ms for at, ms in self._latencies.get(model, ()) if at >= since]
+        if len(values) < LATENCY_MIN_SAMPLES:
+            return None
+        return float(np.percentile(values, 95))
+
+    # ---------- 記錄 ----------
+    def record(self, model, operation, seconds, usage=None, outcome="ok"):
+        prompt_tokens = getattr(usage, "prompt_token_count", None) or 0
+        # thinking 模型的思考 token 以 output 計價
+        output_tokens = (getattr(usage, "candidates_token_count", None) or 0) + \
+            (getattr(usage, "thoughts_token_count", None) or 0)
+        cost = estimate_cost(model, prompt_tokens, output_tokens)
+        with self._lock:
+            self._latencies[model].append((time.monotonic(), seconds * 1000))
+            if self._day == _day_start():
+                self._spent += cost
+
+        if self.engine is None:
+            return cost
+        ctx = _context.get()
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text("""
+                    INSERT INTO ai_usage (model, operation, outcome, school, department, degree,
+                                          prompt_tokens, output_tokens, latency_ms, cost_usd)
+                    VALUES (:model, :operation, :outcome, :school, :department, :degree,
+                            :prompt_tokens, :output_tokens, :latency_ms, :cost_usd)
+                """), {
+                    "model": model,
+                    "operation": operation,
+                    "outcome": outcome,
+                    "school": ctx.get("school"),
+                    "department": ctx.get("department"),
+                    "degree": ctx.get("degree"),
+                    "prompt_tokens": prompt_tokens,
+                    "output_tokens": output_tokens,
+                    "latency_ms": seconds * 1000,
+                    "cost_usd": cost,
+                })
+        except Exception as e:
+            metrics.log_event("ai_usage_record_failed", level="warning", model=model, error=str(e))
+        return cost
+
+
+ledger = UsageLedger()
+
+
+def configure(engine):
+    """設定後用量會寫入 ai_usage 表，預算也會以資料庫中的當日花費計算"""
+    ledger.configure(engine)
+
+
+def record_usage(model, operation, seconds, usage=None, outcome="ok"):
+    return ledger.record(model, operation, seconds, usage, outcome)
+
+
+def choose_model(input_kind, size=0):
+    """input_kind 為 "text"（size 為字數）或 "image" / "file"，回傳模型名稱"""
+    if input_kind == "text" and size <= SMALL_TEXT_CHARS:
+        tier = 0
+    elif input_kind == "text" and size <= LARGE_TEXT_CHARS:
+        tier = min(1, len(MODEL_TIERS) - 1)
+    else:
+        tier = len(MODEL_TIERS) - 1
+    wanted = MODEL_TIERS[tier]
+
+    reason = "size"
+    if tier > 0 and ledger.over_budget():
+        tier, reason = 0, "budget"
+    if LATENCY_SLO_MS > 0:
+        while tier > 0:
+            p95 = ledger.p95_latency_ms(MODEL_TIERS[tier])
+            if p95 is None or p95 <= LATENCY_SLO_MS:
+                break
+            tier, reason = tier - 1, "latency_slo"
+
+    model = MODEL_TIERS[tier]
+    if model != wanted:
+        metrics.log_event("ai_model_downgraded", sample_rate=1.0, wanted=wanted, model=model,
+                          reason=reason, input_kind=input_kind, size=size)
+    return model
+
+
+def usage_report(conn, days=30):
+    """近 days 天的用量：各系所與各模型的呼叫次數、token、費用與平均延遲"""
+    since = _day_start() - datetime.timedelta(days=days - 1)
+    params = {"since": since}
+    departments = conn.execute(text("""
+        SELECT school, department,
+               COUNT(*) AS calls,
+               SUM(prompt_tokens)::bigint AS prompt_tokens,
+               SUM(output_tokens)::bigint AS output_tokens,
+               SUM(cost_usd) AS cost_usd,
+               AVG(latency_ms) AS avg_latency_ms,
+               COUNT(*) FILTER (WHERE outcome <> 'ok') AS errors
+        FROM ai_usage
+        WHERE created_at >= :since
+        GROUP BY school, department
+        ORDER BY cost_usd DESC
+    """), params).mappings().all()
+    models = conn.execute(text("""
+        SELECT model,
+               COUNT(*) AS calls,
+               SUM(prompt_tokens)::bigint AS prompt_tokens,
+               SUM(output_tokens)::bigint AS output_tokens,
+               SUM(cost_usd) AS cost_usd,
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY latency_ms) AS p95_latency_ms
+        FROM ai_usage
+        WHERE created_at >= :since
+        GROUP BY model
+        ORDER BY cost_usd DESC
+    """), params).mappings().all()
+
+    def _clean(row):
+        return {k: round(v, 6) if isinstance(v, float) else v for k, v in row.items()}
+
+    return {
+        "since": since.isoformat(),
+        "spent_today_usd": round(ledger.spent_today(), 6),
+        "daily_budget_usd": DAILY_BUDGET_USD or None,
+        "departments": [_clean(r) for r in departments],
+        "models": [_clean(r) for r in models],
+    }
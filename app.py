@@ -1,7 +1,6 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
-from sqlalchemy import create_engine, text
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import text
 import numpy as np
 import datetime
 from utils import send_mail
@@ -11,7 +10,27 @@ import jwt
 import tempfile
 import json
 import io
+import contextlib
 import googleAI
+import db
+import rankings
+import cascade
+import overlap
+import name_index
+import namelists
+import metrics
+import profiler
+import ai_router
+import singleflight
+import responses
+import catalog
+import catalog_search
+import throttle
+import sessions
+import verifications
+import live_stats
+import export_data
+import load_catalog
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -29,6 +48,8 @@ if os.getenv("FLASK_ENV") == "development":
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 DATABASE_URL = os.getenv("DATABASE_URL")
+# 維運用的管理 token（未設定時所有 admin 端點一律拒絕）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
 # 判斷是否為本地開發環境
 IS_LOCAL_DEV = os.getenv("FLASK_ENV") == "development" or os.getenv("DEBUG", "").lower() == "true"
@@ -48,11 +69,85 @@ else:
     ], supports_credentials=True)
     print("[INFO] 生產模式 - 限制 CORS 來源")
 
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"sslmode": "require"} if "localhost" not in DATABASE_URL else {},
-    pool_pre_ping=True
-)
+# 連線池大小、overflow、recycle、pre-ping 皆可由環境變數設定（見 db.create_db_engine）
+engine = db.create_db_engine(DATABASE_URL)
+
+# 指標：每個路由的延遲、每種 SQL 的執行時間與連線池狀態（見 metrics.py，GET /metrics）
+metrics.instrument_app(app)
+metrics.instrument_engine(engine, "primary")
+# 模型呼叫的 token / 費用記帳寫入 ai_usage，並依每日預算與延遲挑選模型（見 ai_router.py）
+ai_router.configure(engine)
+# 相同檔案 + 相同目標的模型呼叫在各 worker 間合併為一次（見 singleflight.py）
+singleflight.configure(engine)
+# 取樣式 profiler：PROFILE_SAMPLE_RATE 或帶 X-Debug-Profile 標頭的請求輸出 flamegraph（見 profiler.py）
+profiler.instrument_app(app)
+# JSON 以 ujson 輸出 UTF-8，較大的回應依 Accept-Encoding 壓縮（見 responses.py）
+responses.install(app)
+# 學校 / 系所清單只在匯入系所資料時變動，序列化與壓縮後的結果保留 CATALOG_CACHE_SECONDS 秒
+CATALOG_CACHE_SECONDS = int(os.getenv("CATALOG_CACHE_SECONDS", "300"))
+catalog_responses = responses.EncodedResponseCache(ttl=CATALOG_CACHE_SECONDS)
+# /api/bootstrap 的學校 → 系所 → 學制目錄（預先序列化，每個 worker 一份）
+bootstrap_catalog = catalog.Catalog(max_age=CATALOG_CACHE_SECONDS)
+# 學校 / 系所搜尋的記憶體內索引（同上，過期後只同步有變動的系所）
+catalog_index = catalog_search.CatalogIndex(max_age=CATALOG_CACHE_SECONDS)
+# 名單回應以 (school, department, degree) 為 key、名單的 md5 為版本，內容變了就重新產生，不需要過期時間
+namelist_responses = responses.EncodedResponseCache(max_entries=1024)
+# 寄驗證碼、登入與模型呼叫的限流；THROTTLE_SHARED=true 時多台機器共用額度（見 throttle.py）
+throttle.configure(engine)
+# 系所統計即時推送：每個 worker 一條 LISTEN 連線，第一個訂閱者連上時才建立（見 live_stats.py）
+live_stats.configure(engine)
+# Prometheus 抓取 /metrics 時需帶 Authorization: Bearer <METRICS_TOKEN>（未設定時不驗證）
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# 讀寫分離：設定 DATABASE_REPLICA_URL 後，讀取量大的端點改走 replica
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+replica_engine = db.create_db_engine(DATABASE_REPLICA_URL) if DATABASE_REPLICA_URL else None
+if replica_engine is not None:
+    metrics.instrument_engine(replica_engine, "replica")
+# 使用者寫入後多少秒內的讀取固定走 primary，確保看得到自己剛送出的資料
+DB_STICKY_PRIMARY_SECONDS = int(os.getenv("DB_STICKY_PRIMARY_SECONDS", "10"))
+read_router = db.ReadRouter(engine, replica_engine, DB_STICKY_PRIMARY_SECONDS, secret=SECRET_KEY)
+# sticky 期限放在簽章過的 cookie 中，下一個請求落在其他 worker / 機器時仍會讀 primary
+STICKY_PRIMARY_COOKIE = "gf_read_primary"
+
+
+def mark_write(user_id):
+    """標記使用者剛寫入：回應時設定 sticky cookie"""
+    marker = read_router.write_marker(user_id)
+    if marker is not None:
+        g.read_primary_marker = marker
+
+
+def read_engine(user_id=None):
+    """該次讀取應使用的 engine（replica，或剛寫入過的使用者走 primary）"""
+    return read_router.engine_for(user_id, request.cookies.get(STICKY_PRIMARY_COOKIE))
+
+
+@app.after_request
+def set_read_primary_cookie(response):
+    marker = g.pop("read_primary_marker", None)
+    if marker is not None:
+        response.set_cookie(
+            STICKY_PRIMARY_COOKIE, marker,
+            max_age=DB_STICKY_PRIMARY_SECONDS + 1,
+            httponly=True,
+            # 前端與 API 不同網域，跨站送 cookie 需要 SameSite=None + Secure
+            secure=not IS_LOCAL_DEV,
+            samesite="Lax" if IS_LOCAL_DEV else "None",
+        )
+    return response
+
+# 錄取流向模擬（記憶體內，每個 worker 一份；超過 CASCADE_MAX_AGE 秒後由一個請求重新從資料庫載入）
+cascade_sim = cascade.CascadeSimulator(max_age=int(os.getenv("CASCADE_MAX_AGE", "600")))
+# 系所共同報名人數矩陣（同上，每個 worker 一份）
+overlap_matrix = overlap.OverlapMatrix(max_age=int(os.getenv("CASCADE_MAX_AGE", "600")))
+# 跨系所姓名反查索引（同上，每個 worker 一份）
+namelist_index = name_index.NameIndex(max_age=int(os.getenv("CASCADE_MAX_AGE", "600")))
+
+# 設定 DB_AUTO_MIGRATE=true 時，啟動時自動套用 schema migration（見 migrations.py）
+if os.getenv("DB_AUTO_MIGRATE", "").lower() == "true":
+    import migrations
+    migrations.upgrade(engine)
 
 if IS_LOCAL_DEV:
     print(f"[INFO] 資料庫連線: {'Neon (遠端)' if 'neon' in DATABASE_URL else '本地'}")
@@ -71,7 +166,16 @@ def is_valid_email_domain(email):
     return domain in ALLOWED_EMAIL_DOMAINS or domain.endswith('.edu.tw')
 
 # >>>>>>>>>>>>>>> register >>>>>>>>>>>>>>> #
+REGISTER_FAILURES = {
+    "missing": ({"success": False, "message": "此電子郵件尚未申請驗證碼"}, 400),
+    "used": ({"success": False, "message": "此電子郵件已註冊，將自動跳轉至登入頁面"}, 409),
+    "expired": ({"success": False, "message": "驗證碼過期，請重新申請"}, 400),
+    "mismatch": ({"success": False, "message": "驗證碼不正確"}, 400),
+    "locked": ({"success": False, "message": "驗證碼錯誤次數過多，請重新申請"}, 429),
+}
+
 @app.route('/api/register', methods=['POST'])
+@throttle.limit("register", "ip", "email")
 def register():
     data = request.get_json()
     username = data.get('name')
@@ -85,37 +189,41 @@ def register():
             "message": "此電子郵件域名不被允許。請使用學校 .edu.tw 信箱或常見的郵件服務（Gmail、Outlook 等）"
         }), 400
     
-    hashed_pw = generate_password_hash(password)  # 密碼 hash
     create_time = datetime.datetime.now(datetime.timezone.utc)
-    verify_result, verify_result_code = register_verify_email(data)
 
-    if verify_result_code != 200:
-        return verify_result, verify_result_code
-    else:
-    # 插入資料
+    # 先核對驗證碼（錯誤時累計嘗試次數），驗證碼正確才計算密碼 hash
+    with engine.begin() as conn:
+        failure = verifications.check(conn, email, data.get('captcha'), create_time)
+    if failure is not None:
+        body, status = REGISTER_FAILURES[failure]
+        return jsonify(body), status
+
+    try:
+        hashed_pw = sessions.hash_password(password)  # 密碼 hash
+    except sessions.KDFBusy:
+        return kdf_busy_response()
+
+    # 核對並消耗驗證碼、建立使用者在同一個交易（同一個 SQL）中完成
+    try:
         with engine.begin() as conn:
-            try:
-                # 將解析出的 school/department 一併儲存到 users 表（若表格有對應欄位）
-                school = data.get('school')
-                department = data.get('department')
-                create_user_sql = text("""
-                    INSERT INTO "users" (username, email, password_hash, school, department, created_at)
-                    VALUES (:username, :email, :password_hash, :school, :department, :created_at)
-                """)
-                conn.execute(create_user_sql, {
-                    "username": username,
-                    "email": email,
-                    "password_hash": hashed_pw,
-                    "school": school,
-                    "department": department,
-                    "created_at": create_time
-                })
-            except Exception as e:
-                return jsonify({"success": False, "message": f"註冊失敗: {str(e)}"}), 400
+            # 將解析出的 school/department 一併儲存到 users 表
+            user_id, failure = verifications.register(
+                conn, email, data.get('captcha'), create_time,
+                username=username,
+                password_hash=hashed_pw,
+                school=data.get('school'),
+                department=data.get('department'),
+            )
+    except Exception as e:
+        return jsonify({"success": False, "message": f"註冊失敗: {str(e)}"}), 400
 
+    if failure is not None:
+        body, status = REGISTER_FAILURES[failure]
+        return jsonify(body), status
     return jsonify({"success": True, "message": "註冊成功！"}), 201
 
 @app.route('/api/register_captcha_apply', methods=['POST'])
+@throttle.limit("captcha", "ip", "email")
 def register_captcha_apply():
     data = request.get_json()
     email = data.get('email')
@@ -129,60 +237,20 @@ def register_captcha_apply():
         }), 400
 
     verification_code = str(np.random.randint(100000, 999999))
-    # 插入資料
+    # 寄信前先提交，不在寄信期間持有交易
     with engine.begin() as conn:
-        exist_sql = text("""
-            SELECT * 
-            FROM email_verifications
-            WHERE email = :email
-            ORDER BY created_at DESC
-            LIMIT 1
-        """)
-        exist = conn.execute(exist_sql, {"email": email}).mappings().fetchone()
-        
-        if exist:
-            if exist["used"] == True:
-                return jsonify({"success": False, "message": "此電子郵件已經驗證過，將自動跳轉至登入頁面"}), 409
-            
-            else:
-                update_emailverification_sql = text("""
-                    UPDATE email_verifications
-                    SET verification_code = :verification_code,
-                        expires_at = :expires_at,
-                        created_at = :created_at
-                    WHERE email = :email
-                """)
-                conn.execute(update_emailverification_sql, {
-                    "email": email,
-                    "verification_code": verification_code,
-                    "expires_at": create_time + datetime.timedelta(minutes=5),
-                    "created_at": create_time
-                })
+        issued = verifications.issue(conn, email, verification_code, create_time)
+    if not issued:
+        return jsonify({"success": False, "message": "此電子郵件已經驗證過，將自動跳轉至登入頁面"}), 409
 
-                if send_mail(email, "captcha", verification_code) == True:
-                    return jsonify({"success": True, "message": "驗證碼已寄出，請在五分鐘內驗證"}), 201
-                else:
-                    return jsonify({"success": False, "message": "驗證碼寄出失敗"}), 400
-
-        else:
-            create_emailverification_sql = text("""
-                    INSERT INTO email_verifications (email, verification_code, expires_at, used, created_at)
-                    VALUES (:email, :verification_code, :expires_at, :used, :created_at)
-                """)
-            conn.execute(create_emailverification_sql, {
-                "email": email,
-                "verification_code": verification_code,
-                "expires_at": create_time + datetime.timedelta(minutes=5),
-                "used": False,
-                "created_at": create_time
-            })
-            if send_mail(email, "captcha", verification_code) == True:
-                return jsonify({"success": True, "message": "驗證碼已寄出，請在五分鐘內驗證"}), 201
-            else:
-                return jsonify({"success": False, "message": "驗證碼寄出失敗"}), 400
+    if send_mail(email, "captcha", verification_code) == True:
+        return jsonify({"success": True, "message": "驗證碼已寄出，請在五分鐘內驗證"}), 201
+    else:
+        return jsonify({"success": False, "message": "驗證碼寄出失敗"}), 400
 
 
 @app.route('/api/parse_id', methods=['POST'])
+@throttle.limit("parse_id", "ip")
 def api_parse_id():
     """接收上傳的學生證影像，呼叫 googleAI 做 OCR + 解析，回傳 school/department/name"""
     if 'file' not in request.files:
@@ -191,80 +259,64 @@ def api_parse_id():
     if file.filename == '':
         return jsonify({"success": False, "message": "未提供檔案名稱"}), 400
 
-    # 儲存暫存檔並交給 googleAI 處理
-    tmp = None
-    try:
-        suffix = os.path.splitext(file.filename)[1] or '.jpg'
+    suffix = os.path.splitext(file.filename)[1] or '.jpg'
+    content = file.read()
+
+    def _parse():
+        # 儲存暫存檔並交給 googleAI 處理
         tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-        file.save(tmp.name)
-        tmp.close()
+        try:
+            tmp.write(content)
+            tmp.close()
+            # googleAI 提供 read_student_id(path) -> ocr_text
+            ocr_text = googleAI.read_student_id(tmp.name)
+            # parse_ocr_with_google_ai 返回 dict 或 error 資訊
+            return googleAI.parse_ocr_with_google_ai(ocr_text)
+        finally:
+            try:
+                os.unlink(tmp.name)
+            except:
+                pass
 
-        # googleAI 提供 read_student_id(path) -> ocr_text
-        ocr_text = googleAI.read_student_id(tmp.name)
-        # parse_ocr_with_google_ai 返回 dict 或 error 資訊
-        parsed = googleAI.parse_ocr_with_google_ai(ocr_text)
+    def _is_parsed(parsed):
+        return isinstance(parsed, dict) and bool(parsed.get('school') and parsed.get('department') and parsed.get('name'))
 
-        if isinstance(parsed, dict) and parsed.get('school') and parsed.get('department') and parsed.get('name'):
+    try:
+        # 同一張學生證同時重送時只做一次 OCR + 解析；結果含姓名等個人資料，只在本 process 內合併，不寫入資料庫
+        parsed = singleflight.do(singleflight.content_key("parse_id", content), _parse, ok=_is_parsed,
+                                 shared=False)
+
+        if _is_parsed(parsed):
             return jsonify({"success": True, "result": parsed}), 200
         else:
             return jsonify({"success": False, "message": "解析失敗", "raw": parsed}), 400
     except Exception as e:
         return jsonify({"success": False, "message": f"解析錯誤: {str(e)}"}), 500
-    finally:
-        try:
-            if tmp:
-                os.unlink(tmp.name)
-        except:
-            pass
-
-def register_verify_email(data):
-    email = data.get('email')
-    captcha = data.get('captcha')
-    verify_time = datetime.datetime.now(datetime.timezone.utc)
-    with engine.begin() as conn:
-        verification = conn.execute(text("""
-            SELECT * 
-            FROM email_verifications
-            WHERE email = :email
-            ORDER BY created_at DESC
-            LIMIT 1
-        """), {"email": email}).mappings().fetchone()
-
-
-        if not verification:
-            return jsonify({"success": False, "message": "此電子郵件尚未申請驗證碼"}), 400
-        
-        if verification["used"] == True:
-                return jsonify({"success": False, "message": "此電子郵件已註冊，將自動跳轉至登入頁面"}), 409
-        
-        expires_at_aware = verification['expires_at'].replace(tzinfo=datetime.timezone.utc)
-        if verify_time > expires_at_aware:
-            return jsonify({"success": False, "message": "驗證碼過期，請重新申請"}), 400
-        
-        
-        if verification['verification_code'] == captcha:
-            # 驗證成功：更新 used
-            update_verification = text("""
-                UPDATE email_verifications
-                SET used = TRUE
-                WHERE id = :id
-            """)
-            conn.execute(update_verification, {"id": verification['id']})
-            return jsonify({"success": True, "message": "驗證成功"}), 200
-        else:
-            # 驗證碼不匹配
-            return jsonify({"success": False, "message": "驗證碼不正確"}), 400
 # <<<<<<<<<<<<<<< register <<<<<<<<<<<<<<< #
 
 # >>>>>>>>>>>>>>> login >>>>>>>>>>>>>>> #
+def kdf_busy_response():
+    response = jsonify({"success": False, "message": "登入人數過多，請稍後再試"})
+    response.headers["Retry-After"] = "5"
+    return response, 503
+
+def session_response(message, user_id, name, email, refresh_token):
+    return jsonify({
+        "success": True,
+        "message": message,
+        "token": sessions.access_token(SECRET_KEY, user_id, name, email),
+        "refresh_token": refresh_token,
+        "expires_in": sessions.ACCESS_TOKEN_MINUTES * 60
+    }), 200
+
 @app.route('/api/login', methods=['POST'])
+@throttle.limit("login", "ip", "email")
 def login():
-    import jwt
     data = request.get_json()
     email = data.get('email')
     entered_password = data.get('password')
-    login_time = datetime.datetime.now(datetime.timezone.utc)
-    with engine.begin() as conn:
+    # 核對密碼時不佔用資料庫連線
+    with db.read_only(engine) as conn:
         exist_sql = text("""
             SELECT * 
             FROM users
@@ -274,25 +326,38 @@ def login():
         """)
         exist = conn.execute(exist_sql, {"email": email}).mappings().fetchone()
 
-        if not exist:
-            return jsonify({"success": False, "message": "此電子郵件尚未註冊，將自動跳轉至註冊頁面"}), 404
-        
-        sql_password = exist["password_hash"]
-        if not check_password_hash(sql_password, entered_password):
+    if not exist:
+        return jsonify({"success": False, "message": "此電子郵件尚未註冊，將自動跳轉至註冊頁面"}), 404
+
+    try:
+        if not sessions.check_password(exist["password_hash"], entered_password):
             return jsonify({"success": False, "message": "密碼錯誤"}), 400
-        
-        user_id = exist["user_id"]
-        username = exist["username"]
-        payload = {
-            "user_id": user_id,
-            "name": username,
-            "email": email,
-            "exp": login_time + datetime.timedelta(hours=2),
-            "iat": login_time
-        }
-        token = jwt.encode(payload, SECRET_KEY, algorithm="HS256")
-        response = jsonify({"success": True, "message": "登入成功", "token": token})
-        return response, 200
+    except sessions.KDFBusy:
+        return kdf_busy_response()
+
+    user_id = exist["user_id"]
+    with engine.begin() as conn:
+        refresh_token = sessions.store.issue(conn, user_id)
+    return session_response("登入成功", user_id, exist["username"], email, refresh_token)
+
+@app.route('/api/refresh', methods=['POST'])
+@throttle.limit("refresh", "ip")
+def refresh_session():
+    """以 refresh token 換新的 access token 與 refresh token（舊的 refresh token 作廢）"""
+    data = request.get_json(silent=True) or {}
+    with engine.begin() as conn:
+        user, refresh_token = sessions.store.rotate(conn, data.get('refresh_token'), SECRET_KEY)
+    if user is None:
+        return jsonify({"success": False, "message": "登入已過期，請重新登入"}), 401
+    return session_response("已更新登入狀態", user["user_id"], user["username"], user["email"], refresh_token)
+
+@app.route('/api/logout', methods=['POST'])
+def logout():
+    """撤銷 refresh token（同一次登入輪替出來的都一併撤銷）；access token 於短時間內自然過期"""
+    data = request.get_json(silent=True) or {}
+    with engine.begin() as conn:
+        sessions.store.revoke(conn, data.get('refresh_token'))
+    return jsonify({"success": True, "message": "已登出"}), 200
 # <<<<<<<<<<<<<<< login <<<<<<<<<<<<<<< #
 
 # >>>>>>>>>>>>>>> token verification >>>>>>>>>>>>>>> #
@@ -303,67 +368,184 @@ def verify_token():
     if not auth_header or not auth_header.startswith('Bearer '):
         return jsonify({"success": False, "message": "未提供或格式錯誤的驗證 Token"}), 401
     
-    token = auth_header.split(' ')[1]
-    
     # 2. 驗證 Token
+    payload, error = bearer_payload()
+    if error is not None:
+        return error
+
+    # 驗證成功
+    return jsonify({
+        "success": True,
+        "user": {
+            "user_id": payload["user_id"],
+            "name": payload["name"],
+            "email": payload["email"]
+        }
+    }), 200
+
+def bearer_payload():
+    """解析 Authorization: Bearer <access token>，回傳 (payload, None)；失敗時回傳 (None, 401 回應)"""
+    auth_header = request.headers.get('Authorization')
+
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None, (jsonify({"success": False, "message": "請先登入"}), 401)
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        
-        # 驗證成功
-        return jsonify({
-            "success": True,
-            "user": {
-                "user_id": payload["user_id"],
-                "name": payload["name"],
-                "email": payload["email"]
-            }
-        }), 200
-        
+        return sessions.decode_access_token(SECRET_KEY, auth_header.split(' ')[1]), None
+
     except jwt.ExpiredSignatureError:
-        return jsonify({"success": False, "message": "登入已過期"}), 401
-        
-    except jwt.InvalidTokenError:
-        return jsonify({"success": False, "message": "無效的登入狀態"}), 401
+        # 前端看到這個 header 時以 refresh token 呼叫 /api/refresh 後重送（見 sessions.py）
+        response = jsonify({"success": False, "message": "登入已過期"})
+        response.headers["WWW-Authenticate"] = 'Bearer error="invalid_token", error_description="expired"'
+        return None, (response, 401)
+
+    except Exception:
+        return None, (jsonify({"success": False, "message": "無效的登入狀態"}), 401)
 
 def token_required(f):
     from functools import wraps
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth_header = request.headers.get('Authorization')
-        
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return jsonify({"success": False, "message": "請先登入"}), 401
-        
-        token = auth_header.split(' ')[1]
-        
-        try:
-            jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-            
-        except jwt.ExpiredSignatureError:
-            return jsonify({"success": False, "message": "登入已過期"}), 401
-            
-        except Exception:
-            return jsonify({"success": False, "message": "無效的登入狀態"}), 401
-            
+        payload, error = bearer_payload()
+        if error is not None:
+            return error
+        # 端點內以 g.token_payload / current_user_id() 取得，不必再解析一次
+        g.token_payload = payload
         return f(*args, **kwargs)
         
     return decorated
 
+def current_user_id():
+    """從 Authorization header 解析 user_id，無法解析時回傳 None"""
+    payload = g.get("token_payload")
+    if payload is not None:
+        return payload.get('user_id')
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    try:
+        payload = sessions.decode_access_token(SECRET_KEY, auth_header.split(' ')[1])
+    except Exception:
+        return None
+    return payload.get('user_id')
+
+def admin_required(f):
+    from functools import wraps
+    import hmac
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        provided = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(provided, ADMIN_TOKEN):
+            return jsonify({"success": False, "message": "權限不足"}), 403
+        return f(*args, **kwargs)
+
+    return decorated
+
+# >>>>>>>>>>>>>>> admin >>>>>>>>>>>>>>> #
+@app.route('/api/admin/db_pool_stats', methods=['GET'])
+@admin_required
+def api_db_pool_stats():
+    """回傳本 worker 的連線池狀態與 checkout 等待時間，用來依實際資料調整 pool 大小"""
+    stats = {"success": True, "pid": os.getpid(), "primary": db.pool_stats(engine)}
+    if replica_engine is not None:
+        stats["replica"] = db.pool_stats(replica_engine)
+    return jsonify(stats), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 文字格式的指標（本 worker）"""
+    import hmac
+    if METRICS_TOKEN:
+        provided = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(provided, f"Bearer {METRICS_TOKEN}"):
+            return jsonify({"success": False, "message": "權限不足"}), 403
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/api/admin/ai_usage', methods=['GET'])
+@admin_required
+def api_ai_usage_report():
+    """近 days 天（預設 30）的模型用量與費用，依系所與模型彙總"""
+    try:
+        days = min(max(int(request.args.get('days', 30)), 1), 366)
+    except ValueError:
+        return jsonify({"success": False, "message": "days 必須是整數"}), 400
+    with db.read_only(engine) as conn:
+        report = ai_router.usage_report(conn, days)
+    return jsonify({"success": True, **report}), 200
+
+
+@app.route('/api/admin/export', methods=['GET'])
+@admin_required
+def api_admin_export():
+    """串流匯出分析用資料（user_id 匿名化，見 export_data.py），讀取走 replica
+       Query params: dataset=choices|departments|schools，format=csv|parquet（預設 csv）
+    """
+    dataset = request.args.get('dataset', 'choices')
+    fmt = request.args.get('format', 'csv')
+    if dataset not in export_data.DATASETS:
+        return jsonify({"success": False, "message": f"dataset 必須是 {', '.join(export_data.DATASETS)}"}), 400
+    if fmt not in export_data.FORMATS:
+        return jsonify({"success": False, "message": "format 必須是 csv 或 parquet"}), 400
+    if fmt == "parquet" and export_data.pq is None:
+        return jsonify({"success": False, "message": "伺服器未安裝 pyarrow，請改用 csv"}), 400
+
+    chunks = export_data.stream_dataset(read_engine(), dataset, fmt)
+    response = app.response_class(chunks, mimetype=export_data.CONTENT_TYPES[fmt])
+    response.headers["Content-Disposition"] = f'attachment; filename="{dataset}.{fmt}"'
+    return response
+
+
+@app.route('/api/admin/load_catalog', methods=['POST'])
+@admin_required
+def api_admin_load_catalog():
+    """匯入教育部格式的系所清單（CSV / Excel，見 load_catalog.py）
+       form-data: file, retire=schools|all|none（預設 schools），dry_run=true|false
+       回傳：{ rows, inserted, updated, unchanged, retired }
+    """
+    file = request.files.get('file')
+    if file is None or not file.filename:
+        return jsonify({"success": False, "message": "請上傳檔案 (file)"}), 400
+    retire = request.form.get('retire', 'schools')
+    if retire not in load_catalog.RETIRE_SCOPES:
+        return jsonify({"success": False, "message": "retire 必須是 schools、all 或 none"}), 400
+    dry_run = request.form.get('dry_run', 'false').lower() == 'true'
+
+    try:
+        departments = load_catalog.read_departments(io.BytesIO(file.read()), file.filename)
+    except (ValueError, ImportError) as e:
+        return jsonify({"success": False, "message": f"無法讀取檔案: {str(e)}"}), 400
+    if departments.empty:
+        return jsonify({"success": False, "message": "檔案中沒有系所資料"}), 400
+
+    report = load_catalog.load(engine, departments, retire, dry_run)
+    if not dry_run:
+        catalog_responses.invalidate()
+        bootstrap_catalog.invalidate()
+        catalog_index.invalidate()
+    metrics.log_event("catalog_loaded", dry_run=dry_run, **report)
+    return jsonify({"success": True, "dry_run": dry_run, **report}), 200
+# <<<<<<<<<<<<<<< admin <<<<<<<<<<<<<<< #
+
 # >>>>>>>>>>>>>>> schools / departments / lookup >>>>>>>>>>>>>>> #
 @app.route('/api/schools', methods=['GET'])
 @token_required
 def api_get_schools():
     """回傳學校清單，從 schools 表取 distinct school 欄位，格式: [{id, name}, ...]"""
-    try:
-        with engine.begin() as conn:
+    def build():
+        with db.read_only(read_engine(current_user_id())) as conn:
             sql = text("""
                 SELECT DISTINCT school
                 FROM schools
+                WHERE retired_at IS NULL
                 ORDER BY school
             """)
             rows = conn.execute(sql).mappings().all()
-            schools = [{ 'id': r['school'], 'name': r['school'] } for r in rows]
-        return jsonify(schools), 200
+            return [{ 'id': r['school'], 'name': r['school'] } for r in rows]
+
+    try:
+        return catalog_responses.response("schools", build)
     except Exception as e:
         return jsonify({"success": False, "message": f"取得學校清單失敗: {str(e)}"}), 500
 
@@ -372,25 +554,54 @@ def api_get_schools():
 @token_required
 def api_get_departments(school_id):
     """回傳指定學校的系所清單，格式: [{id: '學校名/系所名', name: '系所名'}, ...]"""
-    try:
-        with engine.begin() as conn:
+    def build():
+        with db.read_only(read_engine(current_user_id())) as conn:
             sql = text("""
                 SELECT DISTINCT dep_name
                 FROM schools
-                WHERE school = :school_id
+                WHERE school = :school_id AND retired_at IS NULL
                 ORDER BY dep_name
             """)
             rows = conn.execute(sql, {"school_id": school_id}).mappings().all()
             # id 使用 "學校名/系所名" 的格式，確保唯一性
-            depts = [{ 
+            return [{ 
                 'id': f"{school_id}/{r['dep_name']}", 
                 'name': r['dep_name'] 
             } for r in rows]
-        return jsonify(depts), 200
+
+    try:
+        return catalog_responses.response(("departments", school_id), build)
     except Exception as e:
         return jsonify({"success": False, "message": f"取得系所清單失敗: {str(e)}"}), 500
 
 
+# 搜尋結果的上限
+SEARCH_LIMIT_MAX = 50
+
+
+@app.route('/api/search', methods=['GET'])
+@token_required
+def api_search_departments():
+    """搜尋學校與系所（自動完成用），支援部分字詞與縮寫，例如「台大 電機」、「資工」
+       Query params: q, limit（預設 10，上限 50）
+       回傳：{"success": true, "results": [{"school", "department", "degrees", "score"}, ...]}
+    """
+    query = request.args.get('q', '')
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        return jsonify({"success": False, "message": "limit 必須是整數"}), 400
+    if not 1 <= limit <= SEARCH_LIMIT_MAX:
+        return jsonify({"success": False, "message": f"limit 必須介於 1 到 {SEARCH_LIMIT_MAX}"}), 400
+
+    try:
+        # 索引過期時才由一個執行緒查詢資料庫，平常每次輸入只查記憶體（見 catalog_search.py）
+        catalog_index.ensure_loaded(lambda: db.read_only(read_engine(current_user_id())))
+        return jsonify({"success": True, "results": catalog_index.search(query, limit)}), 200
+    except Exception as e:
+        return jsonify({"success": False, "message": f"搜尋失敗: {str(e)}"}), 500
+
+
 @app.route('/api/degrees', methods=['GET'])
 @token_required
 def api_get_degrees():
@@ -399,10 +610,11 @@ def api_get_degrees():
     """
     school_q = request.args.get('school')
     dep_q = request.args.get('dep')
+    engine_for_read = read_engine(current_user_id())
     try:
         if school_q and dep_q:
             # 取得特定系的 degree 欄位
-            with engine.begin() as conn:
+            with db.read_only(engine_for_read) as conn:
                 sql = text("""
                     SELECT degree
                     FROM schools
@@ -417,8 +629,8 @@ def api_get_degrees():
                 return jsonify(parts), 200
         else:
             degrees_set = set()
-            with engine.begin() as conn:
-                sql = text('SELECT degree FROM schools')
+            with db.read_only(engine_for_read) as conn:
+                sql = text('SELECT degree FROM schools WHERE retired_at IS NULL')
                 rows = conn.execute(sql).mappings().all()
                 for r in rows:
                     deg = r.get('degree')
@@ -433,6 +645,46 @@ def api_get_degrees():
         return jsonify({"success": False, "message": f"取得學制清單失敗: {str(e)}"}), 500
 
 
+def namelist_status(namelist_raw, degree):
+    """/api/check_namelist 的回應內容"""
+    # 無名單
+    if not namelist_raw or namelist_raw.strip() == '':
+        return {
+            "success": True,
+            "has_namelist": False,
+            "message": f"{degree} 學制暫無名單，請上傳"
+        }
+
+    namelist_dict = json.loads(namelist_raw)
+
+    # 檢查指定 degree 是否存在
+    degree_data = namelist_dict.get(degree)
+
+    if not degree_data or not degree_data.get("names"):
+        return {
+            "success": True,
+            "has_namelist": False,
+            "message": f"{degree} 學制暫無名單，請上傳"
+        }
+
+    # 判斷是否有實際姓名
+    names_str = degree_data.get("names", "").strip()
+
+    if not names_str:
+        return {
+            "success": True,
+            "has_namelist": False,
+            "message": f"{degree} 學制名單為空，請上傳"
+        }
+
+    return {
+        "success": True,
+        "has_namelist": True,
+        "degree": degree,
+        "namelist": degree_data
+    }
+
+
 @app.route('/api/check_namelist', methods=['GET'])
 @token_required
 def api_check_namelist():
@@ -457,17 +709,22 @@ def api_check_namelist():
         }), 400
 
     try:
-        with engine.begin() as conn:
-            sql = text("""
-                SELECT namelist
+        with db.read_only(read_engine(current_user_id())) as conn:
+            # 帶上快取的版本一起查詢：名單沒變時不傳整份名單，直接送出快取的回應；變了就在同一個查詢取得名單
+            key = (school, department, degree)
+            cached_version = namelist_responses.version(key)
+            row = conn.execute(text("""
+                SELECT md5(COALESCE(namelist, '')) AS version,
+                       CASE WHEN md5(COALESCE(namelist, '')) IS DISTINCT FROM :cached_version
+                            THEN namelist END AS namelist
                 FROM schools
                 WHERE school = :school AND dep_name = :department
                 LIMIT 1
-            """)
-            row = conn.execute(sql, {
+            """), {
                 "school": school,
-                "department": department
-            }).mappings().fetchone()
+                "department": department,
+                "cached_version": cached_version
+            }).fetchone()
 
             # 查不到該系所
             if not row:
@@ -477,59 +734,94 @@ def api_check_namelist():
                     "message": "該系所不存在或尚未建立資料"
                 }), 200
 
-            namelist_raw = row['namelist']
+            def build():
+                namelist_raw = row.namelist
+                if row.version == cached_version:
+                    # 查詢後快取剛好被淘汰：名單沒有一起傳回，再讀一次
+                    namelist_raw = conn.execute(text("""
+                        SELECT namelist
+                        FROM schools
+                        WHERE school = :school AND dep_name = :department
+                        LIMIT 1
+                    """), {"school": school, "department": department}).scalar()
+                return namelist_status(namelist_raw, degree)
+
+            # 同一份名單的回應只序列化、壓縮一次；上傳後雜湊改變，其他 worker 也會重新產生
+            return namelist_responses.response(key, build, version=row.version)
 
-            # 無名單
-            if not namelist_raw or namelist_raw.strip() == '':
-                return jsonify({
-                    "success": True,
-                    "has_namelist": False,
-                    "message": f"{degree} 學制暫無名單，請上傳"
-                }), 200
+    except Exception as e:
+        return jsonify({"success": False, "message": f"檢查名單失敗: {str(e)}"}), 500
 
-            # 嘗試解析 JSON 格式
-            # try:
-            namelist_dict = json.loads(namelist_raw)
-            # except Exception:
-            #     # 舊格式相容：只有一個名單字串時
-            #     namelist_dict = {
-            #         "預設": {"names": namelist_raw, "has_names": True}
-            #     }
 
-            # 檢查指定 degree 是否存在
-            degree_data = namelist_dict.get(degree)
+# 名單分頁的上限（每頁人數）
+NAMELIST_PAGE_MAX = 1000
+NAMELIST_FIELDS = {"count", "has_names", "names"}
 
-            if not degree_data or not degree_data.get("names"):
-                return jsonify({
-                    "success": True,
-                    "has_namelist": False,
-                    "message": f"{degree} 學制暫無名單，請上傳"
-                }), 200
 
-            # 判斷是否有實際姓名
-            has_names = degree_data.get("has_names", True)
-            names_str = degree_data.get("names", "").strip()
+@app.route('/api/namelist', methods=['GET'])
+@token_required
+def api_namelist():
+    """讀取名單（可選欄位、分頁與前綴搜尋），讀的是逐筆的 namelist_entries，不會整份名單載入
+       Query params: school, department, degree
+                     fields  逗號分隔：count, has_names, names（預設 count,has_names，只檢查是否存在時不傳名字）
+                     offset / limit  名字的分頁（預設 0 / 100，limit 上限 1000）
+                     prefix  只回傳以此開頭的名字（offset / limit 套用在篩選後的結果）
+       回傳：
+       {
+           "success": true,
+           "has_namelist": true,
+           "degree": "碩士班",
+           "count": 120,
+           "has_names": true,
+           "names": ["張*睿", ...],
+           "next_offset": 100       // 沒有下一頁時為 null
+       }
+    """
+    school = request.args.get('school')
+    department = request.args.get('department')
+    degree = request.args.get('degree')
+    if not school or not department or not degree:
+        return jsonify({"success": False, "message": "需要提供 school、department 和 degree 參數"}), 400
+
+    fields = {f.strip() for f in request.args.get('fields', 'count,has_names').split(',') if f.strip()}
+    if not fields or not fields <= NAMELIST_FIELDS:
+        return jsonify({"success": False, "message": f"fields 只能是 {', '.join(sorted(NAMELIST_FIELDS))}"}), 400
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({"success": False, "message": "offset 與 limit 必須是整數"}), 400
+    if offset < 0 or not 1 <= limit <= NAMELIST_PAGE_MAX:
+        return jsonify({"success": False, "message": f"offset 不可為負數，limit 必須介於 1 到 {NAMELIST_PAGE_MAX}"}), 400
+    prefix = request.args.get('prefix') or None
 
-            if not names_str:
+    try:
+        with db.read_only(read_engine(current_user_id())) as conn:
+            meta = namelists.namelist_meta(conn, school, department, degree)
+            if meta is None:
                 return jsonify({
                     "success": True,
                     "has_namelist": False,
-                    "message": f"{degree} 學制名單為空，請上傳"
+                    "message": f"{degree} 學制暫無名單，請上傳"
                 }), 200
 
-            return jsonify({
-                "success": True,
-                "has_namelist": True,
-                "degree": degree,
-                "namelist": degree_data
-            }), 200
-
+            result = {"success": True, "has_namelist": True, "degree": degree}
+            if "count" in fields:
+                result["count"] = meta["count"]
+            if "has_names" in fields:
+                result["has_names"] = meta["has_names"]
+            if "names" in fields:
+                names, has_more = namelists.page_names(conn, school, department, degree, offset, limit, prefix)
+                result["names"] = names
+                result["next_offset"] = offset + len(names) if has_more else None
+        return jsonify(result), 200
     except Exception as e:
-        return jsonify({"success": False, "message": f"檢查名單失敗: {str(e)}"}), 500
+        return jsonify({"success": False, "message": f"讀取名單失敗: {str(e)}"}), 500
 
 
 @app.route('/api/upload_namelist', methods=['POST'])
 @token_required
+@throttle.limit("upload_namelist", "user", "ip", user_id=current_user_id)
 def api_upload_namelist():
     """上傳或解析名單，支援三種方式：
        1. 上傳檔案（PDF/圖片/Excel）- POST params: file (multipart), school, department, degree
@@ -545,7 +837,6 @@ def api_upload_namelist():
         return jsonify({"success": False, "message": "需要提供 school、department 和 degree 參數"}), 400
     
     result = None
-    tmp = None
     
     try:
         # 方式 1：檔案上傳
@@ -557,8 +848,17 @@ def api_upload_namelist():
             file_bytes = io.BytesIO(file.read())
             file_bytes.name = file.filename  # 保留原始檔案名稱，讓 googleAI 可以判斷副檔名
 
-            # 呼叫你的 Google AI 方法（需支援 BytesIO）
-            result = googleAI.parse_namelist_from_file(file_bytes, school + department + degree)
+            # 呼叫你的 Google AI 方法（需支援 BytesIO），用量記在該系所名下；
+            # 同一份檔案、同一個系所學制同時被多人上傳時只呼叫一次模型
+            target = school + department + degree
+            key = singleflight.content_key("namelist", file_bytes.getvalue(),
+                                            os.path.splitext(file.filename)[1].lower(), target)
+            with ai_router.usage_context(school, department, degree):
+                result = singleflight.do(
+                    key,
+                    lambda: googleAI.parse_namelist_from_file(file_bytes, target),
+                    ok=lambda r: bool(r and r.get('success')),
+                )
         
         # # 方式 2：提供 URL
         # elif 'url' in (request.get_json() or {}):
@@ -597,62 +897,25 @@ def api_upload_namelist():
         has_names = result.get('has_names')
         
         # 將名單存入 schools 表的 namelist 欄位（JSON 格式）
-        # 名單格式：{"degree": {"names": [...], "has_names": bool}}
-        names_str = ','.join(names)
-        
+        # 名單格式：{"degree": {"names": "A,B", "has_names": bool}}
         with engine.begin() as conn:
-            # 先查詢現有的 namelist 和 degree
-            query_sql = text("""
-                SELECT namelist, degree
-                FROM schools
-                WHERE school = :school AND dep_name = :department
-                LIMIT 1
-            """)
-            row = conn.execute(query_sql, {
-                "school": school,
-                "department": department
-            }).mappings().fetchone()
-            
-            # 初始化或更新 namelist dict，保留其他 degree
-            namelist_dict = {}
-            if row and row['namelist']:
-                namelist_dict = json.loads(row['namelist'])
+            found = namelists.save_degree_namelist(conn, school, department, degree, names, has_names)
+        # 系所不存在時沒有寫入任何資料，記憶體中的模擬與索引也不能更新
+        if not found:
+            return jsonify({"success": False, "message": "該系所不存在"}), 404
 
-            # 只更新指定 degree 的名單（新格式：包含 names 和 has_names）
-            namelist_dict[degree] = {
-                "names": names_str,
-                "has_names": has_names
-            }
-            namelist_json = json.dumps(namelist_dict, ensure_ascii=False)
-
-            # 更新 degree 欄位：確保傳入的 degree 在 degree 欄位中
-            existing_degrees = ""
-            if row and row.get('degree'):
-                existing_degrees = row['degree']
-            
-            # 解析現有 degree（逗號分隔）
-            degree_list = [d.strip() for d in existing_degrees.split(',') if d.strip()]
-            
-            # 如果傳入的 degree 不在列表中，就加入
-            if degree not in degree_list:
-                degree_list.append(degree)
-            
-            # 重新組成逗號分隔字串
-            updated_degrees = ','.join(degree_list)
+        mark_write(current_user_id())
+        try:
+            cascade_sim.update_namelist((school, department, degree), names, has_names)
+            namelist_index.set_list((school, department, degree), names, has_names)
+        except Exception as e:
+            metrics.log_event("cascade_update_failed", level="warning", error=str(e))
+        # 其他 worker 的名單快取在下一次請求比對 md5 時更新
+        namelist_responses.invalidate((school, department, degree))
+        # 上傳可能新增系所的學制
+        bootstrap_catalog.invalidate()
+        catalog_index.invalidate()
 
-            # 更新資料庫（同時更新 namelist 和 degree）
-            update_sql = text("""
-                UPDATE schools
-                SET namelist = :namelist, degree = :degree
-                WHERE school = :school AND dep_name = :department
-            """)
-            conn.execute(update_sql, {
-                "namelist": namelist_json,
-                "degree": updated_degrees,
-                "school": school,
-                "department": department
-            })
-        
         # 返回結果時也包含 has_names 信息
         msg_suffix = " (⚠️ 此系所名單無提供考生姓名)" if not has_names else ""
         
@@ -666,12 +929,6 @@ def api_upload_namelist():
         
     except Exception as e:
         return jsonify({"success": False, "message": f"上傳失敗: {str(e)}"}), 500
-    finally:
-        try:
-            if tmp and os.path.exists(tmp.name):
-                os.unlink(tmp.name)
-        except:
-            pass
 
 
 @app.route('/api/validate_name', methods=['POST'])
@@ -691,7 +948,7 @@ def api_validate_name():
         return jsonify({"success": False, "message": "需要提供 school, department, degree, name"}), 400
     
     try:
-        with engine.begin() as conn:
+        with db.read_only(read_engine(current_user_id())) as conn:
             sql = text("""
                 SELECT namelist
                 FROM schools
@@ -767,6 +1024,28 @@ def api_validate_name():
         return jsonify({"success": False, "message": f"驗證失敗: {str(e)}"}), 500
 
 
+@app.route('/api/lookup_name', methods=['GET'])
+@token_required
+def api_lookup_name():
+    """以登入使用者的名字反查所有名單，回傳名字出現在哪些系所學制的名單中（含 * 遮蔽比對）。
+       回傳：{ success, matches: [{ school, department, degree, matched_name }, ...] }
+    """
+    name = g.token_payload.get('name')
+    if not name:
+        return jsonify({"success": False, "message": "未取得使用者名稱"}), 400
+
+    try:
+        # 過期時只有一個執行緒重新載入，其他請求沿用舊的索引（見 reloader.py）
+        namelist_index.ensure_loaded(lambda: db.read_only(read_engine(current_user_id())))
+        matches = [
+            {"school": s, "department": d, "degree": g, "matched_name": matched}
+            for (s, d, g), matched in sorted(namelist_index.lookup(name).items())
+        ]
+        return jsonify({"success": True, "matches": matches}), 200
+    except Exception as e:
+        return jsonify({"success": False, "message": f"反查名單失敗: {str(e)}"}), 500
+
+
 @app.route('/api/user_filled_departments', methods=['GET'])
 @token_required
 def api_user_filled_departments():
@@ -789,7 +1068,7 @@ def api_user_filled_departments():
         return jsonify({"success": False, "message": "未取得 user_id"}), 401
 
     try:
-        with engine.begin() as conn:
+        with db.read_only(read_engine(user_id)) as conn:
             sql = text("""
                 SELECT school, department, degree, rank
                 FROM user_choices
@@ -847,7 +1126,7 @@ def api_user_department_stats():
         return jsonify({"success": False, "message": "需要提供 school, department, degree"}), 400
 
     try:
-        with engine.begin() as conn:
+        with db.read_only(read_engine(user_id)) as conn:
             # 取得該使用者在該系所的排名
             user_rank_sql = text("""
                 SELECT rank
@@ -863,61 +1142,12 @@ def api_user_department_stats():
             }).fetchone()
             user_rank = int(user_row[0]) if user_row and user_row[0] is not None else None
 
-            # 全校統計：該系所此學制的填志願人數
-            total_sql = text("""
-                SELECT COUNT(*) AS cnt
-                FROM user_choices
-                WHERE school = :school AND department = :department AND degree = :degree
-            """)
-            total_row = conn.execute(total_sql, {"school": school, "department": department, "degree": degree}).fetchone()
-            total_choices = int(total_row[0]) if total_row and total_row[0] is not None else 0
-
-            # 第一志願人數
-            first_sql = text("""
-                SELECT COUNT(*)
-                FROM user_choices
-                WHERE school = :school AND department = :department AND degree = :degree AND rank = 1
-            """)
-            first_row = conn.execute(first_sql, {"school": school, "department": department, "degree": degree}).fetchone()
-            first_choice = int(first_row[0]) if first_row and first_row[0] is not None else 0
-
-            # 第五志願後人數 (rank >= 5)
-            fifth_sql = text("""
-                SELECT COUNT(*)
-                FROM user_choices
-                WHERE school = :school AND department = :department AND degree = :degree AND rank >= 5
-            """)
-            fifth_row = conn.execute(fifth_sql, {"school": school, "department": department, "degree": degree}).fetchone()
-            fifth_and_after = int(fifth_row[0]) if fifth_row and fifth_row[0] is not None else 0
-
-            # 名單人數：從 schools.namelist dict 解析
-            namelist_count = 0
-            sql = text("""
-                SELECT namelist
-                FROM schools
-                WHERE school = :school AND dep_name = :department
-                LIMIT 1
-            """)
-            row = conn.execute(sql, {"school": school, "department": department}).mappings().fetchone()
-            if row and row.get('namelist'):
-                try:
-                    namelist_dict = json.loads(row['namelist'])
-                    degree_data = namelist_dict.get(degree)
-                    
-                    if degree_data:
-                        if isinstance(degree_data, dict):
-                            deg_list_str = degree_data.get('names', '')
-                        else:
-                            # 舊格式：直接是字符串
-                            deg_list_str = degree_data
-                        
-                        if deg_list_str and isinstance(deg_list_str, str):
-                            namelist_count = len([n for n in deg_list_str.split(',') if n.strip()])
-                except Exception as e:
-                    # 如果解析失敗，嘗試將整個namelist作為舊格式處理
-                    deg_list_str = row['namelist']
-                    if deg_list_str and isinstance(deg_list_str, str):
-                        namelist_count = len([n for n in deg_list_str.split(',') if n.strip()])
+            # 全校統計：直接讀取增量維護的 department_stats（見 rankings.py）
+            stats = rankings.get_stats(conn, school, department, degree) or {}
+            total_choices = stats.get('total_choices', 0)
+            first_choice = stats.get('first_choice', 0)
+            fifth_and_after = stats.get('fifth_and_after', 0)
+            namelist_count = stats.get('namelist_count', 0)
 
             return jsonify({
                 "success": True,
@@ -932,12 +1162,175 @@ def api_user_department_stats():
         return jsonify({"success": False, "message": f"取得統計失敗: {str(e)}"}), 500
 
 
+@app.route('/api/department_rankings', methods=['GET'])
+@token_required
+def api_department_rankings():
+    """回傳最熱門（競爭最激烈）的系所排行。
+       Query params: metric (total_choices / first_choice / applicants_per_seat), limit (預設 20，上限 100)
+       回傳：{ success, metric, rankings: [{ school, department, degree, total_choices, ... }, ...] }
+    """
+    metric = request.args.get('metric', 'total_choices')
+    if metric not in rankings.RANKING_METRICS:
+        return jsonify({
+            "success": False,
+            "message": f"metric 必須是 {', '.join(rankings.RANKING_METRICS)} 其中之一"
+        }), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+    except ValueError:
+        return jsonify({"success": False, "message": "limit 必須是整數"}), 400
+
+    try:
+        with db.read_only(read_engine(current_user_id())) as conn:
+            rows = rankings.top_departments(conn, metric, limit)
+        return jsonify({"success": True, "metric": metric, "rankings": rows}), 200
+    except Exception as e:
+        return jsonify({"success": False, "message": f"取得排行失敗: {str(e)}"}), 500
+
+
+@app.route('/api/admission_cascade', methods=['GET'])
+@token_required
+def api_admission_cascade():
+    """回傳指定系所學制的錄取流向模擬結果（預估缺額與候補移動）。
+       Query params: school, department, degree
+       回傳：{ success, result: { seats, applicants, admitted, projected_accepted,
+                                 projected_vacancies, waitlist_promoted }, simulation: {...} }
+    """
+    school = request.args.get('school')
+    department = request.args.get('department')
+    degree = request.args.get('degree')
+
+    if not all([school, department, degree]):
+        return jsonify({"success": False, "message": "需要提供 school, department, degree"}), 400
+
+    try:
+        # 過期時只有一個執行緒重新載入，其他請求沿用舊的模擬結果（見 reloader.py）
+        cascade_sim.ensure_loaded(lambda: db.read_only(read_engine(current_user_id())))
+        result = cascade_sim.department_result((school, department, degree))
+        return jsonify({
+            "success": True,
+            "result": result,
+            "simulation": cascade_sim.summary()
+        }), 200
+    except Exception as e:
+        return jsonify({"success": False, "message": f"取得錄取模擬失敗: {str(e)}"}), 500
+
+
+@app.route('/api/department_overlap', methods=['GET'])
+@token_required
+def api_department_overlap():
+    """回傳與指定系所學制共同報名人數最多的系所。
+       Query params: school, department, degree, limit (預設 10，上限 50)
+       回傳：{ success, applicants, overlaps: [{ school, department, degree, overlap }, ...] }
+    """
+    school = request.args.get('school')
+    department = request.args.get('department')
+    degree = request.args.get('degree')
+
+    if not all([school, department, degree]):
+        return jsonify({"success": False, "message": "需要提供 school, department, degree"}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        return jsonify({"success": False, "message": "limit 必須是整數"}), 400
+
+    try:
+        # 過期時只有一個執行緒重新載入，其他請求沿用舊的矩陣（見 reloader.py）
+        overlap_matrix.ensure_loaded(lambda: db.read_only(read_engine(current_user_id())))
+        key = (school, department, degree)
+        top = overlap_matrix.top_overlaps(key, limit) or []
+        return jsonify({
+            "success": True,
+            "applicants": overlap_matrix.applicant_count(key),
+            "overlaps": [
+                {"school": s, "department": d, "degree": g, "overlap": count}
+                for (s, d, g), count in top
+            ]
+        }), 200
+    except Exception as e:
+        return jsonify({"success": False, "message": f"取得共同報名統計失敗: {str(e)}"}), 500
+
+
+def _validation_response(rows, validation):
+    return [
+        {"selection": f"{school}/{department}", "degree": degree, "rank": rank, **v}
+        for (school, department, degree, rank), v in zip(rows, validation)
+    ]
+
+
+@app.route('/api/stats/stream_ticket', methods=['POST'])
+def api_stats_stream_ticket():
+    """以 access token 換一張 /api/stats/stream 用的短效票券（放在網址中的是票券，不是 access token）
+       回傳：{ success, ticket, expires_in }
+    """
+    payload, error = bearer_payload()
+    if error is not None:
+        return error
+    return jsonify({
+        "success": True,
+        "ticket": sessions.stream_ticket(SECRET_KEY, payload),
+        "expires_in": sessions.STREAM_TICKET_SECONDS
+    }), 200
+
+
+@app.route('/api/stats/stream', methods=['GET'])
+def api_stats_stream():
+    """以 Server-Sent Events 推送系所統計，統計有變動時才送出（同一個間隔內的多次變動只送一次）
+       Query params: key=school|department|degree（可重複）
+                     ticket=<POST /api/stats/stream_ticket 取得的票券>（EventSource 無法帶 Authorization header 時使用，
+                     票券 STREAM_TICKET_SECONDS 秒內有效；連線中斷後重連需先換一張新的）
+       事件：event: stats，data: { stats: [{ school, department, degree, total_choices,
+             namelist_count, first_choice, fifth_and_after }] }；連上時先送一次完整統計
+    """
+    ticket = request.args.get('ticket')
+    if ticket:
+        try:
+            claims = sessions.decode_stream_ticket(SECRET_KEY, ticket)
+        except jwt.ExpiredSignatureError:
+            return jsonify({"success": False, "message": "票券已過期"}), 401
+        except Exception:
+            return jsonify({"success": False, "message": "無效的票券"}), 401
+        expires_at = claims.get('session_exp')
+    else:
+        payload, error = bearer_payload()
+        if error is not None:
+            return error
+        expires_at = payload.get('exp')
+
+    keys = []
+    for raw in request.args.getlist('key'):
+        parts = raw.split('|')
+        if len(parts) != 3 or not all(parts):
+            return jsonify({"success": False, "message": f"無效的 key: {raw}"}), 400
+        keys.append(tuple(parts))
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return jsonify({"success": False, "message": "需要提供 key=school|department|degree"}), 400
+    if len(keys) > live_stats.MAX_KEYS:
+        return jsonify({"success": False, "message": f"最多訂閱 {live_stats.MAX_KEYS} 個系所"}), 400
+
+    try:
+        # 在建立回應之前訂閱，連線數已滿時還能回 503；access token 過期時結束連線
+        events, close = live_stats.stream(keys, expires_at=expires_at)
+    except live_stats.TooManySubscribers:
+        response = jsonify({"success": False, "message": "目前連線人數過多，請稍後再試"})
+        response.headers["Retry-After"] = "30"
+        return response, 503
+    response = app.response_class(events, mimetype="text/event-stream")
+    response.call_on_close(close)
+    response.headers["Cache-Control"] = "no-cache"
+    # 避免反向代理緩衝整個串流
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 @app.route('/api/submit_choices', methods=['POST'])
 @token_required
 def api_submit_choices():
     """接收前端送出的志願序 choices: 
-       { choices: [ { selection: 'school/dep', degree: '碩士班' }, ... ] }
+       { choices: [ { selection: 'school/dep', degree: '碩士班' }, ... ], strict: false }
        改成每筆志願獨立存一列 (user_id, rank, school, dep, degree)
+       回傳中的 validation 為每筆志願的名單驗證結果（與 /api/validate_name 相同規則）
     """
     auth_header = request.headers.get('Authorization')
     
@@ -958,76 +1351,101 @@ def api_submit_choices():
     choices = data.get('choices')
     if not choices or not isinstance(choices, list):
         return jsonify({"success": False, "message": "請提供 choices 陣列"}), 400
+    # strict=true 時，只要有一筆志願不在名單中就不儲存
+    strict = bool(data.get('strict'))
+
+    # 先檢查所有志願格式，避免刪掉舊志願後才發現格式錯誤
+    new_rows = []
+    for i, c in enumerate(choices, start=1):  # rank 從 1 開始
+        sel = c.get('selection')
+        degree = c.get('degree')
+        if not sel or not degree:
+            return jsonify({"success": False, "message": "每筆 choice 必須包含 selection 與 degree"}), 400
+
+        parts = sel.split('/', 1)
+        if len(parts) != 2:
+            return jsonify({"success": False, "message": f"無效的 selection 格式: {sel}"}), 400
+
+        new_rows.append((parts[0], parts[1], degree, i))
 
     try:
         with engine.begin() as conn:
-            # 先刪掉該使用者的所有舊志願，確保更新是原子性的
-            conn.execute(
-                text("DELETE FROM user_choices WHERE user_id = :user_id"),
+            # 一次取回所有志願系所的 degree 與名單，同時批次驗證名字是否在名單中
+            departments = namelists.load_departments(conn, [(r[0], r[1]) for r in new_rows])
+            validation = namelists.validate_choices(payload.get('name'), new_rows, departments)
+            if strict and not all(v["is_valid"] for v in validation):
+                return jsonify({
+                    "success": False,
+                    "message": "部分志願未通過名單驗證",
+                    "validation": _validation_response(new_rows, validation)
+                }), 400
+
+            # 先刪掉該使用者的所有舊志願，確保更新是原子性的（同時取回舊志願用來計算統計差異）
+            old_rows = conn.execute(
+                text("""
+                    DELETE FROM user_choices WHERE user_id = :user_id
+                    RETURNING school, department, degree, rank
+                """),
                 {"user_id": user_id}
-            )
+            ).fetchall()
             now = datetime.datetime.now(datetime.timezone.utc)
-            # 新增所有新的志願
-            for i, c in enumerate(choices, start=1):  # rank 從 1 開始
-                sel = c.get('selection')
-                degree = c.get('degree')
-                if not sel or not degree:
-                    return jsonify({"success": False, "message": "每筆 choice 必須包含 selection 與 degree"}), 400
-
-                parts = sel.split('/', 1)
-                if len(parts) != 2:
-                    return jsonify({"success": False, "message": f"無效的 selection 格式: {sel}"}), 400
 
-                school, department = parts[0], parts[1]
-                
-                # 檢查該系所的 degree 欄位是否包含此 degree，若無則新增
-                check_degree_sql = text("""
-                    SELECT degree
-                    FROM schools
+            # 檢查各系所的 degree 欄位是否包含志願的 degree，若無則新增
+            degree_updates = {}
+            for school, department, degree, rank in new_rows:
+                row = departments.get((school, department))
+                if not row:
+                    continue
+                key = (school, department)
+                degree_list = degree_updates.get(key)
+                if degree_list is None:
+                    degree_list = [d.strip() for d in (row['degree'] or '').split(',') if d.strip()]
+                if degree not in degree_list:
+                    degree_updates[key] = degree_list + [degree]
+            if degree_updates:
+                conn.execute(text("""
+                    UPDATE schools
+                    SET degree = :degree
                     WHERE school = :school AND dep_name = :department
-                    LIMIT 1
-                """)
-                degree_row = conn.execute(check_degree_sql, {
-                    "school": school,
-                    "department": department
-                }).mappings().fetchone()
-                
-                if degree_row:
-                    existing_degrees = degree_row.get('degree', '')
-                    degree_list = [d.strip() for d in existing_degrees.split(',') if d.strip()]
-                    
-                    # 如果此 degree 不在列表中，新增它
-                    if degree not in degree_list:
-                        degree_list.append(degree)
-                        new_degrees_str = ','.join(degree_list)
-                        update_degree_sql = text("""
-                            UPDATE schools
-                            SET degree = :degree
-                            WHERE school = :school AND dep_name = :department
-                        """)
-                        conn.execute(update_degree_sql, {
-                            "degree": new_degrees_str,
-                            "school": school,
-                            "department": department
-                        })
-                
-                insert_sql = text("""
-                    INSERT INTO user_choices (user_id, rank, school, department, degree, created_at)
-                    VALUES (:user_id, :rank, :school, :department, :degree, :created_at)
-                """)
-                conn.execute(insert_sql, {
+                """), [
+                    {"degree": ','.join(degrees), "school": school, "department": department}
+                    for (school, department), degrees in degree_updates.items()
+                ])
+
+            # 新增所有新的志願
+            conn.execute(text("""
+                INSERT INTO user_choices (user_id, rank, school, department, degree, created_at)
+                VALUES (:user_id, :rank, :school, :department, :degree, :created_at)
+            """), [
+                {
                     "user_id": user_id,
-                    "rank": i,
+                    "rank": rank,
                     "school": school,
                     "department": department,
                     "degree": degree,
                     "created_at": now
-                })
+                }
+                for school, department, degree, rank in new_rows
+            ])
 
-        return jsonify({"success": True, "message": "志願序儲存成功"}), 201
+            # 只把新舊志願的差異加減到系所統計
+            rankings.apply_choice_diff(conn, old_rows, new_rows)
+
+        mark_write(user_id)
+        submitted_keys = [row[:3] for row in new_rows]
+        try:
+            cascade_sim.update_user(user_id, payload.get('name'), submitted_keys)
+            overlap_matrix.update_user(user_id, payload.get('name'), submitted_keys)
+        except Exception as e:
+            metrics.log_event("cascade_update_failed", level="warning", error=str(e))
+        return jsonify({
+            "success": True,
+            "message": "志願序儲存成功",
+            "validation": _validation_response(new_rows, validation)
+        }), 201
 
     except Exception as e:
-        print(e)
+        metrics.log_event("submit_choices_failed", level="error", user_id=user_id, error=str(e))
         return jsonify({"success": False, "message": f"儲存失敗: {str(e)}"}), 500
 
 
@@ -1051,7 +1469,7 @@ def api_get_user_choices():
         return jsonify({"success": False, "message": "未取得 user_id"}), 401
 
     try:
-        with engine.begin() as conn:
+        with db.read_only(read_engine(user_id)) as conn:
             sql = text("""
                 SELECT school, department, degree
                 FROM user_choices
@@ -1075,6 +1493,55 @@ def api_get_user_choices():
     except Exception as e:
         return jsonify({"success": False, "message": f"取得志願序失敗: {str(e)}"}), 500
 
+
+
+@app.route('/api/bootstrap', methods=['GET'])
+@token_required
+def api_bootstrap():
+    """前端首次載入需要的資料一次回傳（取代 verify_token + schools + departments + degrees + get_user_choices）
+       Query params: catalog_version（選填，與目前目錄相同時不回傳目錄）
+       回傳：
+       {
+           "success": true,
+           "user": {"user_id": 1, "name": "...", "email": "..."},
+           "choices": [{"selection": "學校/系所", "degree": "碩士班"}, ...],
+           "catalog": {"version": "...", "degrees": [...], "schools": [[學校, [[系所, [學制索引]]]]]}
+                      // catalog_version 相同時為 null（見 catalog.py）
+       }
+    """
+    payload = g.token_payload
+    user_id = current_user_id()
+    try:
+        # 目錄（過期時才由一個執行緒查詢）與志願序在同一個連線中讀取
+        with db.read_only(read_engine(user_id)) as conn:
+            bootstrap_catalog.ensure_loaded(lambda: contextlib.nullcontext(conn))
+            rows = conn.execute(text("""
+                SELECT school, department, degree
+                FROM user_choices
+                WHERE user_id = :user_id
+                ORDER BY rank
+            """), {"user_id": user_id}).mappings().fetchall()
+    except Exception as e:
+        return jsonify({"success": False, "message": f"載入失敗: {str(e)}"}), 500
+
+    body = app.json.dumps({
+        "success": True,
+        "user": {
+            "user_id": payload["user_id"],
+            "name": payload["name"],
+            "email": payload["email"]
+        },
+        "choices": [
+            {"selection": f"{r['school']}/{r['department']}", "degree": r['degree']}
+            for r in rows
+        ],
+    })
+    # 目錄已預先序列化，直接接在後面，不必每次重新 dumps
+    version, encoded = bootstrap_catalog.snapshot()
+    catalog_json = "null" if request.args.get('catalog_version') == version else encoded
+    body = body[:-1] + ',"catalog":' + catalog_json + '}\n'
+    return app.response_class(body, status=200, mimetype="application/json")
+
 # <<<<<<<<<<<<<<< schools / departments / lookup <<<<<<<<<<<<<<< #
 if __name__ == "__main__":
     if IS_LOCAL_DEV:
@@ -0,0 +1,458 @@
+"""端點基準測試
+
+以 Flask test client 逐一呼叫 app.py 的端點（不經過網路與 gunicorn），資料庫為本機 Postgres，
+Gemini / Vision / SMTP 換成固定延遲的替身（見 stubs.py）。每個端點輸出
+p50 / p95 / p99 延遲與每個請求執行的 SQL 數。
+
+用法：
+    export BENCH_DATABASE_URL=postgresql://postgres@localhost:5432/graduatedfriends_bench
+    python bench/bench_endpoints.py --seed                      # 建立 schema 並產生資料後測試
+    python bench/bench_endpoints.py --save-baseline bench/baseline.json
+    python bench/bench_endpoints.py --compare bench/baseline.json   # 退步時 exit code 為 1
+
+BENCH_DATABASE_URL 必須指向基準測試專用的資料庫（--seed 會清空資料表），
+不會讀取 DATABASE_URL，避免誤連正式環境。
+SQLite 不支援 app 使用的 unnest / FOR UPDATE / advisory lock 等語法，因此只支援 Postgres。
+
+submit_choices / upload_namelist 會修改資料，要讓數字可以和 baseline 比較，請每次都加 --seed。
+SQL 數是固定的，任何增加都視為退步；延遲受機器影響，超過 baseline 的 (1 + --threshold) 倍才視為退步。
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import numpy as np
+from sqlalchemy import event, text
+
+import seed as bench_seed
+from stubs import Stubs
+
+SECRET_KEY = "bench-secret-key-for-local-benchmarks-only"
+ADMIN_TOKEN = "bench-admin"
+
+
+def load_app(url):
+    """以基準測試設定匯入 app，並確保所有資料庫連線都指向 BENCH_DATABASE_URL
+
+    app.py 會以 override=True 載入 .env，匯入前先把 dotenv.load_dotenv 換成不覆寫既有環境變數的版本，
+    本機 .env 中的 DATABASE_URL / DB_AUTO_MIGRATE 等設定不會蓋掉下面的值
+    （否則 DB_AUTO_MIGRATE=true 時匯入 app 就會對 .env 的資料庫跑 migration）。
+    匯入後再把 engine 與所有持有 engine 的模組重新設定一次。
+    """
+    import dotenv
+
+    load_dotenv = dotenv.load_dotenv
+
+    def load_dotenv_without_override(*args, **kwargs):
+        kwargs["override"] = False
+        return load_dotenv(*args, **kwargs)
+
+    dotenv.load_dotenv = load_dotenv_without_override
+
+    os.environ["DATABASE_URL"] = url
+    os.environ["SECRET_KEY"] = SECRET_KEY
+    os.environ["ADMIN_TOKEN"] = ADMIN_TOKEN
+    # 不可用 pop：沒有設定的變數仍會從 .env 載入，因此明確設為空值 / false
+    os.environ["DATABASE_REPLICA_URL"] = ""
+    os.environ["DB_AUTO_MIGRATE"] = "false"
+    os.environ["LIVE_STATS_LISTEN_URL"] = ""
+    # 壓測時同一個 IP / 帳號會大量重複請求，關閉限流
+    os.environ["THROTTLE_ENABLED"] = "false"
+    import app
+    import db
+    import metrics
+    import ai_router
+    import singleflight
+    import throttle
+    import live_stats
+
+    app.engine = db.create_db_engine(url)
+    metrics.instrument_engine(app.engine, "primary")
+    ai_router.configure(app.engine)
+    singleflight.configure(app.engine)
+    throttle.configure(app.engine)
+    live_stats.configure(app.engine)
+    app.read_router = db.ReadRouter(app.engine, secret=SECRET_KEY)
+    app.SECRET_KEY = SECRET_KEY
+    app.ADMIN_TOKEN = ADMIN_TOKEN
+    return app
+
+
+class QueryCounter:
+    """計算 engine 上執行的 SQL 數（含 executemany，算一次）"""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def make_token(user_id, name, email):
+    import jwt
+    now = datetime.datetime.now(datetime.timezone.utc)
+    payload = {"user_id": user_id, "name": name, "email": email,
+               "exp": now + datetime.timedelta(hours=2), "iat": now}
+    return jwt.encode(payload, SECRET_KEY, algorithm="HS256")
+
+
+class Fixture:
+    """從資料庫抽樣使用者與系所，讓每個請求打到不同的資料"""
+
+    def __init__(self, engine, rng):
+        self.rng = rng
+        self.engine = engine
+        with engine.connect() as conn:
+            self.users = conn.execute(text("""
+                SELECT user_id, username, email FROM users ORDER BY user_id LIMIT 2000
+            """)).fetchall()
+            self.departments = conn.execute(text("""
+                SELECT school, dep_name, split_part(degree, ',', 1) AS degree
+                FROM schools ORDER BY id
+            """)).fetchall()
+            # 熱門系所（有人填寫、有名單）才測得到模擬與共同報名
+            self.popular = conn.execute(text("""
+                SELECT school, department, degree FROM department_stats
+                ORDER BY total_choices DESC LIMIT 200
+            """)).fetchall()
+        if not self.users or not self.departments:
+            raise SystemExit("[ERROR] 資料庫沒有資料，請加上 --seed")
+        self.schools = sorted({d[0] for d in self.departments})
+        self._tokens = {}
+        self._email_seq = 0
+
+    def user(self):
+        u = self.rng.choice(self.users)
+        if u[0] not in self._tokens:
+            self._tokens[u[0]] = {"Authorization": "Bearer " + make_token(u[0], u[1], u[2])}
+        return u, self._tokens[u[0]]
+
+    def department(self, popular=False):
+        return self.rng.choice(self.popular if popular and self.popular else self.departments)
+
+    def new_email(self):
+        self._email_seq += 1
+        return f"bench-new-{os.getpid()}-{self._email_seq}@gmail.com"
+
+    def refresh_token(self, user_id):
+        """新發一個 refresh token（/api/refresh 會讓舊的作廢，每次都要新的）"""
+        import sessions
+        with self.engine.begin() as conn:
+            return sessions.store.issue(conn, user_id)
+
+    def unique_bytes(self):
+        """每次不同的檔案內容，避免上傳與辨識被 singleflight 的結果快取命中"""
+        self._email_seq += 1
+        return f"{os.getpid()}-{self._email_seq}".encode()
+
+
+# ---------- 端點 ----------
+# 每個 case 回傳 (method, path, kwargs)，kwargs 直接傳給 test client
+
+def case_login(f):
+    u, _ = f.user()
+    return "POST", "/api/login", {"json": {"email": u[2], "password": bench_seed.BENCH_PASSWORD}}
+
+
+def case_refresh(f):
+    u, _ = f.user()
+    return "POST", "/api/refresh", {"json": {"refresh_token": f.refresh_token(u[0])}}
+
+
+def case_verify_token(f):
+    _, headers = f.user()
+    return "GET", "/api/verify_token", {"headers": headers}
+
+
+def case_schools(f):
+    _, headers = f.user()
+    return "GET", "/api/schools", {"headers": headers}
+
+
+def case_departments(f):
+    _, headers = f.user()
+    return "GET", f"/api/schools/{f.rng.choice(f.schools)}/departments", {"headers": headers}
+
+
+def case_degrees(f):
+    _, headers = f.user()
+    d = f.department()
+    return "GET", "/api/degrees", {"headers": headers, "query_string": {"school": d[0], "dep": d[1]}}
+
+
+SEARCH_QUERIES = ["台北 電機", "資工", "臺中", "經濟", "大學 法律", "新竹 化工", "電", "財金"]
+
+
+def case_search(f):
+    _, headers = f.user()
+    return "GET", "/api/search", {"headers": headers, "query_string": {"q": f.rng.choice(SEARCH_QUERIES)}}
+
+
+def case_check_namelist(f):
+    _, headers = f.user()
+    d = f.department()
+    return "GET", "/api/check_namelist", {
+        "headers": headers, "query_string": {"school": d[0], "department": d[1], "degree": d[2]}}
+
+
+def case_namelist_page(f):
+    _, headers = f.user()
+    d = f.department()
+    return "GET", "/api/namelist", {"headers": headers, "query_string": {
+        "school": d[0], "department": d[1], "degree": d[2],
+        "fields": "count,has_names,names", "offset": f.rng.randrange(0, 150), "limit": 50}}
+
+
+def case_validate_name(f):
+    u, headers = f.user()
+    d = f.department(popular=True)
+    return "POST", "/api/validate_name", {
+        "headers": headers, "json": {"school": d[0], "department": d[1], "degree": d[2], "name": u[1]}}
+
+
+def case_lookup_name(f):
+    _, headers = f.user()
+    return "GET", "/api/lookup_name", {"headers": headers}
+
+
+def case_user_filled_departments(f):
+    _, headers = f.user()
+    return "GET", "/api/user_filled_departments", {"headers": headers}
+
+
+def case_user_department_stats(f):
+    _, headers = f.user()
+    d = f.department(popular=True)
+    return "GET", "/api/user_department_stats", {
+        "headers": headers, "query_string": {"school": d[0], "department": d[1], "degree": d[2]}}
+
+
+def case_department_rankings(f):
+    _, headers = f.user()
+    return "GET", "/api/department_rankings", {"headers": headers, "query_string": {"limit": 20}}
+
+
+def case_admission_cascade(f):
+    _, headers = f.user()
+    d = f.department(popular=True)
+    return "GET", "/api/admission_cascade", {
+        "headers": headers, "query_string": {"school": d[0], "department": d[1], "degree": d[2]}}
+
+
+def case_department_overlap(f):
+    _, headers = f.user()
+    d = f.department(popular=True)
+    return "GET", "/api/department_overlap", {
+        "headers": headers, "query_string": {"school": d[0], "department": d[1], "degree": d[2]}}
+
+
+def case_get_user_choices(f):
+    _, headers = f.user()
+    return "GET", "/api/get_user_choices", {"headers": headers}
+
+
+def case_bootstrap(f):
+    _, headers = f.user()
+    return "GET", "/api/bootstrap", {"headers": headers}
+
+
+def case_submit_choices(f):
+    _, headers = f.user()
+    picks = f.rng.sample(f.departments, 5)
+    return "POST", "/api/submit_choices", {"headers": headers, "json": {
+        "choices": [{"selection": f"{d[0]}/{d[1]}", "degree": d[2]} for d in picks]}}
+
+
+def case_upload_namelist(f):
+    _, headers = f.user()
+    d = f.department()
+    return "POST", "/api/upload_namelist", {"headers": headers, "data": {
+        "school": d[0], "department": d[1], "degree": d[2],
+        "file": (io.BytesIO(b"%PDF-1.4 bench " + f.unique_bytes()), "namelist.pdf")}}
+
+
+def case_parse_id(f):
+    return "POST", "/api/parse_id", {"data": {"file": (io.BytesIO(b"\xff\xd8bench " + f.unique_bytes()), "id.jpg")}}
+
+
+def case_register_captcha_apply(f):
+    return "POST", "/api/register_captcha_apply", {"json": {"email": f.new_email()}}
+
+
+# (名稱, case, 是否呼叫外部服務替身)；呼叫替身的端點以 --slow-iterations 次數執行
+CASES = [
+    ("login", case_login, False),
+    ("refresh", case_refresh, False),
+    ("verify_token", case_verify_token, False),
+    ("schools", case_schools, False),
+    ("departments", case_departments, False),
+    ("degrees", case_degrees, False),
+    ("search", case_search, False),
+    ("check_namelist", case_check_namelist, False),
+    ("namelist_page", case_namelist_page, False),
+    ("validate_name", case_validate_name, False),
+    ("lookup_name", case_lookup_name, False),
+    ("user_filled_departments", case_user_filled_departments, False),
+    ("user_department_stats", case_user_department_stats, False),
+    ("department_rankings", case_department_rankings, False),
+    ("admission_cascade", case_admission_cascade, False),
+    ("department_overlap", case_department_overlap, False),
+    ("get_user_choices", case_get_user_choices, False),
+    ("bootstrap", case_bootstrap, False),
+    ("submit_choices", case_submit_choices, False),
+    ("upload_namelist", case_upload_namelist, True),
+    ("parse_id", case_parse_id, True),
+    ("register_captcha_apply", case_register_captcha_apply, True),
+]
+
+
+def run_case(client, counter, fixture, case, iterations, warmup):
+    """回傳 {n, p50_ms, p95_ms, p99_ms, mean_ms, queries, errors}"""
+    for _ in range(warmup):
+        method, path, kwargs = case(fixture)
+        client.open(path, method=method, **kwargs)
+
+    latencies = []
+    queries = []
+    errors = 0
+    for _ in range(iterations):
+        method, path, kwargs = case(fixture)
+        before = counter.count
+        start = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        latencies.append((time.perf_counter() - start) * 1000)
+        queries.append(counter.count - before)
+        if response.status_code >= 400:
+            errors += 1
+
+    latencies = np.asarray(latencies)
+    return {
+        "n": iterations,
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "mean_ms": round(float(latencies.mean()), 3),
+        # 同一端點不同輸入走的分支可能不同，取平均並保留最大值
+        "queries": round(float(np.mean(queries)), 2),
+        "max_queries": int(max(queries)),
+        "errors": errors,
+    }
+
+
+def print_results(results):
+    print(f"{'endpoint':<26}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}{'errors':>8}")
+    for name, r in results.items():
+        print(f"{name:<26}{r['n']:>6}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+              f"{r['queries']:>9.2f}{r['errors']:>8}")
+
+
+def compare(results, baseline, threshold):
+    """與 baseline 比較，回傳退步的項目清單"""
+    regressions = []
+    print(f"\n{'endpoint':<26}{'p95 base':>10}{'p95 now':>10}{'change':>9}{'q base':>8}{'q now':>8}")
+    for name, r in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            print(f"{name:<26}{'(new)':>10}")
+            continue
+        change = (r["p95_ms"] - base["p95_ms"]) / base["p95_ms"] if base["p95_ms"] else 0.0
+        flags = []
+        if change > threshold:
+            flags.append("p95")
+        if r["max_queries"] > base["max_queries"]:
+            flags.append("queries")
+        if r["errors"] > base["errors"]:
+            flags.append("errors")
+        print(f"{name:<26}{base['p95_ms']:>10.2f}{r['p95_ms']:>10.2f}{change:>+9.0%}"
+              f"{base['max_queries']:>8}{r['max_queries']:>8}  {' '.join('!' + f for f in flags)}")
+        if flags:
+            regressions.append((name, flags))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="端點基準測試")
+    parser.add_argument("--seed", action="store_true", help="清空資料表並重新產生資料")
+    parser.add_argument("--departments", type=int, default=3000)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--choices", type=int, default=100000)
+    parser.add_argument("--namelist-size", type=int, default=200)
+    parser.add_argument("--random-seed", type=int, default=0, help="資料與請求的亂數種子")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--slow-iterations", type=int, default=20, help="呼叫外部服務替身的端點的次數")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--ai-ms", type=int, default=800, help="Gemini 替身延遲")
+    parser.add_argument("--vision-ms", type=int, default=300, help="Vision 替身延遲")
+    parser.add_argument("--smtp-ms", type=int, default=200, help="SMTP 替身延遲")
+    parser.add_argument("--only", help="只測指定端點，逗號分隔")
+    parser.add_argument("--save-baseline", help="將結果寫入 JSON")
+    parser.add_argument("--compare", help="與 baseline JSON 比較")
+    parser.add_argument("--threshold", type=float, default=0.2, help="p95 超過 baseline 多少比例視為退步")
+    args = parser.parse_args(argv)
+
+    url = os.getenv("BENCH_DATABASE_URL")
+    if not url:
+        print("[ERROR] 請設定 BENCH_DATABASE_URL（基準測試專用資料庫）")
+        return 2
+
+    app = load_app(url)
+    import migrations
+    migrations.upgrade(app.engine, log=lambda *a: None)
+    if args.seed:
+        bench_seed.seed(app.engine, args.departments, args.users, args.choices,
+                        args.namelist_size, args.random_seed)
+
+    stubs = Stubs(args.ai_ms, args.vision_ms, args.smtp_ms, args.namelist_size).install(app)
+    counter = QueryCounter(app.engine)
+    fixture = Fixture(app.engine, random.Random(args.random_seed))
+    client = app.app.test_client()
+
+    only = set(args.only.split(",")) if args.only else None
+    results = {}
+    try:
+        for name, case, slow in CASES:
+            if only and name not in only:
+                continue
+            iterations = args.slow_iterations if slow else args.iterations
+            results[name] = run_case(client, counter, fixture, case, iterations, args.warmup)
+            print(f"[INFO] {name}: p95 {results[name]['p95_ms']:.2f} ms")
+    finally:
+        stubs.uninstall()
+
+    print()
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+                "params": {k: getattr(args, k) for k in (
+                    "departments", "users", "choices", "namelist_size", "random_seed",
+                    "iterations", "slow_iterations", "ai_ms", "vision_ms", "smtp_ms")},
+                "results": results,
+            }, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"\n[INFO] baseline 已寫入 {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n[FAIL] {len(regressions)} 個端點退步：" + "、".join(n for n, _ in regressions))
+            return 1
+        print("\n[OK] 沒有退步")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,353 @@
+"""截止前尖峰流量的負載產生器
+
+模擬放榜前幾小時的流量：大量使用者登入後反覆查詢 /api/user_department_stats、
+重新送出 /api/submit_choices。以 asyncio + httpx 產生虛擬使用者，依 --stages 逐段增加同時在線人數，
+每段輸出各端點的吞吐量、錯誤率與延遲，並同時取樣連線池（/api/admin/db_pool_stats）
+與資料庫 lock 等待（pg_stat_activity，需 --db-url），用來在真正的尖峰前找出瓶頸。
+
+用法（先以 bench/serve.py 啟動使用替身的伺服器）：
+    python bench/loadgen.py --base-url http://127.0.0.1:8080 --stages 20:30,100:60,300:60 \\
+        --admin-token bench-admin --db-url $BENCH_DATABASE_URL
+
+虛擬使用者以 bench/seed.py 產生的帳號（bench{i}@gmail.com）登入。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import httpx
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed import BENCH_PASSWORD, user_email
+
+DEFAULT_MIX = "user_department_stats=60,get_user_choices=15,submit_choices=15,refresh=8,login=2"
+
+LOCK_SQL = """
+    SELECT
+        count(*) FILTER (WHERE state = 'active') AS active,
+        count(*) FILTER (WHERE wait_event_type = 'Lock') AS lock_waiting,
+        count(*) FILTER (WHERE state = 'idle in transaction') AS idle_in_transaction,
+        coalesce(max(extract(epoch FROM now() - query_start))
+                 FILTER (WHERE wait_event_type = 'Lock'), 0) AS longest_lock_wait
+    FROM pg_stat_activity
+    WHERE datname = current_database() AND pid <> pg_backend_pid()
+"""
+BLOCKED_SQL = """
+    SELECT left(regexp_replace(query, '\\s+', ' ', 'g'), 100) AS query
+    FROM pg_stat_activity
+    WHERE datname = current_database() AND wait_event_type = 'Lock'
+"""
+
+
+def parse_stages(value):
+    """「20:30,100:60」→ [(20, 30.0), (100, 60.0)]（同時在線人數:秒數）"""
+    stages = []
+    for part in value.split(","):
+        users, seconds = part.split(":")
+        stages.append((int(users), float(seconds)))
+    return stages
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        name, weight = part.split("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+class Recorder:
+    """依 (階段, 端點) 記錄延遲與錯誤"""
+
+    def __init__(self):
+        self.stage = 0
+        self.latencies = {}
+        self.errors = {}
+        self.error_samples = {}
+
+    def record(self, endpoint, seconds, error=None):
+        key = (self.stage, endpoint)
+        self.latencies.setdefault(key, []).append(seconds)
+        if error is not None:
+            self.errors[key] = self.errors.get(key, 0) + 1
+            self.error_samples.setdefault(endpoint, {}).setdefault(error, 0)
+            self.error_samples[endpoint][error] += 1
+
+    def stage_results(self, stage, duration):
+        results = {}
+        for (s, endpoint), values in sorted(self.latencies.items()):
+            if s != stage:
+                continue
+            ms = np.asarray(values) * 1000
+            errors = self.errors.get((s, endpoint), 0)
+            results[endpoint] = {
+                "requests": len(values),
+                "rps": round(len(values) / duration, 2),
+                "errors": errors,
+                "error_rate": round(errors / len(values), 4),
+                "p50_ms": round(float(np.percentile(ms, 50)), 1),
+                "p95_ms": round(float(np.percentile(ms, 95)), 1),
+                "p99_ms": round(float(np.percentile(ms, 99)), 1),
+            }
+        return results
+
+
+class ResourceSampler:
+    """定期取樣連線池與 lock 等待，依階段彙整"""
+
+    def __init__(self, client, admin_token, db_url):
+        self.client = client
+        self.admin_token = admin_token
+        self.engine = None
+        if db_url:
+            from sqlalchemy import create_engine
+            self.engine = create_engine(db_url, pool_size=1, max_overflow=0)
+        self.samples = {}
+        self.blocked = {}
+
+    async def sample(self, stage):
+        row = {}
+        if self.admin_token:
+            try:
+                r = await self.client.get("/api/admin/db_pool_stats", headers={"X-Admin-Token": self.admin_token})
+                if r.status_code == 200:
+                    row["pool"] = r.json()["primary"]
+            except httpx.HTTPError:
+                pass
+        if self.engine is not None:
+            row.update(await asyncio.to_thread(self._query_locks))
+        self.samples.setdefault(stage, []).append(row)
+
+    def _query_locks(self):
+        from sqlalchemy import text
+        with self.engine.connect() as conn:
+            locks = dict(conn.execute(text(LOCK_SQL)).mappings().fetchone())
+            for (query,) in conn.execute(text(BLOCKED_SQL)).fetchall():
+                self.blocked[query] = self.blocked.get(query, 0) + 1
+        return {"locks": {k: float(v) for k, v in locks.items()}}
+
+    def stage_summary(self, stage):
+        samples = self.samples.get(stage, [])
+        summary = {}
+        pools = [s["pool"] for s in samples if "pool" in s]
+        if pools:
+            first, last = pools[0], pools[-1]
+            checkouts = last.get("checkouts", 0) - first.get("checkouts", 0)
+            wait_total = last.get("avg_wait_ms", 0) * last.get("checkouts", 0) - \
+                first.get("avg_wait_ms", 0) * first.get("checkouts", 0)
+            summary["pool"] = {
+                "size": last.get("size"),
+                "max_checked_out": max(p.get("checked_out", 0) for p in pools),
+                "max_overflow": max(p.get("overflow", 0) for p in pools),
+                "checkouts": checkouts,
+                "avg_wait_ms": round(wait_total / checkouts, 3) if checkouts > 0 else 0.0,
+                "failed_checkouts": last.get("failed_checkouts", 0) - first.get("failed_checkouts", 0),
+            }
+        locks = [s["locks"] for s in samples if "locks" in s]
+        if locks:
+            summary["locks"] = {
+                "max_active": int(max(l["active"] for l in locks)),
+                "max_lock_waiting": int(max(l["lock_waiting"] for l in locks)),
+                "max_idle_in_transaction": int(max(l["idle_in_transaction"] for l in locks)),
+                "longest_lock_wait_s": round(max(l["longest_lock_wait"] for l in locks), 3),
+            }
+        return summary
+
+
+class VirtualUser:
+    def __init__(self, index, client, recorder, departments, mix, think_seconds, rng):
+        self.email = user_email(index)
+        self.client = client
+        self.recorder = recorder
+        self.departments = departments
+        self.actions = list(mix)
+        self.weights = [mix[a] for a in self.actions]
+        self.think_seconds = think_seconds
+        self.rng = rng
+        self.headers = None
+        self.refresh_token = None
+        self.choices = rng.sample(departments, min(5, len(departments)))
+
+    async def _request(self, endpoint, method, path, **kwargs):
+        start = time.perf_counter()
+        error = None
+        response = None
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            if response.status_code >= 400:
+                error = f"HTTP {response.status_code}"
+        except httpx.HTTPError as e:
+            error = type(e).__name__
+        self.recorder.record(endpoint, time.perf_counter() - start, error)
+        return response if error is None else None
+
+    async def login(self):
+        response = await self._request("login", "POST", "/api/login",
+                                       json={"email": self.email, "password": BENCH_PASSWORD})
+        if response is not None:
+            self.headers = {"Authorization": "Bearer " + response.json()["token"]}
+            self.refresh_token = response.json().get("refresh_token")
+
+    async def refresh(self):
+        response = await self._request("refresh", "POST", "/api/refresh",
+                                       json={"refresh_token": self.refresh_token})
+        if response is not None:
+            self.headers = {"Authorization": "Bearer " + response.json()["token"]}
+            self.refresh_token = response.json()["refresh_token"]
+
+    async def step(self, action):
+        if action == "login" or self.headers is None:
+            await self.login()
+        elif action == "refresh":
+            if self.refresh_token is None:
+                await self.login()
+            else:
+                await self.refresh()
+        elif action == "user_department_stats":
+            school, department, degree = self.rng.choice(self.choices)
+            await self._request(action, "GET", "/api/user_department_stats", headers=self.headers,
+                                params={"school": school, "department": department, "degree": degree})
+        elif action == "get_user_choices":
+            await self._request(action, "GET", "/api/get_user_choices", headers=self.headers)
+        elif action == "submit_choices":
+            # 重新送出：換掉一個志願並打亂順序
+            self.choices[self.rng.randrange(len(self.choices))] = self.rng.choice(self.departments)
+            self.choices = list(dict.fromkeys(self.choices))
+            self.rng.shuffle(self.choices)
+            await self._request(action, "POST", "/api/submit_choices", headers=self.headers, json={
+                "choices": [{"selection": f"{s}/{d}", "degree": g} for s, d, g in self.choices]})
+        elif action == "user_filled_departments":
+            await self._request(action, "GET", "/api/user_filled_departments", headers=self.headers)
+
+    async def run(self):
+        await self.login()
+        while True:
+            await asyncio.sleep(self.rng.expovariate(1 / self.think_seconds) if self.think_seconds else 0)
+            await self.step(self.rng.choices(self.actions, self.weights)[0])
+
+
+async def load_departments(client, email):
+    """以第一個帳號登入，取熱門系所作為虛擬使用者的志願（尖峰時流量集中在熱門系所）"""
+    r = await client.post("/api/login", json={"email": email, "password": BENCH_PASSWORD})
+    r.raise_for_status()
+    headers = {"Authorization": "Bearer " + r.json()["token"]}
+    r = await client.get("/api/department_rankings", headers=headers, params={"limit": 100})
+    r.raise_for_status()
+    return [(d["school"], d["department"], d["degree"]) for d in r.json()["rankings"]]
+
+
+def bottleneck_hints(stage_summary, results):
+    hints = []
+    pool = stage_summary.get("pool")
+    if pool:
+        if pool["failed_checkouts"]:
+            hints.append(f"連線池等待逾時 {pool['failed_checkouts']} 次：pool 已飽和")
+        elif pool["avg_wait_ms"] > 10:
+            hints.append(f"平均等待連線 {pool['avg_wait_ms']} ms：pool 接近飽和")
+    locks = stage_summary.get("locks")
+    if locks and locks["max_lock_waiting"]:
+        hints.append(f"最多 {locks['max_lock_waiting']} 個連線在等 lock（最長 {locks['longest_lock_wait_s']}s）")
+    if locks and locks["max_idle_in_transaction"]:
+        hints.append(f"有 {locks['max_idle_in_transaction']} 個交易開著但閒置：交易內有外部呼叫或計算")
+    errors = {k: v["error_rate"] for k, v in results.items() if v["error_rate"] > 0.01}
+    if errors:
+        hints.append("錯誤率超過 1%：" + "、".join(f"{k} {v:.1%}" for k, v in errors.items()))
+    return hints
+
+
+def print_stage(stage, users, duration, results, summary, hints):
+    print(f"\n=== 階段 {stage + 1}：{users} 位同時在線，{duration:.0f}s ===")
+    print(f"{'endpoint':<24}{'requests':>9}{'rps':>9}{'err%':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, r in results.items():
+        print(f"{name:<24}{r['requests']:>9}{r['rps']:>9.1f}{r['error_rate']:>8.1%}"
+              f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}")
+    pool = summary.get("pool")
+    if pool:
+        print(f"連線池：最多借出 {pool['max_checked_out']}/{pool['size']}（overflow {pool['max_overflow']}），"
+              f"平均等待 {pool['avg_wait_ms']} ms，逾時 {pool['failed_checkouts']}")
+    locks = summary.get("locks")
+    if locks:
+        print(f"資料庫：最多 {locks['max_active']} 個執行中，{locks['max_lock_waiting']} 個等 lock，"
+              f"{locks['max_idle_in_transaction']} 個 idle in transaction")
+    for hint in hints:
+        print(f"[HINT] {hint}")
+
+
+async def run(args):
+    stages = parse_stages(args.stages)
+    mix = parse_mix(args.mix)
+    rng = random.Random(args.random_seed)
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=max(u for u, _ in stages) + 5, max_keepalive_connections=None)
+
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        departments = await load_departments(client, user_email(1))
+        sampler = ResourceSampler(client, args.admin_token, args.db_url)
+        tasks = []
+        report = []
+        for stage, (users, duration) in enumerate(stages):
+            recorder.stage = stage
+            while len(tasks) < users:
+                vu = VirtualUser(len(tasks) % args.users + 1, client, recorder, departments, mix,
+                                 args.think_ms / 1000, random.Random(rng.random()))
+                tasks.append(asyncio.create_task(vu.run()))
+            while len(tasks) > users:
+                tasks.pop().cancel()
+
+            start = time.perf_counter()
+            while time.perf_counter() - start < duration:
+                await sampler.sample(stage)
+                await asyncio.sleep(min(args.sample_seconds, max(0.0, duration - (time.perf_counter() - start))))
+            elapsed = time.perf_counter() - start
+
+            results = recorder.stage_results(stage, elapsed)
+            summary = sampler.stage_summary(stage)
+            hints = bottleneck_hints(summary, results)
+            print_stage(stage, users, elapsed, results, summary, hints)
+            report.append({"users": users, "seconds": round(elapsed, 1), "endpoints": results,
+                           "resources": summary, "hints": hints})
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if recorder.error_samples:
+        print("\n錯誤類型：")
+        for endpoint, errors in recorder.error_samples.items():
+            print(f"  {endpoint}: " + "、".join(f"{e} ×{n}" for e, n in errors.items()))
+    if sampler.blocked:
+        print("\n等待 lock 的查詢（取樣次數）：")
+        for query, n in sorted(sampler.blocked.items(), key=lambda item: -item[1])[:5]:
+            print(f"  {n:>5}  {query}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"stages": report, "mix": mix, "think_ms": args.think_ms}, f, ensure_ascii=False, indent=2)
+        print(f"\n[INFO] 結果已寫入 {args.output}")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="截止前尖峰流量的負載產生器")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8080")
+    parser.add_argument("--stages", default="20:30,100:60,300:60", help="同時在線人數:秒數，逗號分隔")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="各動作的權重")
+    parser.add_argument("--think-ms", type=float, default=500, help="每位使用者兩次請求之間的平均間隔")
+    parser.add_argument("--users", type=int, default=2000, help="輪流使用的帳號數（bench1..N）")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--sample-seconds", type=float, default=1.0, help="資源取樣間隔")
+    parser.add_argument("--admin-token", default=os.getenv("ADMIN_TOKEN"), help="取樣連線池用")
+    parser.add_argument("--db-url", default=os.getenv("BENCH_DATABASE_URL"), help="取樣 lock 等待用")
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--output", help="將結果寫入 JSON")
+    args = parser.parse_args(argv)
+    asyncio.run(run(args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+"""以基準測試設定啟動 app（資料庫為 BENCH_DATABASE_URL，Gemini / Vision / SMTP 為替身）
+
+用法：
+    export BENCH_DATABASE_URL=postgresql://postgres@localhost:5432/graduatedfriends_bench
+    python bench/serve.py --port 8080                              # werkzeug 多執行緒伺服器
+    gunicorn --chdir bench --bind 127.0.0.1:8080 serve:app         # 與正式環境相同的 gunicorn 設定
+
+替身延遲以環境變數 BENCH_AI_MS / BENCH_VISION_MS / BENCH_SMTP_MS 設定（毫秒）。
+資料請先以 python bench/bench_endpoints.py --seed --only schools 產生。
+"""
+import argparse
+import os
+import sys
+
+from bench_endpoints import ADMIN_TOKEN, load_app
+from stubs import Stubs
+
+url = os.getenv("BENCH_DATABASE_URL")
+if not url:
+    sys.exit("[ERROR] 請設定 BENCH_DATABASE_URL（基準測試專用資料庫）")
+
+app_module = load_app(url)
+stubs = Stubs(
+    ai_ms=int(os.getenv("BENCH_AI_MS", "800")),
+    vision_ms=int(os.getenv("BENCH_VISION_MS", "300")),
+    smtp_ms=int(os.getenv("BENCH_SMTP_MS", "200")),
+).install(app_module)
+app = app_module.app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="以替身啟動基準測試用的 app")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args(argv)
+    print(f"[INFO] admin token: {ADMIN_TOKEN}")
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""基準測試用的外部服務替身（Gemini / Vision / SMTP）
+
+替身不連網路：輸出只由輸入決定（同樣的 school_dep 永遠得到同樣的名單），
+延遲固定為設定的毫秒數（以 sleep 模擬等待外部服務），讓每次跑出來的數字可以互相比較。
+"""
+import hashlib
+import time
+
+import googleAI
+import utils
+from seed import make_name, mask_name
+
+
+class Stubs:
+    def __init__(self, ai_ms=800, vision_ms=300, smtp_ms=200, namelist_size=200):
+        self.ai_seconds = ai_ms / 1000
+        self.vision_seconds = vision_ms / 1000
+        self.smtp_seconds = smtp_ms / 1000
+        self.namelist_size = namelist_size
+        self.calls = {}
+        self._originals = []
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _names(self, school_dep):
+        """依 school_dep 產生固定的名單（約三成遮蔽）"""
+        base = int(hashlib.sha256(school_dep.encode("utf-8")).hexdigest()[:8], 16)
+        names = [make_name(base + i * 7919) for i in range(self.namelist_size)]
+        return [mask_name(n) if i % 3 == 0 else n for i, n in enumerate(names)]
+
+    # ---------- 替身 ----------
+    def parse_namelist_from_file(self, file_bytes, school_dep):
+        self._count("parse_namelist_from_file")
+        time.sleep(self.ai_seconds)
+        return {"success": True, "names": self._names(school_dep), "has_names": True}
+
+    def parse_namelist_from_url(self, url, school_dep):
+        self._count("parse_namelist_from_url")
+        time.sleep(self.ai_seconds)
+        return {"success": True, "names": self._names(school_dep), "has_names": True}
+
+    def read_student_id(self, image_path):
+        self._count("read_student_id")
+        time.sleep(self.vision_seconds)
+        return "國立臺北第1大學\n電機工程學系\n姓名 陳宜庭\n學號 R12345678"
+
+    def parse_ocr_with_google_ai(self, ocr_text):
+        self._count("parse_ocr_with_google_ai")
+        time.sleep(self.ai_seconds)
+        lines = ocr_text.splitlines()
+        return {"school": lines[0], "department": lines[1], "name": lines[2].replace("姓名", "").strip()}
+
+    def send_mail(self, email_address, mail_type, necessary_content):
+        self._count("send_mail")
+        time.sleep(self.smtp_seconds)
+        return True
+
+    # ---------- 安裝 / 還原 ----------
+    def _patch(self, module, name, replacement):
+        self._originals.append((module, name, getattr(module, name)))
+        setattr(module, name, replacement)
+
+    def install(self, app_module):
+        """替換 googleAI / utils 的外部呼叫；app.py 以 from utils import send_mail 匯入，需另外替換"""
+        for name in ("parse_namelist_from_file", "parse_namelist_from_url",
+                     "read_student_id", "parse_ocr_with_google_ai"):
+            self._patch(googleAI, name, getattr(self, name))
+        self._patch(utils, "send_mail", self.send_mail)
+        self._patch(app_module, "send_mail", self.send_mail)
+        return self
+
+    def uninstall(self):
+        while self._originals:
+            module, name, original = self._originals.pop()
+            setattr(module, name, original)
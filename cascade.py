@@ -0,0 +1,270 @@
+"""錄取流向（志願遞補）模擬
+
+以 NumPy 陣列模擬「每位被錄取的使用者只會接受自己志願序最前面的錄取系所」：
+  1. admitted[u, k]：使用者 u 的第 k+1 志願是否已錄取（正取名單比對成功；
+     該系所沒有可比對的姓名名單時，視為使用者自填的錄取）
+  2. 每一輪找出每位使用者接受的系所，其他錄取的系所即為放棄（釋出名額）
+  3. 釋出的名額依序遞補給該系所的候補者（有填該系所但不在正取名單內的使用者，
+     依其志願序、user_id 排序），被遞補者可能因此放棄其他系所，再進入下一輪
+  4. 直到沒有新的遞補為止
+
+每個系所輸出：正取名額、平台上錄取人數、預估最終報到人數、釋出名額（預估缺額）
+以及平台上被遞補的人數（候補移動）。
+
+新的志願送出時只需重跑與該使用者相連的系所：以「使用者—系所」二部圖找出相連元件，
+元件內的使用者與系所和其他部分完全獨立，因此結果與全量重跑相同。
+
+過期後由一個執行緒重新載入（見 reloader.py），載入期間送出的志願與名單先記下來，
+新的資料換上後再套用一次，不會因為重新載入而遺失。
+"""
+import threading
+import time
+import numpy as np
+from sqlalchemy import text
+import namelists
+from choice_matrix import load_choice_matrix
+from reloader import Reloader
+
+
+class CascadeSimulator:
+    def __init__(self, max_age=600):
+        self.max_age = max_age
+        self.matrix = None
+        self.loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._reloader = Reloader()
+        # 載入中時為 list，收集期間的增量更新，載入完成後重新套用
+        self._pending = None
+        self._matchers = {}
+        self._seats = {}
+        self._reset_results()
+
+    def _reset_results(self):
+        self.admitted = None
+        self.accepted = np.zeros(0, dtype=np.int64)
+        self.initial_admitted = np.zeros(0, dtype=np.int64)
+        self.vacancies = np.zeros(0, dtype=np.int64)
+        self.promoted = np.zeros(0, dtype=np.int64)
+        self.applicants = np.zeros(0, dtype=np.int64)
+        self.rounds = 0
+        self.last_run_seconds = 0.0
+
+    # ---------- 載入 ----------
+    def is_stale(self):
+        return self.matrix is None or time.monotonic() - self.loaded_at > self.max_age
+
+    def load(self, conn):
+        """從資料庫載入志願與名單並完整跑一次模擬"""
+        with self._lock:
+            self._pending = []
+        try:
+            self._load(conn)
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def _load(self, conn):
+        matrix = load_choice_matrix(conn)
+        matchers = {}
+        seats = {}
+        for school, department, namelist_raw in conn.execute(text("""
+            SELECT school, dep_name, namelist
+            FROM schools
+            WHERE namelist IS NOT NULL AND namelist <> ''
+        """)).fetchall():
+            for degree, degree_data in namelists.parse_namelist_column(namelist_raw).items():
+                if degree is None:
+                    continue
+                names = namelists.split_names(degree_data["names"])
+                seats[(school, department, degree)] = len(names)
+                if degree_data["has_names"] and names:
+                    matchers[(school, department, degree)] = namelists.NameMatcher(names)
+
+        with self._lock:
+            self.matrix = matrix
+            self._matchers = matchers
+            self._seats = seats
+            self._reset_results()
+            self.admitted = self._admitted_rows(np.arange(len(matrix.user_ids)))
+            self._grow()
+            self._run(np.arange(len(matrix.user_ids)), np.ones(matrix.n_departments, dtype=bool))
+            # 載入期間的更新可能不在剛讀到的資料中；兩種更新都是「設定為新值」，重複套用結果相同
+            pending, self._pending = self._pending, None
+            for apply, args in pending:
+                apply(*args)
+            self.loaded_at = time.monotonic()
+
+    def ensure_loaded(self, connect):
+        """過期時重新載入；connect() 回傳資料庫連線的 context manager"""
+        self._reloader.ensure(self.is_stale, lambda: self.matrix is not None, self.load, connect)
+
+    def _admitted_rows(self, rows):
+        """計算指定使用者列的 admitted 矩陣（名單比對只在這裡做一次）"""
+        m = self.matrix
+        ranks = m.ranks[rows]
+        admitted = ranks >= 0
+        for i, u in enumerate(rows):
+            name = m.user_names[u]
+            for k in np.flatnonzero(ranks[i] >= 0):
+                matcher = self._matchers.get(m.keys[ranks[i, k]])
+                if matcher is not None and matcher.match(name) is None:
+                    admitted[i, k] = False
+        return admitted
+
+    def _grow(self):
+        """系所數增加時擴充結果陣列"""
+        n = self.matrix.n_departments
+        for attr in ("accepted", "initial_admitted", "vacancies", "promoted", "applicants"):
+            arr = getattr(self, attr)
+            if len(arr) < n:
+                setattr(self, attr, np.concatenate([arr, np.zeros(n - len(arr), dtype=np.int64)]))
+        if self.admitted.shape[1] < self.matrix.ranks.shape[1]:
+            pad = np.zeros((self.admitted.shape[0], self.matrix.ranks.shape[1] - self.admitted.shape[1]), dtype=bool)
+            self.admitted = np.hstack([self.admitted, pad])
+
+    # ---------- 模擬 ----------
+    def _run(self, rows, dept_mask):
+        """對指定的使用者列模擬遞補，並覆寫 dept_mask 內系所的結果"""
+        start = time.perf_counter()
+        m = self.matrix
+        n = m.n_departments
+        ranks = m.ranks[rows]
+        valid = ranks >= 0
+        dept = np.where(valid, ranks, 0)
+        adm = self.admitted[rows].copy()
+        waitlist = valid & ~adm
+        user_order = m.user_ids[rows]
+
+        if adm.size == 0:
+            for attr in ("accepted", "initial_admitted", "vacancies", "promoted", "applicants"):
+                getattr(self, attr)[dept_mask] = 0
+            self.rounds = 0
+            return
+
+        initial = np.bincount(dept[adm], minlength=n)
+        applicants = np.bincount(dept[valid], minlength=n)
+        promoted = np.zeros(n, dtype=np.int64)
+        rounds = 0
+        while True:
+            rounds += 1
+            has_any = adm.any(axis=1)
+            best = np.argmax(adm, axis=1)
+            accepted_mask = np.zeros_like(adm)
+            accepted_mask[np.flatnonzero(has_any), best[has_any]] = True
+            declined = adm & ~accepted_mask
+            vacancies = np.bincount(dept[declined], minlength=n)
+
+            open_seats = vacancies - promoted
+            candidates = waitlist & ~adm
+            if not (open_seats > 0).any() or not candidates.any():
+                break
+
+            ui, ki = np.nonzero(candidates)
+            cand_dept = dept[ui, ki]
+            # 同系所內依候補者的志願序、user_id 排序
+            order = np.lexsort((user_order[ui], ki, cand_dept))
+            ui, ki, cand_dept = ui[order], ki[order], cand_dept[order]
+            group_start = np.searchsorted(cand_dept, cand_dept, side="left")
+            position = np.arange(len(cand_dept)) - group_start
+            take = position < open_seats[cand_dept]
+            if not take.any():
+                break
+            adm[ui[take], ki[take]] = True
+            promoted += np.bincount(cand_dept[take], minlength=n)
+
+        accepted = np.bincount(dept[accepted_mask], minlength=n)
+        for attr, values in (("accepted", accepted), ("initial_admitted", initial),
+                             ("vacancies", vacancies), ("promoted", promoted),
+                             ("applicants", applicants)):
+            getattr(self, attr)[dept_mask] = values[dept_mask]
+        self.rounds = rounds
+        self.last_run_seconds = time.perf_counter() - start
+
+    def _component(self, dept_ids):
+        """找出與 dept_ids 相連的所有系所與使用者（使用者—系所二部圖的相連元件）"""
+        ranks = self.matrix.ranks
+        valid = ranks >= 0
+        depts = np.zeros(self.matrix.n_departments, dtype=bool)
+        depts[list(dept_ids)] = True
+        while True:
+            users = (valid & depts[np.where(valid, ranks, 0)]).any(axis=1)
+            reached = np.zeros_like(depts)
+            reached[ranks[users][valid[users]]] = True
+            if not (reached & ~depts).any():
+                return np.flatnonzero(users), depts
+            depts |= reached
+
+    def _rerun_departments(self, dept_ids):
+        rows, dept_mask = self._component(dept_ids)
+        self._run(rows, dept_mask)
+
+    # ---------- 增量更新 ----------
+    def update_user(self, user_id, user_name, keys):
+        """使用者送出新志願後只重跑受影響的系所；尚未載入時略過"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((self._update_user, (user_id, user_name, keys)))
+            if self.matrix is not None:
+                self._update_user(user_id, user_name, keys)
+
+    def _update_user(self, user_id, user_name, keys):
+        m = self.matrix
+        row = m.user_index.get(user_id)
+        affected = set()
+        if row is not None:
+            affected.update(int(d) for d in m.ranks[row] if d >= 0)
+        row = m.set_user_choices(user_id, user_name, keys)
+        affected.update(int(d) for d in m.ranks[row] if d >= 0)
+
+        if row >= self.admitted.shape[0]:
+            self.admitted = np.vstack([self.admitted, np.zeros((1, self.admitted.shape[1]), dtype=bool)])
+        self._grow()
+        self.admitted[row] = self._admitted_rows(np.array([row]))[0]
+        if affected:
+            self._rerun_departments(affected)
+
+    def update_namelist(self, key, names, has_names):
+        """名單上傳後更新該系所的正取比對並重跑受影響的系所；尚未載入時略過"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((self._update_namelist, (key, names, has_names)))
+            if self.matrix is not None:
+                self._update_namelist(key, names, has_names)
+
+    def _update_namelist(self, key, names, has_names):
+        self._seats[key] = len(names)
+        if has_names and names:
+            self._matchers[key] = namelists.NameMatcher(names)
+        else:
+            self._matchers.pop(key, None)
+        dept = self.matrix.key_index.get(key)
+        if dept is None:
+            return
+        rows = np.flatnonzero((self.matrix.ranks == dept).any(axis=1))
+        self.admitted[rows] = self._admitted_rows(rows)
+        self._rerun_departments([dept])
+
+    # ---------- 查詢 ----------
+    def department_result(self, key):
+        """回傳單一系所的模擬結果，該系所沒有任何人填寫時回傳 None"""
+        with self._lock:
+            dept = self.matrix.key_index.get(key) if self.matrix else None
+            if dept is None or dept >= len(self.applicants):
+                return None
+            return {
+                "seats": self._seats.get(key),
+                "applicants": int(self.applicants[dept]),
+                "admitted": int(self.initial_admitted[dept]),
+                "projected_accepted": int(self.accepted[dept]),
+                "projected_vacancies": int(self.vacancies[dept]),
+                "waitlist_promoted": int(self.promoted[dept]),
+            }
+
+    def summary(self):
+        with self._lock:
+            return {
+                "users": 0 if self.matrix is None else len(self.matrix.user_ids),
+                "departments": 0 if self.matrix is None else self.matrix.n_departments,
+                "rounds": self.rounds,
+                "last_run_ms": round(self.last_run_seconds * 1000, 2),
+            }
@@ -0,0 +1,89 @@
+"""學校 → 系所 → 學制的完整目錄（/api/bootstrap 用）
+
+一次查詢 schools 表，整理成精簡格式並預先序列化：
+
+    {
+        "version": "3f2a9c0d1b7e4a56",
+        "degrees": ["碩士班", "博士班"],
+        "schools": [["國立臺灣大學", [["電機工程學系", [0, 1]], ["資訊工程學系", [0]]]], ...]
+    }
+
+學制以 degrees 的索引表示，避免同樣的字串重複數千次。version 為內容雜湊，
+前端帶上次拿到的 version 時可以省略整份目錄。
+記憶體內每個 worker 一份，超過 max_age 秒或呼叫 invalidate() 後重新從資料庫載入；
+同一時間只有一個執行緒載入，其他請求沿用目前的目錄（見 reloader.py）。
+"""
+import hashlib
+import threading
+import time
+
+import ujson
+from sqlalchemy import text
+
+from reloader import Reloader
+
+
+def build_compact(rows):
+    """rows 為依 (school, dep_name) 排序的 (school, dep_name, degree 欄位)，回傳精簡格式（不含 version）"""
+    degree_index = {}
+    schools = []
+    current = None
+    for school, department, degree_raw in rows:
+        if current is None or current[0] != school:
+            current = [school, []]
+            schools.append(current)
+        degrees = []
+        for degree in (degree_raw or "").split(","):
+            degree = degree.strip()
+            if degree:
+                degrees.append(degree_index.setdefault(degree, len(degree_index)))
+        current[1].append([department, degrees])
+    return {"degrees": list(degree_index), "schools": schools}
+
+
+class Catalog:
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.loaded = False
+        self.loaded_at = 0.0
+        self.version = None
+        self.encoded = None
+        self._lock = threading.Lock()
+        self._reloader = Reloader()
+        # invalidate() 的次數：載入途中被 invalidate 時，載入完成後仍視為過期
+        self._generation = 0
+
+    def is_stale(self):
+        return not self.loaded or time.monotonic() - self.loaded_at > self.max_age
+
+    def ensure_loaded(self, connect):
+        """過期時重新載入；connect() 回傳資料庫連線的 context manager"""
+        self._reloader.ensure(self.is_stale, lambda: self.encoded is not None, self.load, connect)
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self.loaded = False
+
+    def load(self, conn):
+        generation = self._generation
+        rows = conn.execute(text("""
+            SELECT school, dep_name, degree
+            FROM schools
+            WHERE retired_at IS NULL
+            ORDER BY school, dep_name
+        """)).fetchall()
+        compact = build_compact(rows)
+        body = ujson.dumps(compact, ensure_ascii=False, escape_forward_slashes=False)
+        version = hashlib.sha1(body.encode("utf-8")).hexdigest()[:16]
+        encoded = '{"version":"%s",%s' % (version, body[1:])
+        with self._lock:
+            self.version = version
+            self.encoded = encoded
+            self.loaded = self._generation == generation
+            self.loaded_at = time.monotonic()
+
+    def snapshot(self):
+        """回傳 (version, 序列化後的 JSON 字串)"""
+        with self._lock:
+            return self.version, self.encoded
@@ -0,0 +1,253 @@
+"""學校 / 系所搜尋與自動完成（記憶體內索引）
+
+每個學校名稱與系所名稱正規化（NFKC、台→臺、去掉空白標點）後建立：
+  - 單字 postings：字 → 含有該字的名稱
+  - 雙字 postings：相鄰兩字 → 含有該兩字的名稱（子字串查詢先以此縮小候選）
+  - prefix trie：輸入前幾個字即可找到以此開頭的名稱
+
+查詢以空白切成多個詞，每個詞要符合學校或系所名稱，依符合程度計分：
+  完全相同 4 / 開頭 3 / 子字串 2 / 依序出現（縮寫，例如「台大」→ 國立臺灣大學、「資工」→ 資訊工程學系）1~1.5
+所有詞的分數加總後取前 limit 名，同分時名稱較短者優先。
+
+索引只在名稱新增或刪除時更新對應的 postings（sync 比對差異），不會整份重建；
+每個 worker 一份，超過 max_age 秒或 invalidate() 後下一次查詢時與資料庫同步；
+同一時間只有一個執行緒同步，其他查詢使用目前的索引（見 reloader.py）。
+"""
+import re
+import threading
+import time
+import unicodedata
+
+import numpy as np
+from sqlalchemy import text
+
+from reloader import Reloader
+
+EXACT, PREFIX, SUBSTRING, SUBSEQUENCE = 4, 3, 2, 1
+
+# 常見異體字，正規化成資料庫中使用的字
+_VARIANTS = str.maketrans({"台": "臺"})
+_STRIP = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize(value):
+    return _STRIP.sub("", unicodedata.normalize("NFKC", value or "").translate(_VARIANTS).lower())
+
+
+def _subsequence_span(term, name):
+    """term 的字依序出現在 name 中時，回傳最短的涵蓋長度，否則回傳 None"""
+    best = None
+    for start, c in enumerate(name):
+        if c != term[0]:
+            continue
+        pos = start
+        for t in term[1:]:
+            pos = name.find(t, pos + 1)
+            if pos < 0:
+                return best
+        span = pos - start + 1
+        if best is None or span < best:
+            best = span
+    return best
+
+
+class _TrieNode:
+    __slots__ = ("children", "ids")
+
+    def __init__(self):
+        self.children = {}
+        self.ids = set()
+
+
+class CatalogIndex:
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.loaded = False
+        self.loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._reloader = Reloader()
+        # invalidate() 的次數：同步途中被 invalidate 時，同步完成後仍視為過期
+        self._generation = 0
+        # 名稱表：id → 正規化後的名稱；同一個名稱（例如「電機工程學系」）只存一份，以參照數管理
+        self._names = {}
+        self._name_ids = {}
+        self._refs = {}
+        self._next_id = 0
+        self._unigrams = {}
+        self._bigrams = {}
+        self._trie = _TrieNode()
+        # 系所：(school, department) → (學校名稱 id, 系所名稱 id, degrees)
+        self._entries = {}
+        # 查詢用的陣列（sync 有變動時重建）：第 i 個系所的學校 / 系所名稱 id 與名稱長度
+        self._keys = []
+        self._school_ids = np.zeros(0, dtype=np.int64)
+        self._department_ids = np.zeros(0, dtype=np.int64)
+        self._lengths = np.zeros(0, dtype=np.int64)
+
+    # ---------- 維護 ----------
+    def is_stale(self):
+        return not self.loaded or time.monotonic() - self.loaded_at > self.max_age
+
+    def ensure_loaded(self, connect):
+        """過期時與資料庫同步；connect() 回傳資料庫連線的 context manager"""
+        self._reloader.ensure(self.is_stale, lambda: self.loaded, self.load, connect)
+
+    def invalidate(self):
+        """下一次查詢時與資料庫同步（只更新有變動的系所）"""
+        with self._lock:
+            self._generation += 1
+            self.loaded_at = 0.0
+
+    def load(self, conn):
+        generation = self._generation
+        rows = conn.execute(text("SELECT school, dep_name, degree FROM schools WHERE retired_at IS NULL")).fetchall()
+        self.sync((school, department, degree) for school, department, degree in rows)
+        with self._lock:
+            if self._generation != generation:
+                # 讀取之後又有變動，這次讀到的可能不是最新的
+                self.loaded_at = 0.0
+
+    def sync(self, rows):
+        """rows 為 (school, department, degree 欄位)，回傳 (新增, 刪除) 的系所數"""
+        wanted = {}
+        for school, department, degree_raw in rows:
+            wanted[(school, department)] = [d.strip() for d in (degree_raw or "").split(",") if d.strip()]
+        with self._lock:
+            removed = [key for key in self._entries if key not in wanted]
+            for key in removed:
+                self._remove_entry(key)
+            added = 0
+            for key, degrees in wanted.items():
+                if key in self._entries:
+                    self._entries[key] = self._entries[key][:2] + (degrees,)
+                else:
+                    self._add_entry(key, degrees)
+                    added += 1
+            if added or removed:
+                self._rebuild_arrays()
+            self.loaded = True
+            self.loaded_at = time.monotonic()
+        return added, len(removed)
+
+    def _acquire_name(self, value):
+        name = normalize(value)
+        name_id = self._name_ids.get(name)
+        if name_id is not None:
+            self._refs[name_id] += 1
+            return name_id
+        name_id = self._next_id
+        self._next_id += 1
+        self._names[name_id] = name
+        self._name_ids[name] = name_id
+        self._refs[name_id] = 1
+        for c in set(name):
+            self._unigrams.setdefault(c, set()).add(name_id)
+        for gram in {name[i:i + 2] for i in range(len(name) - 1)}:
+            self._bigrams.setdefault(gram, set()).add(name_id)
+        node = self._trie
+        for c in name:
+            node = node.children.setdefault(c, _TrieNode())
+            node.ids.add(name_id)
+        return name_id
+
+    def _release_name(self, name_id):
+        self._refs[name_id] -= 1
+        if self._refs[name_id]:
+            return
+        name = self._names.pop(name_id)
+        del self._name_ids[name], self._refs[name_id]
+        for postings, keys in ((self._unigrams, set(name)),
+                               (self._bigrams, {name[i:i + 2] for i in range(len(name) - 1)})):
+            for key in keys:
+                postings[key].discard(name_id)
+                if not postings[key]:
+                    del postings[key]
+        path = [self._trie]
+        for c in name:
+            path.append(path[-1].children[c])
+        for depth in range(len(name), 0, -1):
+            node = path[depth]
+            node.ids.discard(name_id)
+            if not node.ids and not node.children:
+                del path[depth - 1].children[name[depth - 1]]
+
+    def _add_entry(self, key, degrees):
+        school, department = key
+        self._entries[key] = (self._acquire_name(school), self._acquire_name(department), degrees)
+
+    def _remove_entry(self, key):
+        school_id, department_id, _ = self._entries.pop(key)
+        self._release_name(school_id)
+        self._release_name(department_id)
+
+    def _rebuild_arrays(self):
+        self._keys = sorted(self._entries)
+        entries = [self._entries[key] for key in self._keys]
+        self._school_ids = np.array([e[0] for e in entries], dtype=np.int64)
+        self._department_ids = np.array([e[1] for e in entries], dtype=np.int64)
+        self._lengths = np.array([len(s) + len(d) for s, d in self._keys], dtype=np.int64)
+
+    # ---------- 查詢 ----------
+    def _match_term(self, term):
+        """回傳 {名稱 id: 分數}"""
+        scores = {}
+        for c in set(term):
+            if c not in self._unigrams:
+                return scores
+        if len(term) == 1:
+            candidates = self._unigrams[term]
+        else:
+            grams = [term[i:i + 2] for i in range(len(term) - 1)]
+            postings = [self._bigrams.get(g) for g in grams]
+            candidates = set.intersection(*postings) if all(postings) else set()
+        for name_id in candidates:
+            if term in self._names[name_id]:
+                scores[name_id] = SUBSTRING
+        node = self._trie
+        for c in term:
+            node = node.children.get(c)
+            if node is None:
+                break
+        else:
+            for name_id in node.ids:
+                scores[name_id] = EXACT if self._names[name_id] == term else PREFIX
+        if len(term) > 1:
+            for name_id in set.intersection(*(self._unigrams[c] for c in set(term))):
+                if name_id in scores:
+                    continue
+                span = _subsequence_span(term, self._names[name_id])
+                if span is not None:
+                    # 字越集中分數越高：「台大」對「國立臺灣大學」（臺灣大）優於「臺北科技大學」（臺北科技大）
+                    scores[name_id] = SUBSEQUENCE + 0.5 * len(term) / span
+        return scores
+
+    def search(self, query, limit=10):
+        """回傳 [{school, department, degrees, score}]（依分數排序）"""
+        terms = [t for t in (normalize(part) for part in (query or "").split()) if t]
+        if not terms:
+            return []
+        with self._lock:
+            # 每個詞先在名稱（數百個）上計分，再以陣列一次套到所有系所（數千個）
+            totals = np.zeros(len(self._keys))
+            alive = np.ones(len(self._keys), dtype=bool)
+            for term in terms:
+                matches = self._match_term(term)
+                if not matches:
+                    return []
+                lookup = np.zeros(self._next_id)
+                lookup[np.fromiter(matches.keys(), dtype=np.int64, count=len(matches))] = \
+                    np.fromiter(matches.values(), dtype=np.float64, count=len(matches))
+                scores = np.maximum(lookup[self._school_ids], lookup[self._department_ids])
+                alive &= scores > 0
+                totals += scores
+            hits = np.flatnonzero(alive)
+            # 分數高者優先，同分時名稱較短者優先（_keys 已排序，lexsort 為穩定排序）
+            best = hits[np.lexsort((self._lengths[hits], -totals[hits]))[:limit]]
+            return [{"school": self._keys[i][0], "department": self._keys[i][1],
+                     "degrees": list(self._entries[self._keys[i]][2]), "score": round(float(totals[i]), 3)}
+                    for i in best]
+
+    def stats(self):
+        with self._lock:
+            return {"departments": len(self._entries), "names": len(self._names),
+                    "unigrams": len(self._unigrams), "bigrams": len(self._bigrams)}
@@ -0,0 +1,88 @@
+"""將 user_choices 載入成 NumPy 陣列，供志願模擬等分析共用
+
+ChoiceMatrix.ranks[u, k] 為第 u 位使用者第 k+1 志願的系所編號（-1 代表沒有填），
+系所編號對應 ChoiceMatrix.keys 中的 (school, department, degree)。
+"""
+import numpy as np
+from sqlalchemy import text
+
+
+class ChoiceMatrix:
+    def __init__(self, user_ids, user_names, ranks, keys):
+        self.user_ids = user_ids
+        self.user_names = user_names
+        self.ranks = ranks
+        self.keys = keys
+        self.key_index = {key: i for i, key in enumerate(keys)}
+        self.user_index = {int(uid): i for i, uid in enumerate(user_ids)}
+
+    @property
+    def n_departments(self):
+        return len(self.keys)
+
+    def department_id(self, key):
+        """取得系所編號，新系所會直接加到最後"""
+        idx = self.key_index.get(key)
+        if idx is None:
+            idx = len(self.keys)
+            self.keys.append(key)
+            self.key_index[key] = idx
+        return idx
+
+    def set_user_choices(self, user_id, user_name, keys):
+        """以新的志願清單覆寫（或新增）一位使用者的那一列，回傳列索引"""
+        dept_ids = [self.department_id(key) for key in keys]
+        if len(dept_ids) > self.ranks.shape[1]:
+            pad = np.full((self.ranks.shape[0], len(dept_ids) - self.ranks.shape[1]), -1, dtype=np.int32)
+            self.ranks = np.hstack([self.ranks, pad])
+
+        row = self.user_index.get(user_id)
+        if row is None:
+            row = len(self.user_ids)
+            self.user_ids = np.append(self.user_ids, np.int64(user_id))
+            self.user_names.append(user_name)
+            self.ranks = np.vstack([self.ranks, np.full((1, self.ranks.shape[1]), -1, dtype=np.int32)])
+            self.user_index[user_id] = row
+        elif user_name:
+            self.user_names[row] = user_name
+
+        self.ranks[row, :] = -1
+        self.ranks[row, :len(dept_ids)] = dept_ids
+        return row
+
+
+def load_choice_matrix(conn):
+    """一次查詢載入所有使用者的志願，組成 ChoiceMatrix"""
+    rows = conn.execute(text("""
+        SELECT uc.user_id, u.username, uc.rank, uc.school, uc.department, uc.degree
+        FROM user_choices uc
+        JOIN users u ON u.user_id = uc.user_id
+        ORDER BY uc.user_id, uc.rank
+    """)).fetchall()
+
+    keys = []
+    key_index = {}
+    user_rows = {}
+    user_ids = []
+    user_names = []
+    entries = []
+    max_rank = 0
+    for user_id, username, rank, school, department, degree in rows:
+        key = (school, department, degree)
+        dept = key_index.get(key)
+        if dept is None:
+            dept = key_index[key] = len(keys)
+            keys.append(key)
+        u = user_rows.get(user_id)
+        if u is None:
+            u = user_rows[user_id] = len(user_ids)
+            user_ids.append(user_id)
+            user_names.append(username)
+        entries.append((u, rank - 1, dept))
+        max_rank = max(max_rank, rank)
+
+    ranks = np.full((len(user_ids), max_rank), -1, dtype=np.int32)
+    if entries:
+        arr = np.asarray(entries, dtype=np.int64)
+        ranks[arr[:, 0], arr[:, 1]] = arr[:, 2]
+    return ChoiceMatrix(np.asarray(user_ids, dtype=np.int64), user_names, ranks, keys)
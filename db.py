@@ -0,0 +1,205 @@
+import hashlib
+import hmac
+import os
+import time
+import threading
+from contextlib import contextmanager
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool, NullPool
+
+
+def load_env():
+    """命令列工具用：與 app.py 相同，優先加載 .env，否則加載 .env.local"""
+    from dotenv import load_dotenv
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    env_path = os.path.join(base_dir, '.env')
+    if not os.path.exists(env_path):
+        env_path = os.path.join(base_dir, '.env.local')
+    load_dotenv(env_path, override=True)
+
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_bool(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+# 連線池等待時間的分桶（秒），用來依實際資料調整 pool 大小
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class PoolWaitStats:
+    """記錄從連線池取得連線所花的等待時間"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.failures = 0
+        self.buckets = [0] * (len(WAIT_BUCKETS) + 1)
+
+    def record(self, seconds, failed=False):
+        with self._lock:
+            if failed:
+                self.failures += 1
+                return
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+            for i, bound in enumerate(WAIT_BUCKETS):
+                if seconds <= bound:
+                    self.buckets[i] += 1
+                    break
+            else:
+                self.buckets[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.count,
+                "failed_checkouts": self.failures,
+                "avg_wait_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+                "max_wait_ms": round(self.max * 1000, 3),
+                "wait_histogram_ms": {
+                    **{f"<={int(b * 1000)}": n for b, n in zip(WAIT_BUCKETS, self.buckets)},
+                    "+Inf": self.buckets[-1],
+                },
+            }
+
+
+def _timed_pool_class(base):
+    """包一層 pool 類別，量測每次 checkout 的等待時間（含建立新連線的時間）"""
+
+    class TimedPool(base):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                conn = super()._do_get()
+            except Exception:
+                self._wait_stats.record(time.perf_counter() - start, failed=True)
+                raise
+            self._wait_stats.record(time.perf_counter() - start)
+            return conn
+
+    TimedPool.__name__ = f"Timed{base.__name__}"
+    return TimedPool
+
+
+def create_db_engine(url, stats=None):
+    """依環境變數建立 SQLAlchemy engine（每個 gunicorn worker 各自一組連線池）
+
+    環境變數：
+      DB_POOL_SIZE       連線池常駐連線數（預設 5）
+      DB_MAX_OVERFLOW    尖峰時可額外開的連線數（預設 10）
+      DB_POOL_TIMEOUT    等待連線的秒數上限（預設 30）
+      DB_POOL_RECYCLE    連線回收秒數，避免 Neon 閒置斷線（預設 300）
+      DB_POOL_PRE_PING   checkout 前是否先 ping（預設 true，每次多一個 round trip）
+      DB_PGBOUNCER       位於 PgBouncer transaction pooling 之後時設為 true
+    """
+    stats = stats or PoolWaitStats()
+    kwargs = {
+        "connect_args": {"sslmode": "require"} if "localhost" not in url else {},
+    }
+
+    if is_pgbouncer_mode():
+        # PgBouncer 已經負責連線池：應用端不再保留連線，也不使用 session 層級的狀態
+        # （唯讀交易透過 BEGIN READ ONLY 傳遞，不會殘留在伺服器端連線上）
+        pool_class = _timed_pool_class(NullPool)
+        kwargs["pool_pre_ping"] = False
+    else:
+        pool_class = _timed_pool_class(QueuePool)
+        kwargs.update(
+            pool_size=_env_int("DB_POOL_SIZE", 5),
+            max_overflow=_env_int("DB_MAX_OVERFLOW", 10),
+            pool_timeout=_env_int("DB_POOL_TIMEOUT", 30),
+            pool_recycle=_env_int("DB_POOL_RECYCLE", 300),
+            pool_pre_ping=_env_bool("DB_POOL_PRE_PING", True),
+        )
+
+    pool_class._wait_stats = stats
+    return create_engine(url, poolclass=pool_class, **kwargs)
+
+
+def is_pgbouncer_mode():
+    """是否位於 PgBouncer transaction pooling 之後（不可使用 session 層級功能）"""
+    return _env_bool("DB_PGBOUNCER", False)
+
+
+@contextmanager
+def read_only(bind):
+    """開啟唯讀交易：PostgreSQL 下以 BEGIN READ ONLY 開始，不會多一個 round trip"""
+    with bind.connect() as conn:
+        if conn.dialect.name == "postgresql":
+            conn = conn.execution_options(postgresql_readonly=True)
+        with conn.begin():
+            yield conn
+
+
+def pool_stats(bind):
+    """回傳連線池目前狀態與等待時間統計"""
+    pool = bind.pool
+    stats = {"pool_class": type(pool).__name__, "status": pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    wait_stats = getattr(pool, "_wait_stats", None)
+    if wait_stats is not None:
+        stats.update(wait_stats.snapshot())
+    return stats
+
+
+class ReadRouter:
+    """讀寫分離：讀取預設走 replica，使用者剛寫入後的短時間內改走 primary（read-your-writes）
+
+    sticky 期限由 client 帶著（write_marker 產生的簽章字串，app.py 以 cookie 傳遞），
+    下一個請求不論落在哪個 worker / 機器，都能判斷是否仍需讀 primary。
+    """
+
+    def __init__(self, primary, replica=None, sticky_seconds=10, secret=None):
+        self.primary = primary
+        self.replica = replica
+        self.sticky_seconds = sticky_seconds
+        self._secret = (secret or "").encode("utf-8")
+
+    def _sign(self, user_id, deadline):
+        message = f"{user_id}.{deadline}".encode("utf-8")
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()[:32]
+
+    def write_marker(self, user_id, now=None):
+        """使用者剛寫入時呼叫，回傳 "user_id.期限.簽章"；沒有 replica 時回傳 None"""
+        if self.replica is None or user_id is None:
+            return None
+        deadline = int((now or time.time()) + self.sticky_seconds) + 1
+        return f"{user_id}.{deadline}.{self._sign(user_id, deadline)}"
+
+    def engine_for(self, user_id=None, marker=None):
+        """回傳該次讀取應使用的 engine；marker 為 client 帶回的 write_marker"""
+        if self.replica is None:
+            return self.primary
+        if user_id is not None and marker:
+            try:
+                marker_user, deadline, signature = marker.split(".")
+                deadline = int(deadline)
+            except ValueError:
+                return self.replica
+            if (marker_user == str(user_id) and deadline > time.time()
+                    and hmac.compare_digest(signature, self._sign(marker_user, deadline))):
+                return self.primary
+        return self.replica
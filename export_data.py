@@ -0,0 +1,245 @@
+"""分析用資料匯出（志願、系所彙總、系所清單）
+
+用法：
+    python export_data.py --out ./export                       # CSV
+    python export_data.py --out ./export --format parquet      # Parquet
+    python export_data.py --out ./export --dataset choices --batch-size 20000
+
+資料以 server-side cursor（stream_results + yield_per）分批讀取，每批轉成 DataFrame 後立即寫出，
+記憶體用量與資料表大小無關。匯出 choices 的同一次掃描中累計各系所的彙總（departments），
+不需要再查一次 user_choices。
+
+user_id 以 HMAC-SHA256(EXPORT_SALT, user_id) 取代，同一個 EXPORT_SALT 的多次匯出可以互相對應；
+未設定 EXPORT_SALT 時每次匯出使用隨機 salt（不同次匯出的 user 無法對應）。
+姓名與名單內容不會匯出。
+
+環境變數：
+  EXPORT_SALT         匿名化 user_id 用的 salt
+  EXPORT_BATCH_SIZE   每批讀取的列數（預設 10000）
+"""
+import argparse
+import hashlib
+import hmac
+import os
+import secrets
+import sys
+from collections import defaultdict
+
+import pandas as pd
+from sqlalchemy import text
+
+import db
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # 列在 requirements.txt；沒有安裝的開發環境只能匯出 CSV
+    pa = pq = None
+
+BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "10000"))
+
+DATASETS = ("choices", "departments", "schools")
+FORMATS = ("csv", "parquet")
+CONTENT_TYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+CHOICE_COLUMNS = ["user_hash", "rank", "school", "department", "degree", "created_at"]
+DEPARTMENT_COLUMNS = ["school", "department", "degree", "applicants", "first_choice", "fifth_and_after",
+                      "mean_rank"]
+SCHOOL_COLUMNS = ["school", "department", "degrees"]
+
+
+def export_salt():
+    return os.getenv("EXPORT_SALT") or secrets.token_hex(16)
+
+
+def anonymize(user_id, salt):
+    return hmac.new(salt.encode("utf-8"), str(user_id).encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+
+def iter_batches(conn, sql, columns, batch_size=BATCH_SIZE, params=None):
+    """以 server-side cursor 每次讀 batch_size 列，逐批回傳 DataFrame"""
+    result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(text(sql), params or {})
+    # partitions() 要明確給大小：不給時（SQLAlchemy 2.0）已讀過的列不會釋放，記憶體隨資料量成長
+    for rows in result.partitions(batch_size):
+        yield pd.DataFrame.from_records(rows, columns=columns)
+
+
+class DepartmentAggregator:
+    """匯出 choices 時順便累計各系所學制的統計（記憶體只與系所數有關）"""
+
+    def __init__(self):
+        self._totals = defaultdict(lambda: [0, 0, 0, 0])  # applicants, first, fifth_and_after, rank_sum
+
+    def add(self, df):
+        if df.empty:
+            return
+        grouped = df.assign(
+            first=(df["rank"] == 1).astype("int64"),
+            fifth=(df["rank"] >= 5).astype("int64"),
+        ).groupby(["school", "department", "degree"], sort=False).agg(
+            applicants=("rank", "size"), first=("first", "sum"), fifth=("fifth", "sum"), rank_sum=("rank", "sum"),
+        )
+        for key, row in zip(grouped.index, grouped.itertuples(index=False)):
+            totals = self._totals[key]
+            totals[0] += int(row.applicants)
+            totals[1] += int(row.first)
+            totals[2] += int(row.fifth)
+            totals[3] += int(row.rank_sum)
+
+    def frame(self):
+        rows = [
+            (school, department, degree, applicants, first, fifth, round(rank_sum / applicants, 3))
+            for (school, department, degree), (applicants, first, fifth, rank_sum) in sorted(self._totals.items())
+        ]
+        return pd.DataFrame.from_records(rows, columns=DEPARTMENT_COLUMNS)
+
+
+def choice_frames(conn, salt, aggregator=None, batch_size=BATCH_SIZE):
+    """志願（user_id 已匿名化），依 (user_id, rank) 的 unique index 順序讀取，不需要排序"""
+    for df in iter_batches(conn, """
+        SELECT user_id, rank, school, department, degree, created_at
+        FROM user_choices
+        ORDER BY user_id, rank
+    """, ["user_id", "rank", "school", "department", "degree", "created_at"], batch_size):
+        if aggregator is not None:
+            aggregator.add(df)
+        df.insert(0, "user_hash", [anonymize(u, salt) for u in df.pop("user_id")])
+        yield df[CHOICE_COLUMNS]
+
+
+def school_frames(conn, batch_size=BATCH_SIZE):
+    yield from iter_batches(conn, """
+        SELECT school, dep_name, degree FROM schools ORDER BY id
+    """, SCHOOL_COLUMNS, batch_size)
+
+
+# ---------- 輸出 ----------
+def encode_csv(frames, columns):
+    """逐批回傳 CSV bytes（UTF-8 BOM，Excel 開啟中文不會亂碼）"""
+    yield "\ufeff".encode("utf-8") + ",".join(columns).encode("utf-8") + b"\n"
+    for df in frames:
+        yield df.to_csv(index=False, header=False).encode("utf-8")
+
+
+class _ChunkSink:
+    """給 ParquetWriter 的輸出目標，寫入的 bytes 暫存到下一次 drain()"""
+
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def encode_parquet(frames, columns):
+    """逐批回傳 Parquet bytes，每批一個 row group（footer 在最後一段）"""
+    if pq is None:
+        raise RuntimeError("匯出 Parquet 需要安裝 pyarrow")
+    sink = _ChunkSink()
+    writer = None
+    schema = None
+    for df in frames:
+        table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+        if writer is None:
+            schema = table.schema
+            writer = pq.ParquetWriter(sink, schema)
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is None:
+        writer = pq.ParquetWriter(sink, pa.Table.from_pandas(pd.DataFrame(columns=columns)).schema)
+    writer.close()
+    yield sink.drain()
+
+
+def encode(frames, columns, fmt):
+    return encode_parquet(frames, columns) if fmt == "parquet" else encode_csv(frames, columns)
+
+
+def stream_dataset(engine, dataset, fmt, salt=None, batch_size=BATCH_SIZE):
+    """給 HTTP 端點用：回傳逐段產生檔案內容的 generator（整個匯出在一個唯讀交易中）"""
+    salt = salt or export_salt()
+    with db.read_only(engine) as conn:
+        if dataset == "choices":
+            yield from encode(choice_frames(conn, salt, batch_size=batch_size), CHOICE_COLUMNS, fmt)
+        elif dataset == "departments":
+            aggregator = DepartmentAggregator()
+            for _ in choice_frames(conn, salt, aggregator, batch_size):
+                pass
+            yield from encode([aggregator.frame()], DEPARTMENT_COLUMNS, fmt)
+        elif dataset == "schools":
+            yield from encode(school_frames(conn, batch_size), SCHOOL_COLUMNS, fmt)
+        else:
+            raise ValueError(f"未知的 dataset: {dataset}")
+
+
+def export_to_directory(engine, out_dir, fmt="csv", datasets=DATASETS, salt=None, batch_size=BATCH_SIZE):
+    """寫出 <dataset>.<fmt>；choices 與 departments 共用一次掃描。回傳 {dataset: 檔案路徑}"""
+    salt = salt or export_salt()
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {name: os.path.join(out_dir, f"{name}.{fmt}") for name in datasets}
+
+    def write(name, chunks):
+        with open(paths[name], "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+    with db.read_only(engine) as conn:
+        if "choices" in datasets or "departments" in datasets:
+            aggregator = DepartmentAggregator()
+            frames = choice_frames(conn, salt, aggregator, batch_size)
+            if "choices" in datasets:
+                write("choices", encode(frames, CHOICE_COLUMNS, fmt))
+            else:
+                for _ in frames:
+                    pass
+            if "departments" in datasets:
+                write("departments", encode([aggregator.frame()], DEPARTMENT_COLUMNS, fmt))
+        if "schools" in datasets:
+            write("schools", encode(school_frames(conn, batch_size), SCHOOL_COLUMNS, fmt))
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="匯出分析用資料（匿名化）")
+    parser.add_argument("--out", required=True, help="輸出目錄")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--dataset", action="append", choices=DATASETS,
+                        help="要匯出的資料（可重複，預設全部）")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="每批讀取的列數")
+    args = parser.parse_args(argv)
+
+    db.load_env()
+    if args.format == "parquet" and pq is None:
+        print("[ERROR] 匯出 Parquet 需要安裝 pyarrow")
+        return 1
+    if not os.getenv("EXPORT_SALT"):
+        print("[WARNING] 未設定 EXPORT_SALT，本次匯出的 user_hash 無法與其他次匯出對應")
+
+    engine = db.create_db_engine(os.getenv("DATABASE_REPLICA_URL") or os.getenv("DATABASE_URL"))
+    paths = export_to_directory(engine, args.out, args.format, tuple(args.dataset or DATASETS),
+                                batch_size=args.batch_size)
+    for name, path in paths.items():
+        print(f"[INFO] {name}: {path} ({os.path.getsize(path)} bytes)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,6 +14,8 @@ from google.genai.types import HttpOptions, GenerateContentConfig
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse
 from pdfminer.high_level import extract_text
+import metrics
+import ai_router
 
 # 使用 Application Default Credentials (ADC)
 # 在 Cloud Run 上會自動使用服務帳戶的憑證，不需要 API KEY
@@ -45,6 +47,33 @@ def get_genai_client():
         print("[INFO] 請設置 GOOGLE_APPLICATION_CREDENTIALS 環境變數或執行 gcloud auth application-default login")
         raise
 
+def generate_content(client, model, contents, config, operation):
+    """呼叫 Gemini 並記錄延遲與 token 用量（operation 為呼叫用途，作為指標標籤與 ai_usage.operation）"""
+    start = time.perf_counter()
+    try:
+        response = client.models.generate_content(model=model, contents=contents, config=config)
+    except Exception as e:
+        metrics.observe_ai(model, operation, time.perf_counter() - start, outcome="error")
+        ai_router.record_usage(model, operation, time.perf_counter() - start, outcome="error")
+        metrics.log_event("ai_call_failed", level="warning", model=model, operation=operation, error=str(e))
+        raise
+    seconds = time.perf_counter() - start
+    usage = getattr(response, "usage_metadata", None)
+    metrics.observe_ai(model, operation, seconds, usage=usage)
+    ai_router.record_usage(model, operation, seconds, usage=usage)
+    metrics.log_event(
+        "ai_call", model=model, operation=operation, ms=round(seconds * 1000, 1),
+        prompt_tokens=getattr(usage, "prompt_token_count", None),
+        output_tokens=getattr(usage, "candidates_token_count", None),
+    )
+    return response
+
+
+def prune_text(raw_text):
+    """去掉空行與重複空白，減少送進模型的 token（名單內容不變）"""
+    lines = (" ".join(line.split()) for line in raw_text.splitlines())
+    return "\n".join(line for line in lines if line)
+
 COMMON_USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
@@ -171,24 +200,28 @@ def extract_text_from_html(html_content):
 
 def read_student_id(image_path):
     """使用 Google Vision API 進行 OCR"""
+    start = time.perf_counter()
     try:
         client = vision.ImageAnnotatorClient()
         with io.open(image_path, "rb") as image_file:
             content = image_file.read()
         image = vision.Image(content=content)
         response = client.text_detection(image=image)
+        metrics.observe_ai("vision-text-detection", "read_student_id", time.perf_counter() - start)
         texts = response.text_annotations
         if not texts:
             return None
         return texts[0].description.strip()
     except Exception as e:
+        metrics.observe_ai("vision-text-detection", "read_student_id", time.perf_counter() - start, outcome="error")
+        metrics.log_event("ai_call_failed", level="warning", model="vision-text-detection", error=str(e))
         return None
 
 
 def parse_ocr_with_google_ai(ocr_text):
     """使用 Gemini 解析 OCR 文字"""
     client = get_genai_client()
-    MODEL_NAME = "gemini-2.5-flash"
+    MODEL_NAME = ai_router.choose_model("text", len(ocr_text or ""))
     
     prompt = (
         f"以下是學生證 OCR 結果，請解析成 JSON 格式，欄位為 school, department, name。\n"
@@ -200,11 +233,7 @@ def parse_ocr_with_google_ai(ocr_text):
     config = GenerateContentConfig(temperature=0.0, max_output_tokens=512)
     
     try:
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=prompt,
-            config=config
-        )
+        response = generate_content(client, MODEL_NAME, prompt, config, "parse_ocr")
         raw_content = response.text.strip()
         clean_json_str = clean_markdown_json(raw_content)
         
@@ -234,7 +263,7 @@ def parse_namelist_from_url(url, school_dep):
         return {"error": "HTML 內容為空或無法解析"}
     
     client = get_genai_client()
-    MODEL_NAME = "gemini-2.5-flash"
+    MODEL_NAME = ai_router.choose_model("text", len(text_content))
     
     prompt = (
         f"從這份網頁內容中提取「{school_dep}」的名單。\n\n"
@@ -255,11 +284,7 @@ def parse_namelist_from_url(url, school_dep):
     config = GenerateContentConfig(temperature=0.0)
     
     try:
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=prompt,
-            config=config
-        )
+        response = generate_content(client, MODEL_NAME, prompt, config, "parse_namelist_url")
         
         # 檢查 response 物件和 text 屬性
         if not hasattr(response, 'text') or response.text is None:
@@ -304,7 +329,6 @@ def parse_namelist_from_file(file_bytes: io.BytesIO, school_dep: str):
     """從記憶體 BytesIO 檔案解析名單（PDF先轉文字，其他直接傳檔案）"""
 
     client = get_genai_client()
-    MODEL_NAME = "gemini-2.5-flash"
 
     try:
         # 確保 BytesIO 指標在開頭
@@ -340,9 +364,9 @@ def parse_namelist_from_file(file_bytes: io.BytesIO, school_dep: str):
         try:
             # 直接從記憶體中提取 PDF 文字層
             file_bytes.seek(0)
-            extracted_text = extract_text(file_bytes)
-            print(extracted_text)
-            if not extracted_text.strip():
+            extracted_text = prune_text(extract_text(file_bytes))
+            metrics.log_event("namelist_pdf_text", school_dep=school_dep, chars=len(extracted_text))
+            if not extracted_text:
                 return {"error": "PDF 無文字層或為掃描圖片"}
             # PDF 只傳送純文字給 Gemini
             prompt = (
@@ -361,17 +385,8 @@ def parse_namelist_from_file(file_bytes: io.BytesIO, school_dep: str):
                 f"PDF 文字：\n{extracted_text}"
             )
             config = GenerateContentConfig(temperature=0.0)
-            response = client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=prompt,
-                config=config
-            )
-            # 顯示 input/output token 數量
-            if hasattr(response, "usage_metadata"):
-                usage = response.usage_metadata
-                print(f"[Token] input: {getattr(usage, 'prompt_token_count', 'N/A')}, output: {getattr(usage, 'completion_token_count', 'N/A')}, total: {getattr(usage, 'total_token_count', 'N/A')}")
-            else:
-                print("[Token] 無法取得 token 數量資訊")
+            model = ai_router.choose_model("text", len(extracted_text))
+            response = generate_content(client, model, prompt, config, "parse_namelist_pdf")
         except Exception as e:
             return {"error": f"PDF 文字層提取失敗或 API 呼叫失敗: {str(e)}"}
 
@@ -406,21 +421,11 @@ def parse_namelist_from_file(file_bytes: io.BytesIO, school_dep: str):
                     {"text": prompt}
                 ]
             }]
-            response = client.models.generate_content(
-                model=MODEL_NAME,
-                contents=contents,
-                config=config
-            )
-            # 顯示 input/output token 數量
-            if hasattr(response, "usage_metadata"):
-                usage = response.usage_metadata
-                print(f"[Token] input: {getattr(usage, 'prompt_token_count', 'N/A')}, output: {getattr(usage, 'completion_token_count', 'N/A')}, total: {getattr(usage, 'total_token_count', 'N/A')}")
-            else:
-                print("[Token] 無法取得 token 數量資訊")
+            model = ai_router.choose_model("image" if mime_type.startswith("image/") else "file", len(file_content))
+            response = generate_content(client, model, contents, config, "parse_namelist_file")
         except Exception as e:
             return {"error": f"API call failed: {str(e)}"}
 
-    print(response)
     # === Step 2: 處理回應（PDF 和非 PDF 共用） ===
     if not response:
         return {"error": "未收到 API 回應"}
@@ -431,21 +436,18 @@ def parse_namelist_from_file(file_bytes: io.BytesIO, school_dep: str):
             return {"error": f"API 回應格式無效: {type(response)}"}
         
         raw_content = response.text.strip()
-        print(raw_content)
-        print("=====")
+        metrics.log_event("namelist_ai_response", school_dep=school_dep, chars=len(raw_content))
         # 檢查回應是否為空
         if not raw_content:
             return {"error": "API 回應為空"}
 
         # 清理 markdown 格式並解析 JSON
         clean_json_str = clean_markdown_json(raw_content)
-        print(clean_json_str)
         # 再次檢查清理後是否為空
         if not clean_json_str:
             return {"error": "無法解析 API 回應"}
         
         parsed = json.loads(clean_json_str)
-        print(3)
         # 驗證回應格式
         if not isinstance(parsed, dict):
             return {"error": "回傳的 JSON 不是物件格式"}
@@ -0,0 +1,253 @@
+"""離線批次匯入名單
+
+用法：
+    python ingest_namelists.py --manifest manifest.csv
+    python ingest_namelists.py --dir ./lists --degree 碩士班
+
+manifest.csv 欄位：source, school, department, degree
+  source 可以是本機檔案路徑（PDF/圖片/Excel）或 http(s) URL。
+--dir 模式下，檔名需為「學校__系所__學制.副檔名」（指定 --degree 時可省略學制）。
+
+檔案交給 process pool 解析（PDF 文字抽取吃 CPU），URL 交給 thread pool（主要在等網路），
+同時進行中的工作數上限為 --concurrency。解析結果每 --batch-size 筆寫入資料庫一次，
+寫入成功後記錄在 checkpoint 檔，中斷後重新執行會跳過已完成的項目。
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import ai_router
+import db
+import googleAI
+import namelists
+
+
+def _entry_id(entry):
+    return "|".join([entry["source"], entry["school"], entry["department"], entry["degree"]])
+
+
+def _is_url(source):
+    return source.startswith("http://") or source.startswith("https://")
+
+
+def read_manifest(path):
+    entries = []
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            entry = {k: (row.get(k) or "").strip() for k in ("source", "school", "department", "degree")}
+            if all(entry.values()):
+                entries.append(entry)
+            else:
+                print(f"[WARNING] manifest 欄位不完整，略過: {row}")
+    return entries
+
+
+def scan_directory(path, default_degree=None):
+    entries = []
+    for filename in sorted(os.listdir(path)):
+        stem, ext = os.path.splitext(filename)
+        if not ext:
+            continue
+        parts = stem.split("__")
+        if len(parts) == 2 and default_degree:
+            parts.append(default_degree)
+        if len(parts) != 3:
+            print(f"[WARNING] 檔名格式不符（學校__系所__學制），略過: {filename}")
+            continue
+        entries.append({
+            "source": os.path.join(path, filename),
+            "school": parts[0],
+            "department": parts[1],
+            "degree": parts[2],
+        })
+    return entries
+
+
+def _init_worker(database_url):
+    """子程序各自建立 engine（不可沿用父程序 fork 過來的連線），用量才能寫入 ai_usage"""
+    if database_url:
+        ai_router.configure(db.create_db_engine(database_url))
+
+
+def _parse_file(path, entry):
+    """在子程序中執行：讀檔並呼叫 Gemini 解析"""
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        file_bytes = io.BytesIO(f.read())
+    file_bytes.name = os.path.basename(path)
+    with ai_router.usage_context(entry["school"], entry["department"], entry["degree"]):
+        result = googleAI.parse_namelist_from_file(file_bytes, entry["school"] + entry["department"] + entry["degree"])
+    return result, time.perf_counter() - start
+
+
+def _parse_url(url, entry):
+    start = time.perf_counter()
+    with ai_router.usage_context(entry["school"], entry["department"], entry["degree"]):
+        result = googleAI.parse_namelist_from_url(url, entry["school"] + entry["department"] + entry["degree"])
+    return result, time.perf_counter() - start
+
+
+class Checkpoint:
+    """記錄已寫入資料庫的項目，每次更新都以暫存檔 + rename 原子寫入"""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.failed = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.done = set(data.get("done", []))
+            self.failed = data.get("failed", {})
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"done": sorted(self.done), "failed": self.failed}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def write_batch(engine, batch, checkpoint):
+    """在同一個交易中寫入一批解析結果，成功後更新 checkpoint"""
+    missing = []
+    with engine.begin() as conn:
+        for entry, result in batch:
+            found = namelists.save_degree_namelist(
+                conn, entry["school"], entry["department"], entry["degree"],
+                result["names"], result.get("has_names", True)
+            )
+            if not found:
+                missing.append(entry)
+    for entry, _ in batch:
+        entry_id = _entry_id(entry)
+        if entry in missing:
+            checkpoint.failed[entry_id] = "schools 表中找不到此系所"
+        else:
+            checkpoint.done.add(entry_id)
+            checkpoint.failed.pop(entry_id, None)
+    checkpoint.save()
+    return len(batch) - len(missing)
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run(entries, engine, processes=4, threads=8, concurrency=8, batch_size=20, checkpoint=None,
+        database_url=None):
+    checkpoint = checkpoint or Checkpoint(None)
+    todo = [e for e in entries if _entry_id(e) not in checkpoint.done]
+    skipped = len(entries) - len(todo)
+    timings = []
+    written = 0
+    failed = 0
+    batch = []
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(database_url,)) as process_pool, \
+            ThreadPoolExecutor(max_workers=threads) as thread_pool:
+        pending = {}
+        queue = list(reversed(todo))
+        while queue or pending:
+            # 補滿到同時進行中的上限
+            while queue and len(pending) < concurrency:
+                entry = queue.pop()
+                if _is_url(entry["source"]):
+                    future = thread_pool.submit(_parse_url, entry["source"], entry)
+                else:
+                    future = process_pool.submit(_parse_file, entry["source"], entry)
+                pending[future] = entry
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                entry = pending.pop(future)
+                entry_id = _entry_id(entry)
+                try:
+                    result, seconds = future.result()
+                except Exception as e:
+                    result, seconds = {"error": str(e)}, 0.0
+                timings.append((seconds, entry_id))
+
+                if result and result.get("success") and result.get("names"):
+                    batch.append((entry, result))
+                    print(f"[OK] {entry_id}（{len(result['names'])} 人，{seconds:.1f}s）")
+                else:
+                    failed += 1
+                    reason = (result or {}).get("error", "未找到人名")
+                    checkpoint.failed[entry_id] = reason
+                    print(f"[FAIL] {entry_id}: {reason}")
+
+            if len(batch) >= batch_size:
+                ok = write_batch(engine, batch, checkpoint)
+                written += ok
+                failed += len(batch) - ok
+                batch = []
+
+    if batch:
+        ok = write_batch(engine, batch, checkpoint)
+        written += ok
+        failed += len(batch) - ok
+    checkpoint.save()
+
+    elapsed = time.perf_counter() - start
+    seconds = [t for t, _ in timings]
+    print("\n" + "=" * 60)
+    print(f"總數 {len(entries)}，略過（已完成）{skipped}，寫入 {written}，失敗 {failed}")
+    print(f"耗時 {elapsed:.1f}s，吞吐量 {len(todo) / elapsed * 60 if elapsed else 0:.1f} 份/分鐘")
+    if seconds:
+        print(f"單份耗時 p50 {_percentile(seconds, 0.5):.1f}s / p95 {_percentile(seconds, 0.95):.1f}s"
+              f" / max {max(seconds):.1f}s")
+        print("最慢的項目：")
+        for t, entry_id in sorted(timings, reverse=True)[:5]:
+            print(f"  {t:6.1f}s  {entry_id}")
+    print("=" * 60)
+    return {"total": len(entries), "skipped": skipped, "written": written, "failed": failed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="離線批次匯入名單")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--manifest", help="CSV：source, school, department, degree")
+    source.add_argument("--dir", help="名單檔案目錄，檔名為 學校__系所__學制.副檔名")
+    parser.add_argument("--degree", help="--dir 模式下檔名未含學制時使用的學制")
+    parser.add_argument("--processes", type=int, default=4, help="解析檔案的 process 數")
+    parser.add_argument("--threads", type=int, default=8, help="抓取 URL 的 thread 數")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時進行中的解析數上限（即模型呼叫併發數）")
+    parser.add_argument("--batch-size", type=int, default=20, help="每批寫入資料庫的筆數")
+    parser.add_argument("--checkpoint", default=".ingest_checkpoint.json", help="checkpoint 檔路徑")
+    args = parser.parse_args(argv)
+
+    entries = read_manifest(args.manifest) if args.manifest else scan_directory(args.dir, args.degree)
+    if not entries:
+        print("[INFO] 沒有可匯入的項目")
+        return 0
+
+    db.load_env()
+    database_url = os.getenv("DATABASE_URL")
+    engine = db.create_db_engine(database_url)
+    ai_router.configure(engine)
+    summary = run(
+        entries, engine,
+        processes=args.processes,
+        threads=args.threads,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        checkpoint=Checkpoint(args.checkpoint),
+        database_url=database_url,
+    )
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
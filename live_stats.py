@@ -0,0 +1,260 @@
+"""系所統計即時推送（Server-Sent Events）
+
+前端以 EventSource 訂閱關心的 (school, department, degree)，不必反覆呼叫 /api/user_department_stats：
+
+  1. rankings.apply_choice_diff / set_namelist_count 在寫入的交易中 pg_notify 變動的 key
+  2. 每個 worker 一條 LISTEN 連線（背景執行緒），收到的 key 先累積起來
+  3. 每 LIVE_STATS_INTERVAL 秒把「有人訂閱且有變動」的 key 以一個查詢取回最新統計，推給訂閱者
+
+同一段時間內的多次變動只推一次，資料庫查詢數與連線數無關（每個 worker 每個間隔最多一次）。
+LISTEN 連線中斷時自動重連，重連後所有訂閱中的 key 視為已變動（可能漏掉通知）。
+
+位於 PgBouncer transaction pooling 之後時 LISTEN 無法使用，需以 LIVE_STATS_LISTEN_URL 指定直連的資料庫。
+
+環境變數：
+  LIVE_STATS_INTERVAL          推送間隔秒數（預設 2）
+  LIVE_STATS_HEARTBEAT         沒有更新時送 keepalive 的間隔（預設 15）
+  LIVE_STATS_MAX_SECONDS       單一連線最長秒數，之後由 EventSource 自動重連（預設 600）
+  LIVE_STATS_MAX_SUBSCRIBERS   每個 worker 最多同時訂閱的連線數（預設 48）；每條連線佔一個 gunicorn 執行緒，
+                               需小於 --threads，其餘執行緒留給一般請求
+  LIVE_STATS_MAX_KEYS          每個連線最多訂閱的系所數（預設 20）
+  LIVE_STATS_LISTEN_URL        LISTEN 用的資料庫 URL（預設與 engine 相同）
+"""
+import json
+import os
+import select
+import threading
+import time
+
+import db
+import metrics
+import rankings
+
+INTERVAL = float(os.getenv("LIVE_STATS_INTERVAL", "2"))
+HEARTBEAT = float(os.getenv("LIVE_STATS_HEARTBEAT", "15"))
+MAX_SECONDS = float(os.getenv("LIVE_STATS_MAX_SECONDS", "600"))
+MAX_SUBSCRIBERS = int(os.getenv("LIVE_STATS_MAX_SUBSCRIBERS", "48"))
+MAX_KEYS = int(os.getenv("LIVE_STATS_MAX_KEYS", "20"))
+LISTEN_URL = os.getenv("LIVE_STATS_LISTEN_URL")
+RECONNECT_SECONDS = 5
+
+STAT_FIELDS = ("total_choices", "first_choice", "fifth_and_after", "namelist_count")
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+def stats_payload(key, stats):
+    school, department, degree = key
+    stats = stats or {}
+    return {"school": school, "department": department, "degree": degree,
+            **{field: stats.get(field, 0) for field in STAT_FIELDS}}
+
+
+class Subscription:
+    """一個 SSE 連線；同一個 key 尚未送出的更新只保留最新的一份"""
+
+    def __init__(self, keys):
+        self.keys = frozenset(keys)
+        self.active = False
+        self._pending = {}
+        self._cond = threading.Condition()
+
+    def push(self, updates):
+        with self._cond:
+            self._pending.update(updates)
+            self._cond.notify()
+
+    def wait(self, timeout):
+        """等待更新，回傳 {key: payload}（逾時回傳空 dict）"""
+        with self._cond:
+            if not self._pending:
+                self._cond.wait(timeout)
+            updates, self._pending = self._pending, {}
+            return updates
+
+
+class StatsHub:
+    def __init__(self):
+        self.engine = None
+        self.listen_url = None
+        self._lock = threading.Lock()
+        self._subscribers = {}   # key -> set(Subscription)
+        self._count = 0
+        self._changed = set()
+        self._thread = None
+
+    def configure(self, engine, listen_url=None):
+        self.engine = engine
+        self.listen_url = listen_url
+
+    # ---------- 訂閱 ----------
+    def subscribe(self, keys):
+        """連線數已滿時丟出 TooManySubscribers（判斷與登記在同一個鎖內）"""
+        with self._lock:
+            if self._count >= MAX_SUBSCRIBERS:
+                raise TooManySubscribers()
+            sub = Subscription(keys)
+            for key in sub.keys:
+                self._subscribers.setdefault(key, set()).add(sub)
+            self._count += 1
+            sub.active = True
+            self._start_listener()
+        return sub
+
+    def unsubscribe(self, sub):
+        """可重複呼叫，只有第一次有作用"""
+        with self._lock:
+            if not sub.active:
+                return
+            sub.active = False
+            for key in sub.keys:
+                subs = self._subscribers.get(key)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._subscribers[key]
+            self._count -= 1
+
+    def snapshot(self, keys):
+        """連線剛建立時的完整統計"""
+        with db.read_only(self.engine) as conn:
+            stats = rankings.get_stats_many(conn, keys)
+        return {key: stats_payload(key, stats.get(key)) for key in keys}
+
+    # ---------- LISTEN ----------
+    def _start_listener(self):
+        if self._thread is None and self.engine is not None:
+            self._thread = threading.Thread(target=self._run, name="live-stats", daemon=True)
+            self._thread.start()
+
+    def _connect(self):
+        if self.listen_url:
+            import psycopg2
+            conn = psycopg2.connect(self.listen_url)
+        else:
+            # 從 engine 取一條連線並脫離連線池，沿用 engine 的連線參數（sslmode 等）
+            pooled = self.engine.raw_connection()
+            conn = pooled.driver_connection
+            pooled.detach()
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {rankings.STATS_CHANNEL}")
+        return conn
+
+    def _run(self):
+        while True:
+            try:
+                conn = self._connect()
+            except Exception as e:
+                metrics.log_event("live_stats_listen_failed", level="warning", error=str(e))
+                time.sleep(RECONNECT_SECONDS)
+                continue
+            # 重連期間可能漏掉通知：訂閱中的 key 全部重新推一次
+            with self._lock:
+                self._changed.update(self._subscribers)
+            try:
+                self._listen(conn)
+            except Exception as e:
+                metrics.log_event("live_stats_listen_failed", level="warning", error=str(e))
+            finally:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            time.sleep(RECONNECT_SECONDS)
+
+    def _listen(self, conn):
+        next_flush = time.monotonic() + INTERVAL
+        while True:
+            timeout = max(0.0, next_flush - time.monotonic())
+            if select.select([conn], [], [], timeout)[0]:
+                conn.poll()
+                changed = set()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        changed.update(tuple(key) for key in json.loads(notify.payload))
+                    except (ValueError, TypeError):
+                        continue
+                with self._lock:
+                    self._changed.update(changed)
+            if time.monotonic() >= next_flush:
+                self._flush()
+                next_flush = time.monotonic() + INTERVAL
+
+    def _flush(self):
+        with self._lock:
+            keys = [key for key in self._changed if key in self._subscribers]
+            self._changed.clear()
+        if not keys:
+            return
+        try:
+            with db.read_only(self.engine) as conn:
+                stats = rankings.get_stats_many(conn, keys)
+        except Exception as e:
+            metrics.log_event("live_stats_flush_failed", level="warning", error=str(e))
+            with self._lock:
+                self._changed.update(keys)
+            return
+        targets = {}
+        with self._lock:
+            for key in keys:
+                payload = stats_payload(key, stats.get(key))
+                for sub in self._subscribers.get(key, ()):
+                    targets.setdefault(sub, {})[key] = payload
+        for sub, updates in targets.items():
+            sub.push(updates)
+
+    def stats(self):
+        with self._lock:
+            return {"subscribers": self._count, "keys": len(self._subscribers)}
+
+
+hub = StatsHub()
+
+
+def configure(engine):
+    hub.configure(engine, LISTEN_URL)
+
+
+def _metric_lines():
+    s = hub.stats()
+    return [
+        "# HELP live_stats_subscribers Open department stats streams",
+        "# TYPE live_stats_subscribers gauge",
+        f"live_stats_subscribers {s['subscribers']}",
+    ]
+
+
+metrics.register_collector(_metric_lines)
+
+
+# ---------- Flask ----------
+def _event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream(keys, expires_at=None):
+    """訂閱 keys，回傳 (SSE 的 generator, 取消訂閱的 close)；expires_at（epoch 秒）到了就結束連線
+
+    在建立回應之前訂閱：連線數已滿時這裡就丟出 TooManySubscribers，可以回 503。
+    呼叫端需在回應結束時呼叫 close（response.call_on_close），回應沒有開始送出就被丟棄時也會呼叫到。
+    """
+    sub = hub.subscribe(keys)
+    deadline = time.time() + MAX_SECONDS
+    if expires_at is not None:
+        deadline = min(deadline, expires_at)
+
+    def generate():
+        yield "retry: 5000\n\n"
+        yield _event("stats", {"stats": list(hub.snapshot(sub.keys).values())})
+        while time.time() < deadline:
+            updates = sub.wait(min(HEARTBEAT, max(0.0, deadline - time.time())))
+            if updates:
+                yield _event("stats", {"stats": list(updates.values())})
+            else:
+                yield ": keepalive\n\n"
+
+    return generate(), lambda: hub.unsubscribe(sub)
@@ -0,0 +1,192 @@
+"""匯入教育部格式的系所清單到 schools 表
+
+用法：
+    python load_catalog.py departments.csv
+    python load_catalog.py 114學年度系所.xlsx --retire all
+    python load_catalog.py departments.csv --dry-run
+
+檔案每列為一個系所學制，欄位名稱可為中文或英文：
+  學校名稱 / 學校 / school
+  系所名稱 / 系所 / dep_name / department
+  學制 / 班別 / degree（選填，同一系所的多列會合併成「碩士班,博士班」）
+
+整份清單先以 COPY 寫入暫存表，再以一個 INSERT ... ON CONFLICT 合併到 schools：
+  - 新的系所新增；已存在的系所只更新 degree（原有學制保留，官方清單的學制排在前面）
+  - namelist 不會被修改
+  - 清單中沒有的系所標記 retired_at（不刪除，已填的志願與名單仍可查詢），
+    --retire schools（預設）只處理清單中出現過的學校，all 處理全部，none 不標記
+  - 已標記 retired_at 的系所重新出現在清單中時恢復
+整個匯入在同一個交易中完成，失敗時不會留下一半的資料。
+
+各 worker 的學校 / 系所清單快取在 CATALOG_CACHE_SECONDS 秒內更新；
+透過 /api/admin/load_catalog 匯入時，處理該請求的 worker 會立即更新。
+"""
+import argparse
+import csv
+import io
+import os
+import sys
+import unicodedata
+
+import pandas as pd
+from sqlalchemy import text
+
+import db
+
+COLUMN_ALIASES = {
+    "school": ("學校名稱", "學校", "school"),
+    "dep_name": ("系所名稱", "系所", "dep_name", "department"),
+    "degree": ("學制", "班別", "degree"),
+}
+RETIRE_SCOPES = ("schools", "all", "none")
+# 教育部提供的 CSV 常為 Big5（cp950）
+CSV_ENCODINGS = ("utf-8-sig", "cp950")
+
+_MERGE_SQL = """
+    WITH merged AS (
+        SELECT st.school, st.dep_name,
+               (
+                   SELECT string_agg(d, ',' ORDER BY ord)
+                   FROM (
+                       SELECT d, min(ord) AS ord
+                       FROM (
+                           SELECT trim(x) AS d, o AS ord
+                           FROM unnest(string_to_array(st.degree, ',')) WITH ORDINALITY AS u(x, o)
+                           UNION ALL
+                           SELECT trim(x), 1000 + o
+                           FROM unnest(string_to_array(s.degree, ',')) WITH ORDINALITY AS u(x, o)
+                       ) all_degrees
+                       WHERE d <> ''
+                       GROUP BY d
+                   ) degrees
+               ) AS degree
+        FROM catalog_stage st
+        LEFT JOIN schools s ON s.school = st.school AND s.dep_name = st.dep_name
+    ),
+    upserted AS (
+        INSERT INTO schools (school, dep_name, degree)
+        SELECT school, dep_name, degree FROM merged
+        ON CONFLICT (school, dep_name) DO UPDATE SET
+            degree = EXCLUDED.degree,
+            retired_at = NULL
+        WHERE schools.degree IS DISTINCT FROM EXCLUDED.degree OR schools.retired_at IS NOT NULL
+        RETURNING (xmax = 0) AS inserted
+    ),
+    retired AS (
+        UPDATE schools s
+        SET retired_at = now()
+        WHERE s.retired_at IS NULL
+          AND :retire_scope <> 'none'
+          AND (:retire_scope = 'all' OR s.school IN (SELECT school FROM catalog_stage))
+          AND NOT EXISTS (
+              SELECT 1 FROM catalog_stage st WHERE st.school = s.school AND st.dep_name = s.dep_name
+          )
+        RETURNING 1
+    )
+    SELECT
+        count(*) FILTER (WHERE inserted) AS inserted,
+        count(*) FILTER (WHERE NOT inserted) AS updated,
+        (SELECT count(*) FROM retired) AS retired
+    FROM upserted
+"""
+
+
+def _clean(value):
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return ""
+    return " ".join(unicodedata.normalize("NFKC", str(value)).split())
+
+
+def read_departments(source, filename=None):
+    """讀取 CSV / Excel（路徑或 file-like），回傳 DataFrame[school, dep_name, degree]，每個系所一列"""
+    name = (filename or (source if isinstance(source, str) else "")).lower()
+    if name.endswith((".xlsx", ".xls")):
+        raw = pd.read_excel(source, dtype=str)
+    else:
+        data = source.read() if hasattr(source, "read") else open(source, "rb").read()
+        for encoding in CSV_ENCODINGS:
+            try:
+                raw = pd.read_csv(io.StringIO(data.decode(encoding)), dtype=str)
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            raise ValueError("無法辨識檔案編碼（支援 UTF-8、Big5）")
+
+    columns = {}
+    for target, aliases in COLUMN_ALIASES.items():
+        found = next((c for c in raw.columns if _clean(c) in aliases), None)
+        if found is None and target != "degree":
+            raise ValueError(f"找不到欄位 {aliases[0]}（可用名稱：{'、'.join(aliases)}）")
+        columns[target] = found
+
+    df = pd.DataFrame({
+        target: raw[column].map(_clean) if column is not None else ""
+        for target, column in columns.items()
+    })
+    df = df[(df["school"] != "") & (df["dep_name"] != "")]
+    # 同一系所的多個學制合併成一列（保留第一次出現的順序）
+    return (
+        df.groupby(["school", "dep_name"], sort=False)["degree"]
+        .agg(lambda values: ",".join(dict.fromkeys(v for v in values if v)))
+        .reset_index()
+    )
+
+
+def merge(conn, departments, retire_scope="schools"):
+    """在 conn 的交易中 COPY 到暫存表並合併，回傳 {rows, inserted, updated, unchanged, retired}"""
+    if retire_scope not in RETIRE_SCOPES:
+        raise ValueError(f"retire_scope 必須是 {', '.join(RETIRE_SCOPES)}")
+    conn.execute(text("""
+        CREATE TEMP TABLE catalog_stage (school TEXT NOT NULL, dep_name TEXT NOT NULL, degree TEXT)
+        ON COMMIT DROP
+    """))
+    buf = io.StringIO()
+    csv.writer(buf).writerows(departments[["school", "dep_name", "degree"]].itertuples(index=False, name=None))
+    buf.seek(0)
+    cursor = conn.connection.cursor()
+    cursor.copy_expert("COPY catalog_stage (school, dep_name, degree) FROM STDIN WITH (FORMAT csv)", buf)
+    row = conn.execute(text(_MERGE_SQL), {"retire_scope": retire_scope}).mappings().one()
+    report = {"rows": len(departments), **{k: int(v) for k, v in row.items()}}
+    report["unchanged"] = report["rows"] - report["inserted"] - report["updated"]
+    return report
+
+
+def load(engine, departments, retire_scope="schools", dry_run=False):
+    """匯入整份清單；dry_run 時回報結果但不提交"""
+    with engine.connect() as conn:
+        with conn.begin() as trans:
+            report = merge(conn, departments, retire_scope)
+            if dry_run:
+                trans.rollback()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="匯入教育部格式的系所清單到 schools 表")
+    parser.add_argument("path", help="CSV 或 Excel 檔")
+    parser.add_argument("--retire", choices=RETIRE_SCOPES, default="schools",
+                        help="清單中沒有的系所標記停招的範圍（預設只處理清單中出現的學校）")
+    parser.add_argument("--dry-run", action="store_true", help="只回報會有的變動，不寫入")
+    args = parser.parse_args(argv)
+
+    try:
+        departments = read_departments(args.path)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] {e}")
+        return 1
+    if departments.empty:
+        print("[INFO] 檔案中沒有系所資料")
+        return 1
+
+    db.load_env()
+    engine = db.create_db_engine(os.getenv("DATABASE_URL"))
+    report = load(engine, departments, args.retire, args.dry_run)
+    prefix = "[DRY RUN] " if args.dry_run else ""
+    print(f"[INFO] {prefix}{report['rows']} 個系所：新增 {report['inserted']}、更新 {report['updated']}、"
+          f"未變動 {report['unchanged']}、標記停招 {report['retired']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
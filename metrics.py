@@ -0,0 +1,255 @@
+"""指標收集與 Prometheus 文字格式輸出（不依賴 prometheus_client）
+
+收集的指標：
+  http_request_duration_seconds   每個路由的請求延遲（route / method / status）
+  db_query_duration_seconds       每種 SQL 的執行時間（以「動作 + 資料表」歸類，避免標籤爆量）
+  ai_request_duration_seconds     Gemini / Vision 呼叫延遲（model / operation / outcome）
+  ai_tokens_total                 Gemini token 用量（model / kind）
+  smtp_send_duration_seconds      寄信時間（outcome）
+  ai_singleflight_total           相同內容的模型呼叫合併情形（leader 實際呼叫，其餘為等待或取用結果）
+  throttled_requests_total        被限流擋下的請求（rule）
+  db_pool_*                       連線池狀態（scrape 時從 db.pool_stats 讀取）
+
+指標存在處理請求的 gunicorn worker 程序的記憶體中（gthread：同一程序的所有執行緒共用一份）。
+/metrics 只回報處理這個請求的那一個程序，不是整個服務：部署為多個執行個體（或多個 worker）時，
+Prometheus 必須逐一抓取每個執行個體（例如以 service discovery 列出各個 instance 再分別 scrape），
+不能經由負載平衡器抓取同一個網址，否則每次抓到的是不同程序、計數器看起來會忽增忽減。
+加總與比較請在 Prometheus 端以 sum by (...) 跨 instance 計算。程序重啟後計數器歸零（rate() 會處理）。
+
+log_event() 取代原本直接 print 的除錯輸出：一行一筆 JSON，依 LOG_SAMPLE_RATE 取樣，
+level 為 warning / error 時一律輸出。不要把整份文件或名單內容放進欄位，只記錄長度等摘要。
+"""
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+# 預設分桶（秒）：涵蓋快取命中的毫秒級查詢到數十秒的模型呼叫
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 不同 SQL 種類的上限，超過後一律歸到 "other"
+MAX_STATEMENT_LABELS = 200
+
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, series["buckets"]):
+                    cumulative += n
+                    le = _format_labels(self.labels, key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                le = _format_labels(self.labels, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series['count']}")
+        return lines
+
+
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency by route",
+                         ("route", "method", "status"))
+DB_LATENCY = Histogram("db_query_duration_seconds", "SQL statement execution time",
+                       ("statement",))
+DB_ERRORS = Counter("db_query_errors_total", "SQL statements that raised", ("statement",))
+AI_LATENCY = Histogram("ai_request_duration_seconds", "Model API call latency",
+                       ("model", "operation", "outcome"))
+AI_TOKENS = Counter("ai_tokens_total", "Model tokens used", ("model", "kind"))
+SMTP_LATENCY = Histogram("smtp_send_duration_seconds", "SMTP send time", ("outcome",))
+SINGLEFLIGHT = Counter("ai_singleflight_total", "Coalesced model calls by role", ("operation", "role"))
+THROTTLED = Counter("throttled_requests_total", "Requests rejected by rate limiting", ("rule",))
+
+_METRICS = [HTTP_LATENCY, DB_LATENCY, DB_ERRORS, AI_LATENCY, AI_TOKENS, SMTP_LATENCY, SINGLEFLIGHT, THROTTLED]
+_collectors = []
+
+
+def register_collector(fn):
+    """fn() 回傳 Prometheus 文字行（list），scrape 時才呼叫，用於連線池等即時狀態"""
+    _collectors.append(fn)
+
+
+def render():
+    lines = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        try:
+            lines.extend(collector())
+        except Exception as e:
+            log_event("metrics_collector_failed", level="warning", error=str(e))
+    return "\n".join(lines) + "\n"
+
+
+# ---------- SQL ----------
+_statement_labels = {}
+_pools = {}
+_SQL_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+([a-z_][a-z0-9_]*)", re.IGNORECASE)
+
+
+def statement_label(statement):
+    """把 SQL 歸類為「動作 資料表」，例如 SELECT schools、INSERT user_choices"""
+    label = _statement_labels.get(statement)
+    if label is not None:
+        return label
+    words = statement.split(None, 1)
+    verb = words[0].upper() if words else "?"
+    if verb == "WITH":
+        verb = "CTE"
+    match = _SQL_TABLE.search(statement)
+    label = f"{verb} {match.group(1).lower()}" if match else verb
+    if len(_statement_labels) >= MAX_STATEMENT_LABELS:
+        return label if label in _statement_labels.values() else "other"
+    _statement_labels[statement] = label
+    return label
+
+
+def instrument_engine(engine, name="primary"):
+    """以 engine events 量測每個 SQL 的執行時間，並把連線池狀態加入 /metrics"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_metrics_start", None)
+        if start is not None:
+            DB_LATENCY.observe(time.perf_counter() - start, statement=statement_label(statement))
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        if exception_context.statement:
+            DB_ERRORS.inc(statement=statement_label(exception_context.statement))
+
+    _pools[name] = engine
+
+
+def _pool_lines():
+    import db
+
+    stats = {name: db.pool_stats(engine) for name, engine in _pools.items()}
+    lines = []
+    for key, metric, kind in (
+        ("size", "db_pool_size", "gauge"),
+        ("checked_out", "db_pool_checked_out", "gauge"),
+        ("overflow", "db_pool_overflow", "gauge"),
+        ("checkouts", "db_pool_checkouts_total", "counter"),
+        ("failed_checkouts", "db_pool_failed_checkouts_total", "counter"),
+    ):
+        values = [(name, s[key]) for name, s in stats.items() if key in s]
+        if values:
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.extend(f'{metric}{{pool="{name}"}} {value}' for name, value in values)
+    lines.append("# TYPE db_pool_wait_seconds_total counter")
+    for name, s in stats.items():
+        if "avg_wait_ms" in s:
+            lines.append(f'db_pool_wait_seconds_total{{pool="{name}"}} {s["avg_wait_ms"] * s["checkouts"] / 1000}')
+    return lines
+
+
+register_collector(_pool_lines)
+
+
+# ---------- Flask ----------
+def instrument_app(app):
+    """記錄每個請求的延遲（以路由規則為標籤，不用實際路徑）"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _record_latency(response):
+        start = g.pop("_metrics_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            HTTP_LATENCY.observe(time.perf_counter() - start, route=route,
+                                 method=request.method, status=response.status_code)
+        return response
+
+
+# ---------- 外部服務 ----------
+def observe_ai(model, operation, seconds, outcome="ok", usage=None):
+    """記錄一次模型呼叫；usage 為 response.usage_metadata（可為 None）"""
+    AI_LATENCY.observe(seconds, model=model, operation=operation, outcome=outcome)
+    if usage is None:
+        return
+    for kind, attr in (("prompt", "prompt_token_count"), ("output", "candidates_token_count"),
+                       ("thoughts", "thoughts_token_count"), ("total", "total_token_count")):
+        count = getattr(usage, attr, None)
+        if count:
+            AI_TOKENS.inc(count, model=model, kind=kind)
+
+
+def observe_smtp(seconds, ok):
+    SMTP_LATENCY.observe(seconds, outcome="ok" if ok else "error")
+
+
+# ---------- 取樣的結構化 log ----------
+def log_event(event, level="info", sample_rate=None, **fields):
+    """輸出一行 JSON log；info 等級依 sample_rate（預設 LOG_SAMPLE_RATE）取樣"""
+    rate = LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+    if level == "info" and random.random() >= rate:
+        return
+    record = {"ts": round(time.time(), 3), "level": level, "event": event, **fields}
+    print(json.dumps(record, ensure_ascii=False, default=str), file=sys.stdout, flush=True)
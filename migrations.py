@@ -0,0 +1,646 @@
+"""資料庫 schema 版本管理
+
+用法：
+    python migrations.py upgrade     # 套用所有尚未執行的 migration
+    python migrations.py status      # 列出每個 migration 是否已套用
+    python migrations.py check       # 以 EXPLAIN 檢查熱門查詢是否都有走索引
+
+每個 migration 為 (版本號, 名稱, 步驟清單)，步驟可以是 SQL 字串或 callable(conn)。
+已上線的 migration 不可修改，需要變更時請新增一個版本；步驟只用本檔案中的 SQL，
+不呼叫其他模組（其他模組之後的修改不會改變已上線的 migration）。
+資料需要人工處理時步驟丟出 MigrationError，該版本整個回滾，upgrade 停在前一個版本。
+"""
+import os
+import sys
+import json
+from sqlalchemy import text
+
+# 多個 worker 同時啟動時，以 advisory lock 確保同一時間只有一個在跑 migration
+MIGRATION_LOCK_KEY = 727274001
+
+
+class MigrationError(Exception):
+    """資料需要人工處理，migration 無法自動套用（整個版本的交易會回滾）"""
+
+
+# schools.namelist 是 TEXT：解析成 JSON 物件，不是 JSON 或不是物件（舊格式的單一名單）時回傳 NULL。
+# 建在 pg_temp，只存在於這個連線，不會留在 schema 中
+_NAMELIST_OBJECT_FUNCTION = """
+    CREATE OR REPLACE FUNCTION pg_temp.namelist_object(value TEXT) RETURNS JSONB
+    LANGUAGE plpgsql IMMUTABLE AS $$
+    DECLARE
+        parsed JSONB;
+    BEGIN
+        parsed := value::jsonb;
+        RETURN CASE WHEN jsonb_typeof(parsed) = 'object' THEN parsed END;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END
+    $$
+"""
+
+# 每個系所學制的名單：(school, department, degree, names, has_names)，與 namelists.parse_namelist_column 相同的規則：
+# 值為物件時取 names / has_names（預設 TRUE），為字串時整個字串即名單
+_NAMELIST_DEGREES_SQL = """
+    SELECT s.school, s.dep_name AS department, item.key AS degree,
+           CASE jsonb_typeof(item.value)
+               WHEN 'object' THEN CASE WHEN jsonb_typeof(item.value -> 'names') = 'string'
+                                       THEN item.value ->> 'names' END
+               WHEN 'string' THEN item.value #>> '{}'
+           END AS names,
+           CASE WHEN jsonb_typeof(item.value -> 'has_names') = 'boolean'
+                THEN (item.value ->> 'has_names')::boolean ELSE TRUE END AS has_names
+    FROM schools s
+    CROSS JOIN LATERAL jsonb_each(pg_temp.namelist_object(s.namelist)) AS item
+"""
+
+# 名單字串切成名字（去除前後空白、略過空字串），position 從 0 起算，與 namelists.split_names 相同
+_NAMELIST_NAMES_SQL = """
+    SELECT d.school, d.department, d.degree,
+           (row_number() OVER (PARTITION BY d.school, d.department, d.degree ORDER BY part.ord) - 1)::int
+               AS position,
+           part.name
+    FROM (""" + _NAMELIST_DEGREES_SQL + """) d
+    CROSS JOIN LATERAL (
+        SELECT regexp_replace(x, '^\\s+|\\s+$', '', 'g') AS name, ord
+        FROM unnest(string_to_array(d.names, ',')) WITH ORDINALITY AS u(x, ord)
+    ) part
+    WHERE part.name <> ''
+"""
+
+
+def _abort_on_duplicate_emails(conn):
+    """同一個 email 有多個帳號時停止：哪個帳號與志願要保留需要人工決定，不自動刪除"""
+    rows = conn.execute(text("""
+        SELECT email, count(*) AS accounts, string_agg(user_id::text, ',' ORDER BY user_id) AS user_ids
+        FROM users
+        GROUP BY email
+        HAVING count(*) > 1
+        ORDER BY email
+    """)).fetchall()
+    if rows:
+        listing = "\n".join(f"  {r.email}: user_id {r.user_ids}" for r in rows)
+        raise MigrationError(
+            f"{len(rows)} 個 email 有重複的帳號，請合併或刪除多餘的帳號（與其 user_choices）後再執行：\n{listing}"
+        )
+
+
+def _abort_on_unmergeable_schools(conn):
+    """同一系所的多列中有舊格式（非 JSON 物件）的名單又有其他名單時停止：無法依學制合併"""
+    rows = conn.execute(text("""
+        SELECT school, dep_name, string_agg(id::text, ',' ORDER BY id) AS ids
+        FROM schools
+        WHERE COALESCE(namelist, '') <> ''
+        GROUP BY school, dep_name
+        HAVING count(*) > 1 AND bool_or(pg_temp.namelist_object(namelist) IS NULL)
+        ORDER BY school, dep_name
+    """)).fetchall()
+    if rows:
+        listing = "\n".join(f"  {r.school} {r.dep_name}: id {r.ids}" for r in rows)
+        raise MigrationError(
+            f"{len(rows)} 個系所有多列名單且含舊格式，無法自動合併，請手動整理後再執行：\n{listing}"
+        )
+
+
+MIGRATIONS = [
+    (1, "baseline_schema", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id SERIAL PRIMARY KEY,
+            username TEXT,
+            email TEXT NOT NULL,
+            password_hash TEXT NOT NULL,
+            school TEXT,
+            department TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS email_verifications (
+            id SERIAL PRIMARY KEY,
+            email TEXT NOT NULL,
+            verification_code TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            used BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at TIMESTAMP NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS schools (
+            id SERIAL PRIMARY KEY,
+            school TEXT NOT NULL,
+            dep_name TEXT NOT NULL,
+            degree TEXT,
+            namelist TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_choices (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+            rank INTEGER NOT NULL,
+            school TEXT NOT NULL,
+            department TEXT NOT NULL,
+            degree TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+    ]),
+    (2, "hot_path_indexes", [
+        # 原本的程式允許重複資料，建立 unique index 前先處理。
+        # 同一個 email 的多個帳號各自有志願，不自動刪除：列出重複的 email 並停止，由管理者處理
+        _abort_on_duplicate_emails,
+        # login / 註冊：WHERE email = :email
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_email_key ON users (email)",
+        # 驗證碼：WHERE email = :email ORDER BY created_at DESC LIMIT 1
+        """
+        CREATE INDEX IF NOT EXISTS email_verifications_email_created_idx
+            ON email_verifications (email, created_at DESC)
+        """,
+        # 重複的系所：優先保留有名單的一列，其次保留 id 最大（最新）的；
+        # 刪除前先把其他列的名單（依學制合併，同一學制以保留的一列為準）與學制併入保留的一列
+        _NAMELIST_OBJECT_FUNCTION,
+        _abort_on_unmergeable_schools,
+        """
+        WITH ranked AS (
+            SELECT id, school, dep_name, degree, namelist,
+                   row_number() OVER (
+                       PARTITION BY school, dep_name ORDER BY (namelist IS NOT NULL) DESC, id DESC
+                   ) AS rn,
+                   count(*) OVER (PARTITION BY school, dep_name) AS copies
+            FROM schools
+        ),
+        dup AS (
+            SELECT * FROM ranked WHERE copies > 1
+        ),
+        namelist_items AS (
+            SELECT DISTINCT ON (d.school, d.dep_name, item.key) d.school, d.dep_name, item.key, item.value
+            FROM dup d
+            CROSS JOIN LATERAL jsonb_each(pg_temp.namelist_object(d.namelist)) AS item
+            ORDER BY d.school, d.dep_name, item.key, d.rn
+        ),
+        merged_namelists AS (
+            SELECT school, dep_name, jsonb_object_agg(key, value)::text AS namelist
+            FROM namelist_items
+            GROUP BY school, dep_name
+        ),
+        degree_items AS (
+            SELECT d.school, d.dep_name, trim(x) AS degree, min(ARRAY[d.rn, u.ord]) AS ord
+            FROM dup d
+            CROSS JOIN LATERAL unnest(string_to_array(d.degree, ',')) WITH ORDINALITY AS u(x, ord)
+            WHERE trim(x) <> ''
+            GROUP BY d.school, d.dep_name, trim(x)
+        ),
+        merged_degrees AS (
+            SELECT school, dep_name, string_agg(degree, ',' ORDER BY ord) AS degree
+            FROM degree_items
+            GROUP BY school, dep_name
+        )
+        UPDATE schools s
+        SET namelist = COALESCE(mn.namelist, s.namelist),
+            degree = COALESCE(md.degree, s.degree)
+        FROM dup k
+        LEFT JOIN merged_namelists mn ON mn.school = k.school AND mn.dep_name = k.dep_name
+        LEFT JOIN merged_degrees md ON md.school = k.school AND md.dep_name = k.dep_name
+        WHERE s.id = k.id AND k.rn = 1
+        """,
+        """
+        DELETE FROM schools s
+        USING (
+            SELECT id,
+                   row_number() OVER (
+                       PARTITION BY school, dep_name ORDER BY (namelist IS NOT NULL) DESC, id DESC
+                   ) AS rn
+            FROM schools
+        ) ranked
+        WHERE s.id = ranked.id AND ranked.rn > 1
+        """,
+        # 系所查詢：WHERE school = :school AND dep_name = :department，程式假設每個系所只有一列
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS schools_school_dep_key
+            ON schools (school, dep_name) INCLUDE (degree)
+        """,
+        # 同時送出兩次志願時，舊的「先刪再寫」可能留下同一個志願序兩筆：保留最新的
+        """
+        DELETE FROM user_choices c
+        USING (
+            SELECT id,
+                   row_number() OVER (PARTITION BY user_id, rank ORDER BY created_at DESC, id DESC) AS rn
+            FROM user_choices
+        ) ranked
+        WHERE c.id = ranked.id AND ranked.rn > 1
+        """,
+        # 使用者志願：WHERE user_id = :user_id ORDER BY rank，每個志願序只會有一筆
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS user_choices_user_rank_key
+            ON user_choices (user_id, rank) INCLUDE (school, department, degree)
+        """,
+        # 系所統計：WHERE school, department, degree [AND rank ...] 的 COUNT(*) 可走 index-only scan
+        """
+        CREATE INDEX IF NOT EXISTS user_choices_dep_rank_idx
+            ON user_choices (school, department, degree, rank)
+        """,
+    ]),
+    (3, "department_stats", [
+        """
+        CREATE TABLE IF NOT EXISTS department_stats (
+            school TEXT NOT NULL,
+            department TEXT NOT NULL,
+            degree TEXT NOT NULL,
+            total_choices INTEGER NOT NULL DEFAULT 0,
+            first_choice INTEGER NOT NULL DEFAULT 0,
+            fifth_and_after INTEGER NOT NULL DEFAULT 0,
+            rank_histogram INTEGER[] NOT NULL DEFAULT '{}',
+            namelist_count INTEGER NOT NULL DEFAULT 0,
+            applicants_per_seat DOUBLE PRECISION GENERATED ALWAYS AS (
+                CASE WHEN namelist_count > 0
+                     THEN total_choices::double precision / namelist_count END
+            ) STORED,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (school, department, degree)
+        )
+        """,
+        # 排行榜：ORDER BY <metric> DESC LIMIT :k
+        "CREATE INDEX IF NOT EXISTS department_stats_total_idx ON department_stats (total_choices DESC)",
+        "CREATE INDEX IF NOT EXISTS department_stats_first_idx ON department_stats (first_choice DESC)",
+        """
+        CREATE INDEX IF NOT EXISTS department_stats_per_seat_idx
+            ON department_stats (applicants_per_seat DESC NULLS LAST)
+        """,
+        # 以 user_choices 與 schools.namelist 填入初始值（SQL 寫在這裡，不隨 rankings.py 改變）
+        _NAMELIST_OBJECT_FUNCTION,
+        """
+        WITH per_rank AS (
+            SELECT school, department, degree, rank, count(*)::int AS cnt
+            FROM user_choices
+            GROUP BY school, department, degree, rank
+        ),
+        choices AS (
+            SELECT school, department, degree,
+                   sum(cnt)::int AS total,
+                   COALESCE(sum(cnt) FILTER (WHERE rank = 1), 0)::int AS first,
+                   COALESCE(sum(cnt) FILTER (WHERE rank >= 5), 0)::int AS fifth,
+                   max(rank) AS max_rank
+            FROM per_rank
+            GROUP BY school, department, degree
+        ),
+        histograms AS (
+            SELECT c.school, c.department, c.degree,
+                   array_agg(COALESCE(p.cnt, 0) ORDER BY r.rank) AS hist
+            FROM choices c
+            CROSS JOIN LATERAL generate_series(1, c.max_rank) AS r(rank)
+            LEFT JOIN per_rank p
+                ON p.school = c.school AND p.department = c.department AND p.degree = c.degree
+               AND p.rank = r.rank
+            GROUP BY c.school, c.department, c.degree
+        ),
+        seats AS (
+            SELECT school, department, degree, count(*)::int AS namelist_count
+            FROM (""" + _NAMELIST_NAMES_SQL + """) names
+            GROUP BY school, department, degree
+        )
+        INSERT INTO department_stats
+            (school, department, degree, total_choices, first_choice, fifth_and_after,
+             rank_histogram, namelist_count, updated_at)
+        SELECT COALESCE(c.school, s.school), COALESCE(c.department, s.department), COALESCE(c.degree, s.degree),
+               COALESCE(c.total, 0), COALESCE(c.first, 0), COALESCE(c.fifth, 0),
+               COALESCE(h.hist, '{}'), COALESCE(s.namelist_count, 0), now()
+        FROM choices c
+        JOIN histograms h ON h.school = c.school AND h.department = c.department AND h.degree = c.degree
+        FULL JOIN seats s ON s.school = c.school AND s.department = c.department AND s.degree = c.degree
+        ON CONFLICT (school, department, degree) DO NOTHING
+        """,
+    ]),
+    (4, "ai_usage", [
+        """
+        CREATE TABLE IF NOT EXISTS ai_usage (
+            id BIGSERIAL PRIMARY KEY,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            model TEXT NOT NULL,
+            operation TEXT NOT NULL,
+            outcome TEXT NOT NULL,
+            school TEXT,
+            department TEXT,
+            degree TEXT,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            output_tokens INTEGER NOT NULL DEFAULT 0,
+            latency_ms DOUBLE PRECISION NOT NULL,
+            cost_usd DOUBLE PRECISION NOT NULL DEFAULT 0
+        )
+        """,
+        # 當日花費：WHERE created_at >= :since
+        "CREATE INDEX IF NOT EXISTS ai_usage_created_idx ON ai_usage (created_at)",
+        # 各系所報表：WHERE created_at >= :since GROUP BY school, department
+        "CREATE INDEX IF NOT EXISTS ai_usage_department_idx ON ai_usage (school, department, created_at)",
+    ]),
+    (5, "ai_singleflight", [
+        # 進行中與剛完成的模型呼叫，key 為 操作:內容雜湊（見 singleflight.py）
+        """
+        CREATE TABLE IF NOT EXISTS ai_singleflight (
+            key TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            result JSONB,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            expires_at TIMESTAMPTZ NOT NULL
+        )
+        """,
+        # 定期清除：WHERE expires_at < :cutoff
+        "CREATE INDEX IF NOT EXISTS ai_singleflight_expires_idx ON ai_singleflight (expires_at)",
+    ]),
+    (6, "namelist_entries", [
+        # 每份名單一列：存在與人數的檢查不需要讀名字
+        """
+        CREATE TABLE IF NOT EXISTS degree_namelists (
+            school TEXT NOT NULL,
+            department TEXT NOT NULL,
+            degree TEXT NOT NULL,
+            name_count INTEGER NOT NULL,
+            has_names BOOLEAN NOT NULL DEFAULT TRUE,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (school, department, degree)
+        )
+        """,
+        # 每個名字一列，分頁：WHERE school, department, degree AND position >= :offset ORDER BY position
+        """
+        CREATE TABLE IF NOT EXISTS namelist_entries (
+            school TEXT NOT NULL,
+            department TEXT NOT NULL,
+            degree TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (school, department, degree, position)
+        )
+        """,
+        # 前綴搜尋：name LIKE '張%'（text_pattern_ops 才能在非 C collation 下用索引）
+        """
+        CREATE INDEX IF NOT EXISTS namelist_entries_prefix_idx
+            ON namelist_entries (school, department, degree, name text_pattern_ops)
+        """,
+        # 從 schools.namelist 填入（SQL 寫在這裡，不隨 namelists.py 改變）
+        _NAMELIST_OBJECT_FUNCTION,
+        """
+        INSERT INTO namelist_entries (school, department, degree, position, name)
+        """ + _NAMELIST_NAMES_SQL + """
+        ON CONFLICT DO NOTHING
+        """,
+        """
+        INSERT INTO degree_namelists (school, department, degree, name_count, has_names, updated_at)
+        SELECT d.school, d.department, d.degree,
+               (SELECT count(*) FROM unnest(string_to_array(d.names, ',')) AS x
+                WHERE regexp_replace(x, '^\\s+|\\s+$', '', 'g') <> '')::int,
+               d.has_names, now()
+        FROM (""" + _NAMELIST_DEGREES_SQL + """) d
+        ON CONFLICT (school, department, degree) DO NOTHING
+        """,
+    ]),
+    (7, "throttle_buckets", [
+        # THROTTLE_SHARED=true 時多台機器共用的限流狀態（見 throttle.py）
+        """
+        CREATE TABLE IF NOT EXISTS throttle_buckets (
+            key TEXT PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        # 清除閒置的桶子：WHERE updated_at < :cutoff
+        "CREATE INDEX IF NOT EXISTS throttle_buckets_updated_idx ON throttle_buckets (updated_at)",
+    ]),
+    (8, "refresh_tokens", [
+        # 只存 token 的 sha256；family_id 為同一次登入輪替出來的所有 token（見 sessions.py）
+        """
+        CREATE TABLE IF NOT EXISTS refresh_tokens (
+            token_hash TEXT PRIMARY KEY,
+            family_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            expires_at TIMESTAMPTZ NOT NULL,
+            used_at TIMESTAMPTZ,
+            revoked_at TIMESTAMPTZ
+        )
+        """,
+        # 偵測重複使用 / 登出時撤銷整個 family
+        "CREATE INDEX IF NOT EXISTS refresh_tokens_family_idx ON refresh_tokens (family_id)",
+        "CREATE INDEX IF NOT EXISTS refresh_tokens_user_idx ON refresh_tokens (user_id)",
+        "CREATE INDEX IF NOT EXISTS refresh_tokens_expires_idx ON refresh_tokens (expires_at)",
+    ]),
+    (9, "email_verifications_unique_email", [
+        # 每個 email 只保留最新的一列；任何一列已使用過就視為已註冊（見 verifications.py）
+        """
+        WITH ranked AS (
+            SELECT id,
+                   bool_or(used) OVER (PARTITION BY email) AS any_used,
+                   row_number() OVER (PARTITION BY email ORDER BY created_at DESC, id DESC) AS rn
+            FROM email_verifications
+        )
+        UPDATE email_verifications v
+        SET used = ranked.any_used
+        FROM ranked
+        WHERE v.id = ranked.id AND ranked.rn = 1 AND v.used <> ranked.any_used
+        """,
+        """
+        DELETE FROM email_verifications v
+        USING (
+            SELECT id, row_number() OVER (PARTITION BY email ORDER BY created_at DESC, id DESC) AS rn
+            FROM email_verifications
+        ) ranked
+        WHERE v.id = ranked.id AND ranked.rn > 1
+        """,
+        # INSERT ... ON CONFLICT (email) 需要 unique index；取代原本的 (email, created_at DESC)
+        "CREATE UNIQUE INDEX IF NOT EXISTS email_verifications_email_key ON email_verifications (email)",
+        "DROP INDEX IF EXISTS email_verifications_email_created_idx",
+        # 驗證碼錯誤的次數，超過 CAPTCHA_MAX_ATTEMPTS 後需要重新申請（見 verifications.py）
+        "ALTER TABLE email_verifications ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (10, "schools_retired_at", [
+        # 官方清單中已不存在的系所（見 load_catalog.py），不再出現在學校 / 系所選單中
+        "ALTER TABLE schools ADD COLUMN IF NOT EXISTS retired_at TIMESTAMPTZ",
+    ]),
+]
+
+
+# 熱門查詢：(名稱, SQL, 範例參數)，check 時不可出現 Seq Scan
+HOT_QUERIES = [
+    ("login", """
+        SELECT * FROM users WHERE email = :email ORDER BY created_at DESC LIMIT 1
+    """, {"email": "someone@gmail.com"}),
+    ("captcha_consume", """
+        UPDATE email_verifications SET used = TRUE
+        WHERE email = :email AND verification_code = :code AND NOT used AND expires_at >= :now
+          AND attempts < :max_attempts
+        RETURNING email
+    """, {"email": "someone@gmail.com", "code": "123456", "now": "2025-01-01T00:00:00", "max_attempts": 5}),
+    ("school_department", """
+        SELECT namelist, degree FROM schools WHERE school = :school AND dep_name = :department LIMIT 1
+    """, {"school": "國立臺灣大學", "department": "電機工程學系"}),
+    ("departments_of_school", """
+        SELECT DISTINCT dep_name FROM schools WHERE school = :school AND retired_at IS NULL ORDER BY dep_name
+    """, {"school": "國立臺灣大學"}),
+    ("user_choices", """
+        SELECT school, department, degree FROM user_choices WHERE user_id = :user_id ORDER BY rank
+    """, {"user_id": 1}),
+    ("department_total", """
+        SELECT COUNT(*) FROM user_choices
+        WHERE school = :school AND department = :department AND degree = :degree
+    """, {"school": "國立臺灣大學", "department": "電機工程學系", "degree": "碩士班"}),
+    ("department_stats", """
+        SELECT * FROM department_stats
+        WHERE school = :school AND department = :department AND degree = :degree
+    """, {"school": "國立臺灣大學", "department": "電機工程學系", "degree": "碩士班"}),
+    ("department_ranking", """
+        SELECT * FROM department_stats WHERE total_choices > 0 ORDER BY total_choices DESC LIMIT 20
+    """, {}),
+    ("department_ranking_per_seat", """
+        SELECT * FROM department_stats WHERE applicants_per_seat > 0
+        ORDER BY applicants_per_seat DESC NULLS LAST LIMIT 20
+    """, {}),
+    ("department_first_choice", """
+        SELECT COUNT(*) FROM user_choices
+        WHERE school = :school AND department = :department AND degree = :degree AND rank = 1
+    """, {"school": "國立臺灣大學", "department": "電機工程學系", "degree": "碩士班"}),
+    ("department_fifth_and_after", """
+        SELECT COUNT(*) FROM user_choices
+        WHERE school = :school AND department = :department AND degree = :degree AND rank >= 5
+    """, {"school": "國立臺灣大學", "department": "電機工程學系", "degree": "碩士班"}),
+    ("namelist_meta", """
+        SELECT name_count, has_names FROM degree_namelists
+        WHERE school = :school AND department = :department AND degree = :degree
+    """, {"school": "國立臺灣大學", "department": "電機工程學系", "degree": "碩士班"}),
+    ("namelist_page", """
+        SELECT name FROM namelist_entries
+        WHERE school = :school AND department = :department AND degree = :degree AND position >= :offset
+        ORDER BY position LIMIT :limit
+    """, {"school": "國立臺灣大學", "department": "電機工程學系", "degree": "碩士班", "offset": 100, "limit": 51}),
+    ("namelist_prefix", """
+        SELECT name FROM namelist_entries
+        WHERE school = :school AND department = :department AND degree = :degree AND name LIKE :pattern
+        ORDER BY position OFFSET 0 LIMIT :limit
+    """, {"school": "國立臺灣大學", "department": "電機工程學系", "degree": "碩士班", "pattern": "張%", "limit": 51}),
+    ("refresh_token", """
+        UPDATE refresh_tokens SET used_at = now()
+        WHERE token_hash = :token_hash AND used_at IS NULL AND revoked_at IS NULL AND expires_at > now()
+        RETURNING family_id, user_id
+    """, {"token_hash": "0" * 64}),
+    ("ai_spend_today", """
+        SELECT COALESCE(SUM(cost_usd), 0) FROM ai_usage WHERE created_at >= :since
+    """, {"since": "2025-01-01T00:00:00+08:00"}),
+]
+# 排行榜 ORDER BY ... LIMIT 必須直接依索引順序讀取前 K 筆，不可出現 Sort（ORDER BY 與索引的 NULLS 順序不同時會發生）
+INDEX_ORDERED_QUERIES = {"department_ranking", "department_ranking_per_seat"}
+
+
+def _ensure_version_table(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """))
+
+
+def applied_versions(engine):
+    """回傳已套用的 migration 版本集合"""
+    with engine.begin() as conn:
+        _ensure_version_table(conn)
+        rows = conn.execute(text("SELECT version FROM schema_migrations")).fetchall()
+    return {r[0] for r in rows}
+
+
+def upgrade(engine, target=None, log=print):
+    """依序套用尚未執行的 migration，每個版本一個交易；回傳本次套用的版本清單"""
+    applied = []
+    for version, name, steps in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            _ensure_version_table(conn)
+            done = conn.execute(
+                text("SELECT 1 FROM schema_migrations WHERE version = :version"),
+                {"version": version}
+            ).fetchone()
+            if done:
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(text(step))
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                {"version": version, "name": name}
+            )
+        log(f"[MIGRATION] 已套用 {version:04d}_{name}")
+        applied.append(version)
+    return applied
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def check_query_plans(engine):
+    """以 EXPLAIN 檢查 HOT_QUERIES，回傳 [(查詢名稱, 問題)]，空清單代表全部通過
+
+    小表時 planner 本來就偏好 Seq Scan，因此檢查時關閉 enable_seqscan：
+    若仍選擇 Seq Scan，代表沒有任何可用的索引。
+    INDEX_ORDERED_QUERIES 中的查詢另外不可出現 Sort（排序沒有走索引）。
+    """
+    failures = []
+    with engine.connect() as conn:
+        with conn.begin() as trans:
+            conn.execute(text("SET LOCAL enable_seqscan = off"))
+            for name, sql, params in HOT_QUERIES:
+                row = conn.execute(text("EXPLAIN (FORMAT JSON) " + sql), params).fetchone()
+                plan = row[0] if not isinstance(row[0], str) else json.loads(row[0])
+                for node in _plan_nodes(plan[0]["Plan"]):
+                    if node.get("Node Type") == "Seq Scan":
+                        failures.append((name, f"Seq Scan on {node.get('Relation Name')}"))
+                    elif node.get("Node Type") in ("Sort", "Incremental Sort") and name in INDEX_ORDERED_QUERIES:
+                        failures.append((name, f"Sort on {', '.join(node.get('Sort Key', []))}"))
+            trans.rollback()
+    return failures
+
+
+def main(argv=None):
+    import argparse
+    import db
+
+    parser = argparse.ArgumentParser(description="資料庫 schema migration")
+    parser.add_argument("command", choices=["upgrade", "status", "check"])
+    parser.add_argument("--target", type=int, default=None, help="只升級到指定版本")
+    args = parser.parse_args(argv)
+
+    db.load_env()
+    engine = db.create_db_engine(os.getenv("DATABASE_URL"))
+
+    if args.command == "upgrade":
+        try:
+            applied = upgrade(engine, target=args.target)
+        except MigrationError as e:
+            print(f"[ERROR] {e}")
+            return 1
+        if not applied:
+            print("[MIGRATION] 已是最新版本")
+        return 0
+
+    if args.command == "status":
+        done = applied_versions(engine)
+        for version, name, _ in MIGRATIONS:
+            print(f"{'[x]' if version in done else '[ ]'} {version:04d}_{name}")
+        return 0
+
+    failures = check_query_plans(engine)
+    for name, problem in failures:
+        print(f"[FAIL] {name}: {problem}")
+    if failures:
+        return 1
+    print(f"[OK] {len(HOT_QUERIES)} 個熱門查詢皆使用索引")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""跨系所的姓名反查索引：哪些 (school, department, degree) 的名單含有與我相符的名字
+
+完整名字直接以 dict 查詢；含 * 遮蔽的名字依「長度 + 遮蔽位置」分桶，
+查詢時把使用者名字套上該長度出現過的每一種遮蔽樣式（例如 (1,) 代表第二個字被遮），
+得到的字串（例如「張*睿」）再到對應的桶中查詢。遮蔽樣式的種類很少，
+因此一次查詢只需要少量 dict 查找，與名單數量無關。
+
+過期後由一個執行緒在鎖外建好新的索引再換上（見 reloader.py），期間的查詢使用舊的索引；
+載入期間上傳的名單在換上後再套用一次。
+"""
+import threading
+import time
+from sqlalchemy import text
+import namelists
+from reloader import Reloader
+
+
+def _mask_positions(name):
+    return tuple(i for i, c in enumerate(name) if c == '*')
+
+
+def _apply_mask(name, positions):
+    chars = list(name)
+    for i in positions:
+        chars[i] = '*'
+    return ''.join(chars)
+
+
+class NameIndex:
+    def __init__(self, max_age=600):
+        self.max_age = max_age
+        self.loaded = False
+        self.loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._reloader = Reloader()
+        # 載入中時為 list，收集期間上傳的名單，載入完成後重新套用
+        self._pending = None
+        self._clear()
+
+    def _clear(self):
+        self._exact = {}
+        self._masked = {}
+        self._patterns = {}
+        self._lists = {}
+
+    def is_stale(self):
+        return not self.loaded or time.monotonic() - self.loaded_at > self.max_age
+
+    def ensure_loaded(self, connect):
+        """過期時重新載入；connect() 回傳資料庫連線的 context manager"""
+        self._reloader.ensure(self.is_stale, lambda: self.loaded, self.load, connect)
+
+    def load(self, conn):
+        """從 schools.namelist 重建整個索引"""
+        with self._lock:
+            self._pending = []
+        try:
+            self._load(conn)
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def _load(self, conn):
+        rows = conn.execute(text("""
+            SELECT school, dep_name, namelist
+            FROM schools
+            WHERE namelist IS NOT NULL AND namelist <> ''
+        """)).fetchall()
+        fresh = NameIndex(self.max_age)
+        for school, department, namelist_raw in rows:
+            for degree, degree_data in namelists.parse_namelist_column(namelist_raw).items():
+                if degree is None or not degree_data["has_names"]:
+                    continue
+                fresh._add((school, department, degree), namelists.split_names(degree_data["names"]))
+        with self._lock:
+            self._exact, self._masked = fresh._exact, fresh._masked
+            self._patterns, self._lists = fresh._patterns, fresh._lists
+            # set_list 是替換整份名單，重複套用結果相同
+            pending, self._pending = self._pending, None
+            for key, names, has_names in pending:
+                self._set_list(key, names, has_names)
+            self.loaded = True
+            self.loaded_at = time.monotonic()
+
+    def _add(self, key, names):
+        names = list(dict.fromkeys(names))
+        self._lists[key] = names
+        for name in names:
+            positions = _mask_positions(name)
+            if not positions:
+                self._exact.setdefault(name, set()).add(key)
+                continue
+            bucket_key = (len(name), positions)
+            bucket = self._masked.setdefault(bucket_key, {})
+            bucket.setdefault(name, set()).add(key)
+            self._patterns.setdefault(len(name), {})
+            self._patterns[len(name)][positions] = self._patterns[len(name)].get(positions, 0) + 1
+
+    def _remove(self, key):
+        for name in self._lists.pop(key, ()):
+            positions = _mask_positions(name)
+            if not positions:
+                keys = self._exact.get(name)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._exact[name]
+                continue
+            bucket_key = (len(name), positions)
+            bucket = self._masked.get(bucket_key, {})
+            keys = bucket.get(name)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del bucket[name]
+                    if not bucket:
+                        del self._masked[bucket_key]
+            patterns = self._patterns.get(len(name), {})
+            if positions in patterns:
+                patterns[positions] -= 1
+                if patterns[positions] <= 0:
+                    del patterns[positions]
+
+    def set_list(self, key, names, has_names=True):
+        """某個系所學制的名單更新後，只替換該份名單的索引；尚未載入時略過"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((key, names, has_names))
+            if self.loaded:
+                self._set_list(key, names, has_names)
+
+    def _set_list(self, key, names, has_names):
+        self._remove(key)
+        if has_names:
+            self._add(key, names)
+
+    def lookup(self, user_name):
+        """回傳 {(school, department, degree): 名單中相符的名字}"""
+        if not user_name:
+            return {}
+        result = {}
+        with self._lock:
+            for key in self._exact.get(user_name, ()):
+                result[key] = user_name
+            for positions in self._patterns.get(len(user_name), {}):
+                masked = _apply_mask(user_name, positions)
+                for key in self._masked.get((len(user_name), positions), {}).get(masked, ()):
+                    result.setdefault(key, masked)
+        return result
+
+    def summary(self):
+        with self._lock:
+            return {
+                "lists": len(self._lists),
+                "exact_names": len(self._exact),
+                "mask_buckets": len(self._masked),
+            }
@@ -0,0 +1,328 @@
+import json
+import numpy as np
+from sqlalchemy import text
+
+
+def parse_namelist_column(namelist_raw):
+    """解析 schools.namelist 欄位，回傳 {degree: {"names": "A,B", "has_names": bool}}
+
+    相容舊格式：degree 對應的值直接是名單字串；整欄不是 JSON 時視為單一份名單（key 為 None）。
+    """
+    if not namelist_raw or not namelist_raw.strip():
+        return {}
+    try:
+        namelist_dict = json.loads(namelist_raw)
+    except Exception:
+        return {None: {"names": namelist_raw, "has_names": True}}
+    if not isinstance(namelist_dict, dict):
+        return {}
+
+    result = {}
+    for degree, degree_data in namelist_dict.items():
+        if isinstance(degree_data, dict):
+            result[degree] = {
+                "names": degree_data.get("names") or "",
+                "has_names": degree_data.get("has_names", True),
+            }
+        else:
+            result[degree] = {"names": degree_data or "", "has_names": True}
+    return result
+
+
+def degree_names(namelist_raw, degree):
+    """取出指定 degree 的 (名單字串, has_names)，找不到時回傳 ("", True)"""
+    parsed = parse_namelist_column(namelist_raw)
+    degree_data = parsed.get(degree)
+    if degree_data is None and None in parsed:
+        degree_data = parsed[None]
+    if not degree_data:
+        return "", True
+    return degree_data["names"], degree_data["has_names"]
+
+
+def split_names(names_str):
+    """將逗號分隔的名單字串切成名字陣列"""
+    if not names_str or not isinstance(names_str, str):
+        return []
+    return [n.strip() for n in names_str.split(',') if n.strip()]
+
+
+class NameMatcher:
+    """一份名單的比對器：完整名字走 set，含 * 遮蔽的名字依長度分組逐字比對"""
+
+    def __init__(self, names):
+        self.exact = set()
+        self.masked = {}
+        for name in names:
+            if '*' in name:
+                self.masked.setdefault(len(name), []).append(name)
+            else:
+                self.exact.add(name)
+
+    def match(self, user_name):
+        """回傳名單中與 user_name 相符的名字，找不到時回傳 None"""
+        if not user_name:
+            return None
+        if user_name in self.exact:
+            return user_name
+        for name in self.masked.get(len(user_name), ()):
+            if all(name_c == '*' or name_c == user_c for user_c, name_c in zip(user_name, name)):
+                return name
+        return None
+
+
+STAR = ord('*')
+
+
+def _codepoints(names):
+    """把名字陣列轉成 (N, 最大長度) 的 Unicode code point 矩陣與長度陣列"""
+    lengths = np.fromiter((len(n) for n in names), dtype=np.int64, count=len(names))
+    width = int(lengths.max()) if len(names) else 0
+    if width == 0:
+        return np.zeros((len(names), 0), dtype=np.uint32), lengths
+    packed = ''.join(n.ljust(width, '\0') for n in names).encode('utf-32-le')
+    return np.frombuffer(packed, dtype=np.uint32).reshape(len(names), width), lengths
+
+
+def match_name_batch(user_name, name_lists):
+    """一次比對 user_name 與多份名單（* 為遮蔽字元），回傳每份名單中相符的名字，不相符為 None"""
+    result = [None] * len(name_lists)
+    if not user_name or not name_lists:
+        return result
+
+    all_names = []
+    list_ids = []
+    for i, names in enumerate(name_lists):
+        all_names.extend(names)
+        list_ids.extend([i] * len(names))
+    if not all_names:
+        return result
+
+    matrix, lengths = _codepoints(all_names)
+    query = np.frombuffer(user_name.encode('utf-32-le'), dtype=np.uint32)
+    candidates = np.flatnonzero(lengths == len(query))
+    if len(candidates) == 0:
+        return result
+
+    sub = matrix[candidates, :len(query)]
+    exact = (sub == query).all(axis=1)
+    masked = ((sub == query) | (sub == STAR)).all(axis=1)
+    list_ids = np.asarray(list_ids, dtype=np.int64)
+    # 完整名字優先於遮蔽名字
+    for hits in (candidates[masked & ~exact], candidates[exact]):
+        for idx in hits[::-1]:
+            result[list_ids[idx]] = all_names[idx]
+    return result
+
+
+def load_departments(conn, pairs):
+    """以一次查詢取得多個 (school, dep_name) 的 degree 與 namelist 欄位，回傳 {(school, dep_name): row}"""
+    pairs = list(dict.fromkeys(pairs))
+    if not pairs:
+        return {}
+    rows = conn.execute(text("""
+        SELECT s.school, s.dep_name, s.degree, s.namelist
+        FROM schools s
+        JOIN unnest(CAST(:schools AS text[]), CAST(:departments AS text[])) AS p(school, dep_name)
+          ON s.school = p.school AND s.dep_name = p.dep_name
+    """), {
+        "schools": [p[0] for p in pairs],
+        "departments": [p[1] for p in pairs],
+    }).mappings().fetchall()
+    return {(r['school'], r['dep_name']): r for r in rows}
+
+
+def validate_choices(user_name, choices, departments):
+    """批次驗證使用者名字是否在每筆志願的名單中
+
+    choices 為 (school, department, degree, rank) 序列，departments 為 load_departments 的結果。
+    回傳與 choices 對應的 [{is_valid, has_names, status}]，status 為
+    valid / not_in_list / no_namelist / no_names（名單只有准考證號碼，無法驗證）。
+    """
+    results = []
+    pending = []
+    for school, department, degree, rank in choices:
+        row = departments.get((school, department))
+        names_str, has_names = degree_names(row['namelist'], degree) if row else ("", True)
+        names = split_names(names_str)
+        if not names:
+            results.append({"is_valid": False, "has_names": has_names, "status": "no_namelist"})
+        elif not has_names:
+            results.append({"is_valid": True, "has_names": False, "status": "no_names"})
+        else:
+            results.append(None)
+            pending.append((len(results) - 1, names))
+
+    matched = match_name_batch(user_name, [names for _, names in pending])
+    for (i, _), name in zip(pending, matched):
+        results[i] = {
+            "is_valid": name is not None,
+            "has_names": True,
+            "status": "valid" if name is not None else "not_in_list",
+        }
+    return results
+
+
+def save_degree_namelist(conn, school, department, degree, names, has_names):
+    """將某系所某學制的名單寫入 schools.namelist（保留其他 degree），並同步 degree 欄位與名單人數
+
+    以 FOR UPDATE 鎖住該系所，避免同時上傳不同 degree 時互相覆蓋。
+    回傳是否找到該系所。
+    """
+    import rankings
+
+    row = conn.execute(text("""
+        SELECT namelist, degree
+        FROM schools
+        WHERE school = :school AND dep_name = :department
+        LIMIT 1
+        FOR UPDATE
+    """), {"school": school, "department": department}).mappings().fetchone()
+    if not row:
+        return False
+
+    # 初始化或更新 namelist dict，保留其他 degree
+    namelist_dict = {}
+    if row['namelist']:
+        namelist_dict = json.loads(row['namelist'])
+
+    # 只更新指定 degree 的名單（新格式：包含 names 和 has_names）
+    namelist_dict[degree] = {
+        "names": ','.join(names),
+        "has_names": has_names
+    }
+
+    # 更新 degree 欄位：確保傳入的 degree 在 degree 欄位中
+    degree_list = [d.strip() for d in (row['degree'] or '').split(',') if d.strip()]
+    if degree not in degree_list:
+        degree_list.append(degree)
+
+    conn.execute(text("""
+        UPDATE schools
+        SET namelist = :namelist, degree = :degree
+        WHERE school = :school AND dep_name = :department
+    """), {
+        "namelist": json.dumps(namelist_dict, ensure_ascii=False),
+        "degree": ','.join(degree_list),
+        "school": school,
+        "department": department
+    })
+    rankings.set_namelist_count(conn, school, department, degree, len(names))
+    replace_entries(conn, school, department, degree, names, has_names)
+    return True
+
+
+# ---------- 逐筆名單（namelist_entries / degree_namelists） ----------
+# schools.namelist 的逗號字串每次都要整份讀出來；分頁、計數與前綴搜尋改讀這兩張表：
+#   degree_namelists   每份名單一列（人數、has_names），存在與否的檢查只讀這一列
+#   namelist_entries   每個名字一列，position 為在名單中的順序（0 起算），分頁以 position 範圍走主鍵
+ENTRY_BATCH_ROWS = 50000
+
+_INSERT_ENTRIES_SQL = text("""
+    INSERT INTO namelist_entries (school, department, degree, position, name)
+    SELECT * FROM unnest(CAST(:schools AS text[]), CAST(:departments AS text[]),
+                         CAST(:degrees AS text[]), CAST(:positions AS int[]), CAST(:names AS text[]))
+""")
+
+_UPSERT_META_SQL = text("""
+    INSERT INTO degree_namelists (school, department, degree, name_count, has_names, updated_at)
+    VALUES (:school, :department, :degree, :count, :has_names, now())
+    ON CONFLICT (school, department, degree) DO UPDATE SET
+        name_count = EXCLUDED.name_count,
+        has_names = EXCLUDED.has_names,
+        updated_at = now()
+""")
+
+
+def _insert_entries(conn, rows):
+    """rows 為 (school, department, degree, position, name)，以陣列參數分批寫入"""
+    for start in range(0, len(rows), ENTRY_BATCH_ROWS):
+        batch = rows[start:start + ENTRY_BATCH_ROWS]
+        conn.execute(_INSERT_ENTRIES_SQL, {
+            "schools": [r[0] for r in batch],
+            "departments": [r[1] for r in batch],
+            "degrees": [r[2] for r in batch],
+            "positions": [r[3] for r in batch],
+            "names": [r[4] for r in batch],
+        })
+
+
+def replace_entries(conn, school, department, degree, names, has_names):
+    """以新名單取代該系所學制的逐筆名單（在 save_degree_namelist 的交易中呼叫）"""
+    conn.execute(text("""
+        DELETE FROM namelist_entries
+        WHERE school = :school AND department = :department AND degree = :degree
+    """), {"school": school, "department": department, "degree": degree})
+    _insert_entries(conn, [(school, department, degree, i, name) for i, name in enumerate(names)])
+    conn.execute(_UPSERT_META_SQL, {
+        "school": school, "department": department, "degree": degree,
+        "count": len(names), "has_names": has_names,
+    })
+
+
+def rebuild_entries(conn):
+    """從 schools.namelist 重建 namelist_entries 與 degree_namelists（migration 與產生測試資料用）"""
+    conn.execute(text("TRUNCATE namelist_entries, degree_namelists"))
+    entries = []
+    meta = []
+    for school, department, namelist_raw in conn.execute(text("""
+        SELECT school, dep_name, namelist
+        FROM schools
+        WHERE namelist IS NOT NULL AND namelist <> ''
+    """)).fetchall():
+        for degree, degree_data in parse_namelist_column(namelist_raw).items():
+            if degree is None:
+                continue
+            names = split_names(degree_data["names"])
+            entries.extend((school, department, degree, i, name) for i, name in enumerate(names))
+            meta.append({"school": school, "department": department, "degree": degree,
+                         "count": len(names), "has_names": degree_data["has_names"]})
+    _insert_entries(conn, entries)
+    if meta:
+        conn.execute(_UPSERT_META_SQL, meta)
+    return len(meta)
+
+
+def namelist_meta(conn, school, department, degree):
+    """回傳 {"count", "has_names"}，沒有名單時回傳 None"""
+    row = conn.execute(text("""
+        SELECT name_count, has_names
+        FROM degree_namelists
+        WHERE school = :school AND department = :department AND degree = :degree
+    """), {"school": school, "department": department, "degree": degree}).fetchone()
+    if not row or not row.name_count:
+        return None
+    return {"count": row.name_count, "has_names": row.has_names}
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def page_names(conn, school, department, degree, offset=0, limit=100, prefix=None):
+    """回傳 (names, 是否還有下一頁)
+
+    沒有 prefix 時以 position 範圍查詢，不論 offset 多大都只讀 limit + 1 列；
+    有 prefix 時走 (school, department, degree, name) 索引，只掃描符合前綴的名字。
+    """
+    params = {"school": school, "department": department, "degree": degree,
+              "offset": offset, "limit": limit + 1}
+    if prefix:
+        params["pattern"] = _escape_like(prefix) + "%"
+        rows = conn.execute(text("""
+            SELECT name FROM namelist_entries
+            WHERE school = :school AND department = :department AND degree = :degree
+              AND name LIKE :pattern
+            ORDER BY position
+            OFFSET :offset LIMIT :limit
+        """), params).fetchall()
+    else:
+        rows = conn.execute(text("""
+            SELECT name FROM namelist_entries
+            WHERE school = :school AND department = :department AND degree = :degree
+              AND position >= :offset
+            ORDER BY position
+            LIMIT :limit
+        """), params).fetchall()
+    names = [r[0] for r in rows[:limit]]
+    return names, len(rows) > limit
@@ -0,0 +1,204 @@
+"""系所之間的共同報名人數（稀疏矩陣）
+
+overlap[a, b] = 同時填了系所 a 與系所 b 的使用者人數。
+以 CSR（indptr / indices / data 三個 NumPy 陣列）儲存，記憶體只隨非零組合數成長；
+新送出的志願先累積在 delta 中，查詢時與 CSR 合併，累積過多時再壓回 CSR。
+過期後由一個執行緒重新載入（見 reloader.py），載入期間送出的志願在新的矩陣換上後再套用一次。
+"""
+import threading
+import time
+import numpy as np
+from choice_matrix import load_choice_matrix
+from reloader import Reloader
+
+
+def _pair_codes(ranks, n):
+    """回傳每位使用者志願中所有 (a, b) 系所組合的編碼 a * n + b（雙向、已去除同系所重複）"""
+    valid = ranks >= 0
+    codes = []
+    for i in range(ranks.shape[1]):
+        for j in range(i + 1, ranks.shape[1]):
+            mask = valid[:, i] & valid[:, j] & (ranks[:, i] != ranks[:, j])
+            if not mask.any():
+                continue
+            a = ranks[mask, i].astype(np.int64)
+            b = ranks[mask, j].astype(np.int64)
+            codes.append(a * n + b)
+            codes.append(b * n + a)
+    if not codes:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(codes)
+
+
+def _dedupe_rows(ranks):
+    """同一使用者重複填同一系所時只保留第一次"""
+    ranks = ranks.copy()
+    for j in range(1, ranks.shape[1]):
+        dup = (ranks[:, :j] == ranks[:, j:j + 1]).any(axis=1) & (ranks[:, j] >= 0)
+        ranks[dup, j] = -1
+    return ranks
+
+
+class OverlapMatrix:
+    def __init__(self, max_age=600, compact_threshold=50000):
+        self.max_age = max_age
+        self.compact_threshold = compact_threshold
+        self.matrix = None
+        self.loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._reloader = Reloader()
+        # 載入中時為 list，收集期間送出的志願，載入完成後重新套用
+        self._pending = None
+        self._n = 0
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.data = np.zeros(0, dtype=np.int32)
+        self.applicants = np.zeros(0, dtype=np.int64)
+        self._delta = {}
+        self._delta_size = 0
+
+    def is_stale(self):
+        return self.matrix is None or time.monotonic() - self.loaded_at > self.max_age
+
+    def ensure_loaded(self, connect):
+        """過期時重新載入；connect() 回傳資料庫連線的 context manager"""
+        self._reloader.ensure(self.is_stale, lambda: self.matrix is not None, self.load, connect)
+
+    def load(self, conn):
+        """從 user_choices 一次建立整個 CSR"""
+        with self._lock:
+            self._pending = []
+        try:
+            self._load(conn)
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def _load(self, conn):
+        matrix = load_choice_matrix(conn)
+        ranks = _dedupe_rows(matrix.ranks)
+        n = matrix.n_departments
+        codes = _pair_codes(ranks, n)
+        indptr, indices, data = self._csr_from_codes(codes, n)
+        valid = ranks >= 0
+        applicants = np.bincount(ranks[valid], minlength=n).astype(np.int64)
+        with self._lock:
+            self.matrix = matrix
+            self._n = n
+            self.indptr, self.indices, self.data = indptr, indices, data
+            self.applicants = applicants
+            self._delta = {}
+            self._delta_size = 0
+            # 以新舊志願的差異更新，已經包含在剛讀到的資料中的志願重複套用時差異為空
+            pending, self._pending = self._pending, None
+            for args in pending:
+                self._update_user(*args)
+            self.loaded_at = time.monotonic()
+
+    @staticmethod
+    def _csr_from_codes(codes, n, counts=None):
+        if len(codes):
+            codes, inverse = np.unique(codes, return_inverse=True)
+            if counts is None:
+                values = np.bincount(inverse)
+            else:
+                values = np.bincount(inverse, weights=counts).astype(np.int64)
+            keep = values != 0
+            codes, values = codes[keep], values[keep]
+        else:
+            values = np.zeros(0, dtype=np.int64)
+        rows = codes // n if n else codes
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+        return indptr, (codes % n if n else codes).astype(np.int32), values.astype(np.int32)
+
+    def _compact(self):
+        """把 delta 合併回 CSR（系所數量可能已經增加）"""
+        n = self.matrix.n_departments
+        row_of = np.repeat(np.arange(self._n, dtype=np.int64), np.diff(self.indptr))
+        base_codes = row_of * n + self.indices
+        delta_codes = []
+        delta_counts = []
+        for a, cols in self._delta.items():
+            for b, count in cols.items():
+                delta_codes.append(a * n + b)
+                delta_counts.append(count)
+        codes = np.concatenate([base_codes, np.asarray(delta_codes, dtype=np.int64)])
+        counts = np.concatenate([self.data.astype(np.int64), np.asarray(delta_counts, dtype=np.int64)])
+        self.indptr, self.indices, self.data = self._csr_from_codes(codes, n, counts)
+        self._n = n
+        self._delta = {}
+        self._delta_size = 0
+
+    def _add_pairs(self, depts, sign):
+        for a in depts:
+            row = self._delta.setdefault(a, {})
+            for b in depts:
+                if a != b:
+                    if b not in row:
+                        self._delta_size += 1
+                    row[b] = row.get(b, 0) + sign
+            if a < len(self.applicants):
+                self.applicants[a] += sign
+
+    def update_user(self, user_id, user_name, keys):
+        """使用者送出新志願後，以新舊志願的差異更新矩陣；尚未載入時略過"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((user_id, user_name, keys))
+            if self.matrix is not None:
+                self._update_user(user_id, user_name, keys)
+
+    def _update_user(self, user_id, user_name, keys):
+        m = self.matrix
+        row = m.user_index.get(user_id)
+        old = [] if row is None else list(dict.fromkeys(int(d) for d in m.ranks[row] if d >= 0))
+        row = m.set_user_choices(user_id, user_name, keys)
+        new = list(dict.fromkeys(int(d) for d in m.ranks[row] if d >= 0))
+        if len(self.applicants) < m.n_departments:
+            self.applicants = np.concatenate([
+                self.applicants, np.zeros(m.n_departments - len(self.applicants), dtype=np.int64)
+            ])
+        self._add_pairs(old, -1)
+        self._add_pairs(new, 1)
+        if self._delta_size > self.compact_threshold:
+            self._compact()
+
+    def top_overlaps(self, key, limit=10):
+        """回傳與 key 共同報名人數最多的系所：[(key, 人數), ...]；key 不存在時回傳 None"""
+        with self._lock:
+            if self.matrix is None:
+                return None
+            a = self.matrix.key_index.get(key)
+            if a is None:
+                return None
+            counts = {}
+            if a < self._n:
+                start, end = self.indptr[a], self.indptr[a + 1]
+                counts = dict(zip(self.indices[start:end].tolist(), self.data[start:end].tolist()))
+            for b, delta in self._delta.get(a, {}).items():
+                counts[b] = counts.get(b, 0) + delta
+            items = [(b, c) for b, c in counts.items() if c > 0]
+            if len(items) > limit:
+                cols = np.fromiter((b for b, _ in items), dtype=np.int64, count=len(items))
+                vals = np.fromiter((c for _, c in items), dtype=np.int64, count=len(items))
+                top = np.argpartition(-vals, limit)[:limit]
+                items = list(zip(cols[top].tolist(), vals[top].tolist()))
+            items.sort(key=lambda item: (-item[1], item[0]))
+            keys = self.matrix.keys
+            return [(keys[b], int(c)) for b, c in items[:limit]]
+
+    def applicant_count(self, key):
+        with self._lock:
+            a = self.matrix.key_index.get(key) if self.matrix else None
+            if a is None or a >= len(self.applicants):
+                return 0
+            return int(self.applicants[a])
+
+    def summary(self):
+        with self._lock:
+            return {
+                "departments": 0 if self.matrix is None else self.matrix.n_departments,
+                "nonzero_pairs": int(len(self.data)),
+                "pending_updates": self._delta_size,
+            }
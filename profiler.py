@@ -0,0 +1,179 @@
+"""請求層級的取樣式 profiler（輸出 flamegraph 用的 collapsed stack 與 speedscope 檔）
+
+開啟方式（皆未設定時不掛任何 hook，對請求沒有額外負擔）：
+  PROFILE_SAMPLE_RATE   隨機 profile 的請求比例，例如 0.01（預設 0）
+  PROFILE_TOKEN         請求帶 X-Debug-Profile: <PROFILE_TOKEN> 時一定 profile
+其他設定：
+  PROFILE_DIR           輸出目錄（預設 /tmp/profiles），每個端點一個子目錄
+  PROFILE_INTERVAL_MS   取樣間隔（預設 5 毫秒）
+  PROFILE_MAX_FILES     每個端點最多保留幾份（預設 50，超過時刪除最舊的）
+
+被 profile 的請求會另開一條執行緒，每隔固定時間以 sys._current_frames() 讀取處理請求的執行緒的
+call stack 並計數，因此不會像 cProfile 一樣拖慢每一次函式呼叫。
+.collapsed 可用 flamegraph.pl / speedscope 開啟，.speedscope.json 可直接拖進 https://www.speedscope.app。
+回應會帶 X-Profile-File 標頭，內容為輸出檔名（不含副檔名）。
+"""
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """在背景執行緒中定期取樣指定執行緒的 call stack"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.started_at = 0.0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started_at
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            key = tuple(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def collapsed(self):
+        """flamegraph.pl 格式：每行「root;child;leaf 次數」"""
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+    def speedscope(self, name):
+        """speedscope 的 sampled profile 格式（權重單位為秒）"""
+        frames = []
+        frame_index = {}
+        samples = []
+        weights = []
+        for stack, count in self.stacks.items():
+            indices = []
+            for frame_name in stack:
+                if frame_name not in frame_index:
+                    frame_index[frame_name] = len(frames)
+                    frames.append({"name": frame_name})
+                indices.append(frame_index[frame_name])
+            samples.append(indices)
+            weights.append(count * self.interval)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+            "name": name,
+            "exporter": "GraduatedFriends profiler",
+        }
+
+
+def _prune(directory):
+    files = sorted(
+        (f for f in os.listdir(directory) if f.endswith(".collapsed")),
+        key=lambda f: os.path.getmtime(os.path.join(directory, f)),
+    )
+    for f in files[:max(0, len(files) - PROFILE_MAX_FILES)]:
+        base = os.path.join(directory, f[:-len(".collapsed")])
+        for ext in (".collapsed", ".speedscope.json"):
+            try:
+                os.unlink(base + ext)
+            except OSError:
+                pass
+
+
+def write_profile(sampler, endpoint, method):
+    """寫入 PROFILE_DIR/<endpoint>/，回傳檔名（不含副檔名）"""
+    safe_endpoint = re.sub(r"[^A-Za-z0-9_.-]", "_", endpoint or "unmatched")
+    directory = os.path.join(PROFILE_DIR, safe_endpoint)
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{method}-{int(sampler.duration * 1000)}ms"
+    base = os.path.join(directory, name)
+    with open(base + ".collapsed", "w", encoding="utf-8") as f:
+        f.write(sampler.collapsed())
+    with open(base + ".speedscope.json", "w", encoding="utf-8") as f:
+        json.dump(sampler.speedscope(f"{method} {endpoint}"), f, ensure_ascii=False)
+    _prune(directory)
+    return name
+
+
+def _should_profile(request):
+    if PROFILE_TOKEN:
+        import hmac
+        provided = request.headers.get("X-Debug-Profile")
+        if provided and hmac.compare_digest(provided, PROFILE_TOKEN):
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def instrument_app(app):
+    """PROFILE_SAMPLE_RATE 與 PROFILE_TOKEN 都未設定時不做任何事"""
+    if PROFILE_SAMPLE_RATE <= 0 and not PROFILE_TOKEN:
+        return
+    from flask import g, request
+    import metrics
+
+    @app.before_request
+    def _start_profile():
+        if _should_profile(request):
+            g._profiler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000).start()
+
+    @app.after_request
+    def _finish_profile(response):
+        sampler = g.pop("_profiler", None)
+        if sampler is None:
+            return response
+        sampler.stop()
+        try:
+            name = write_profile(sampler, request.endpoint, request.method)
+            response.headers["X-Profile-File"] = name
+            metrics.log_event("profile_written", sample_rate=1.0, endpoint=request.endpoint,
+                              file=name, samples=sampler.samples, ms=round(sampler.duration * 1000, 1))
+        except OSError as e:
+            metrics.log_event("profile_write_failed", level="warning", error=str(e))
+        return response
+
+    @app.teardown_request
+    def _stop_profile(exc):
+        # after_request 沒跑到時（例如回應前就中斷）確保取樣執行緒會結束
+        sampler = g.pop("_profiler", None)
+        if sampler is not None:
+            sampler.stop()
@@ -0,0 +1,226 @@
+"""系所熱門程度排行
+
+department_stats 表以 (school, department, degree) 為 key，保存增量維護的統計：
+填志願人數、第一志願人數、第五志願後人數、各志願序分布（rank_histogram[rank-1]）
+以及名單人數。每次 api_submit_choices 只把新舊志願的差異加減上去，
+排行查詢則直接走 department_stats 上的排序索引，讀取成本為 O(K) 而非掃描 user_choices。
+"""
+import json
+from collections import defaultdict
+from sqlalchemy import text
+import namelists
+
+# 統計有變動時以 pg_notify 廣播變動的 key（交易提交時才送出），見 live_stats.py
+STATS_CHANNEL = "department_stats"
+# NOTIFY payload 上限為 8000 bytes，key 多時分批送
+_NOTIFY_MAX_BYTES = 7000
+
+# 可排序的指標（欄位名稱）-> ORDER BY 子句，必須與 migrations.py 中對應索引的排序完全相同才能走索引
+# （DESC 預設為 NULLS FIRST；applicants_per_seat 可為 NULL，索引為 DESC NULLS LAST）
+RANKING_METRICS = {
+    "total_choices": "total_choices DESC",
+    "first_choice": "first_choice DESC",
+    "applicants_per_seat": "applicants_per_seat DESC NULLS LAST",
+}
+
+_UPSERT_DELTA_SQL = text("""
+    INSERT INTO department_stats
+        (school, department, degree, total_choices, first_choice, fifth_and_after, rank_histogram, updated_at)
+    VALUES
+        (:school, :department, :degree, :total, :first, :fifth, :hist, now())
+    ON CONFLICT (school, department, degree) DO UPDATE SET
+        total_choices = department_stats.total_choices + EXCLUDED.total_choices,
+        first_choice = department_stats.first_choice + EXCLUDED.first_choice,
+        fifth_and_after = department_stats.fifth_and_after + EXCLUDED.fifth_and_after,
+        rank_histogram = ARRAY(
+            SELECT COALESCE(a, 0) + COALESCE(b, 0)
+            FROM unnest(department_stats.rank_histogram, EXCLUDED.rank_histogram)
+                 WITH ORDINALITY AS t(a, b, i)
+            ORDER BY i
+        ),
+        updated_at = now()
+""")
+
+
+def choice_deltas(old_rows, new_rows):
+    """比較新舊志願，回傳 {(school, department, degree): {"total", "first", "fifth", "hist"}}
+
+    old_rows / new_rows 為 (school, department, degree, rank) 的序列；沒有變化的 key 不會出現。
+    """
+    deltas = defaultdict(lambda: {"total": 0, "first": 0, "fifth": 0, "hist": defaultdict(int)})
+    for rows, sign in ((old_rows, -1), (new_rows, 1)):
+        for school, department, degree, rank in rows:
+            d = deltas[(school, department, degree)]
+            d["total"] += sign
+            if rank == 1:
+                d["first"] += sign
+            if rank >= 5:
+                d["fifth"] += sign
+            d["hist"][rank] += sign
+
+    result = {}
+    for key, d in deltas.items():
+        hist = {r: n for r, n in d["hist"].items() if n}
+        if d["total"] or d["first"] or d["fifth"] or hist:
+            result[key] = {"total": d["total"], "first": d["first"], "fifth": d["fifth"], "hist": hist}
+    return result
+
+
+def _hist_array(hist):
+    if not hist:
+        return []
+    arr = [0] * max(hist)
+    for rank, n in hist.items():
+        arr[rank - 1] = n
+    return arr
+
+
+def apply_choice_diff(conn, old_rows, new_rows):
+    """在同一個交易中把使用者志願的差異套用到 department_stats，回傳有變動的 key 清單"""
+    deltas = choice_deltas(old_rows, new_rows)
+    if not deltas:
+        return []
+    conn.execute(_UPSERT_DELTA_SQL, [
+        {
+            "school": school,
+            "department": department,
+            "degree": degree,
+            "total": d["total"],
+            "first": d["first"],
+            "fifth": d["fifth"],
+            "hist": _hist_array(d["hist"]),
+        }
+        for (school, department, degree), d in sorted(deltas.items())
+    ])
+    notify_changed(conn, deltas)
+    return list(deltas)
+
+
+def notify_changed(conn, keys):
+    """通知訂閱中的連線這些 (school, department, degree) 的統計已變動"""
+    batches, batch, size = [], [], 0
+    for key in keys:
+        item = json.dumps(list(key), ensure_ascii=False)
+        if batch and size + len(item.encode("utf-8")) > _NOTIFY_MAX_BYTES:
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(item)
+        size += len(item.encode("utf-8")) + 1
+    if batch:
+        batches.append(batch)
+    if batches:
+        conn.execute(text("SELECT pg_notify(:channel, :payload)"), [
+            {"channel": STATS_CHANNEL, "payload": "[" + ",".join(b) + "]"} for b in batches
+        ])
+
+
+def set_namelist_count(conn, school, department, degree, count):
+    """名單上傳後更新該系所學制的名單人數"""
+    conn.execute(text("""
+        INSERT INTO department_stats (school, department, degree, namelist_count, updated_at)
+        VALUES (:school, :department, :degree, :count, now())
+        ON CONFLICT (school, department, degree) DO UPDATE SET
+            namelist_count = EXCLUDED.namelist_count,
+            updated_at = now()
+    """), {"school": school, "department": department, "degree": degree, "count": count})
+    notify_changed(conn, [(school, department, degree)])
+
+
+def get_stats(conn, school, department, degree):
+    """取得單一系所學制的統計，不存在時回傳 None"""
+    row = conn.execute(text("""
+        SELECT total_choices, first_choice, fifth_and_after, rank_histogram,
+               namelist_count, applicants_per_seat
+        FROM department_stats
+        WHERE school = :school AND department = :department AND degree = :degree
+    """), {"school": school, "department": department, "degree": degree}).mappings().fetchone()
+    return dict(row) if row else None
+
+
+def get_stats_many(conn, keys):
+    """一次取得多個系所學制的統計，回傳 {(school, department, degree): stats}，不存在的 key 不會出現"""
+    keys = list(keys)
+    if not keys:
+        return {}
+    rows = conn.execute(text("""
+        SELECT s.school, s.department, s.degree, s.total_choices, s.first_choice, s.fifth_and_after,
+               s.namelist_count, s.applicants_per_seat
+        FROM unnest(CAST(:schools AS TEXT[]), CAST(:departments AS TEXT[]), CAST(:degrees AS TEXT[]))
+             AS k(school, department, degree)
+        JOIN department_stats s
+          ON s.school = k.school AND s.department = k.department AND s.degree = k.degree
+    """), {
+        "schools": [k[0] for k in keys],
+        "departments": [k[1] for k in keys],
+        "degrees": [k[2] for k in keys],
+    }).mappings().all()
+    return {(r["school"], r["department"], r["degree"]): dict(r) for r in rows}
+
+
+def top_departments(conn, metric="total_choices", limit=20):
+    """依指標回傳前 limit 名的系所，直接走排序索引"""
+    # 指標名稱即欄位名稱；metric 必須是 RANKING_METRICS 的 key
+    order_by = RANKING_METRICS[metric]
+    rows = conn.execute(text(f"""
+        SELECT school, department, degree, total_choices, first_choice, fifth_and_after,
+               rank_histogram, namelist_count, applicants_per_seat
+        FROM department_stats
+        WHERE {metric} > 0
+        ORDER BY {order_by}
+        LIMIT :limit
+    """), {"limit": limit}).mappings().all()
+    return [dict(r) for r in rows]
+
+
+def rebuild(conn):
+    """從 user_choices 與 schools 重新計算整張 department_stats（初次建立或校正用）"""
+    stats = defaultdict(lambda: {"total": 0, "first": 0, "fifth": 0, "hist": {}, "namelist_count": 0})
+
+    rows = conn.execute(text("""
+        SELECT school, department, degree, rank, COUNT(*) AS cnt
+        FROM user_choices
+        GROUP BY school, department, degree, rank
+    """)).fetchall()
+    for school, department, degree, rank, cnt in rows:
+        s = stats[(school, department, degree)]
+        s["total"] += cnt
+        if rank == 1:
+            s["first"] += cnt
+        if rank >= 5:
+            s["fifth"] += cnt
+        s["hist"][rank] = cnt
+
+    for school, department, namelist_raw in conn.execute(text("""
+        SELECT school, dep_name, namelist
+        FROM schools
+        WHERE namelist IS NOT NULL AND namelist <> ''
+    """)).fetchall():
+        for degree, degree_data in namelists.parse_namelist_column(namelist_raw).items():
+            if degree is None:
+                continue
+            count = len(namelists.split_names(degree_data["names"]))
+            if count:
+                stats[(school, department, degree)]["namelist_count"] = count
+
+    conn.execute(text("DELETE FROM department_stats"))
+    if stats:
+        conn.execute(text("""
+            INSERT INTO department_stats
+                (school, department, degree, total_choices, first_choice, fifth_and_after,
+                 rank_histogram, namelist_count, updated_at)
+            VALUES
+                (:school, :department, :degree, :total, :first, :fifth, :hist, :namelist_count, now())
+        """), [
+            {
+                "school": school,
+                "department": department,
+                "degree": degree,
+                "total": s["total"],
+                "first": s["first"],
+                "fifth": s["fifth"],
+                "hist": _hist_array(s["hist"]),
+                "namelist_count": s["namelist_count"],
+            }
+            for (school, department, degree), s in sorted(stats.items())
+        ])
+    return len(stats)
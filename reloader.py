@@ -0,0 +1,30 @@
+"""記憶體內資料（錄取模擬、共同報名矩陣、姓名索引、系所搜尋索引）的重新載入
+
+每個 worker 有數十個執行緒（gunicorn gthread），資料過期時若每個請求都各自重新載入，
+會同時跑數十個完整載入。Reloader 讓同一時間只有一個執行緒載入：
+  - 已經有資料時，其他執行緒不等待，繼續使用舊的資料
+  - 還沒有資料（第一次載入）時，其他執行緒等待載入完成
+  - 取得鎖之後再檢查一次是否過期，等待的執行緒不會在剛載入完後又載入一次
+只有實際載入的執行緒才會開啟資料庫連線。
+"""
+import threading
+
+
+class Reloader:
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def ensure(self, is_stale, has_data, load, connect):
+        """is_stale() 時以 connect() 開啟的連線執行 load(conn)；回傳是否由本執行緒載入"""
+        if not is_stale():
+            return False
+        if not self._lock.acquire(blocking=not has_data()):
+            return False
+        try:
+            if not is_stale():
+                return False
+            with connect() as conn:
+                load(conn)
+            return True
+        finally:
+            self._lock.release()
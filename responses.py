@@ -0,0 +1,165 @@
+"""JSON 序列化與回應壓縮
+
+install(app) 之後：
+  - jsonify / request.get_json 改用 ujson，中文直接輸出 UTF-8（不再是 6 bytes 的 \\uXXXX）
+  - 超過 COMPRESS_MIN_BYTES 的 JSON / 文字回應依 Accept-Encoding 以 br 或 gzip 壓縮
+
+內容很少變動的大型回應（學校 / 系所清單、名單）用 EncodedResponseCache：
+payload 只序列化一次，每種壓縮格式也只壓一次，之後的請求直接送出快取的 bytes。
+
+環境變數：
+  COMPRESS_MIN_BYTES   小於此大小不壓縮（預設 1024）
+  COMPRESS_LEVEL       gzip 壓縮等級（預設 6）
+  BROTLI_QUALITY       brotli 品質（預設 5，快取的回應只壓一次，可以調高）
+"""
+import collections
+import gzip
+import os
+import threading
+import time
+
+import ujson
+from flask import current_app, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import brotli
+except ImportError:  # 列在 requirements.txt；沒有安裝的開發環境只提供 gzip
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+COMPRESSIBLE_TYPES = {"application/json", "text/plain", "text/html", "text/csv"}
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+class UJSONProvider(DefaultJSONProvider):
+    """以 ujson 序列化；date / Decimal / UUID 等型別的處理與 Flask 預設相同"""
+
+    ensure_ascii = False
+
+    def dumps(self, obj, **kwargs):
+        # separators 參數忽略：ujson 預設就是最精簡的格式
+        return ujson.dumps(
+            obj,
+            ensure_ascii=False,
+            escape_forward_slashes=False,
+            sort_keys=kwargs.get("sort_keys", self.sort_keys),
+            indent=kwargs.get("indent") or 0,
+            default=self.default,
+        )
+
+    def loads(self, s, **kwargs):
+        return ujson.loads(s)
+
+
+def negotiate():
+    """依 Accept-Encoding 選 br / gzip，都不接受時回傳 None"""
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def encode(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    # mtime=0 讓相同內容的壓縮結果相同
+    return gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+
+def compress_response(response):
+    """after_request：壓縮夠大的 JSON / 文字回應（串流與已壓縮的回應不處理）"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES
+            or request.method == "HEAD"):
+        return response
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    response.set_data(encode(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+class _Entry:
+    __slots__ = ("body", "encoded", "expires_at", "version")
+
+    def __init__(self, body, expires_at, version):
+        self.body = body
+        self.encoded = {}
+        self.expires_at = expires_at
+        self.version = version
+
+
+class EncodedResponseCache:
+    """序列化後的 JSON 回應快取（LRU，可設定 TTL），每種壓縮格式各壓一次
+
+    version 為內容的版本（例如資料的雜湊）：快取的版本與請求的不同時視為沒有快取，
+    新的內容直接取代同一個 key 的舊版本。
+    """
+
+    def __init__(self, max_entries=256, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def version(self, key):
+        """回傳 key 目前快取的版本（沒有快取時為 None），讓呼叫端只在版本不同時才讀取資料"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.version if entry is not None else None
+
+    def _get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if (entry.version != version
+                    or entry.expires_at is not None and entry.expires_at < time.monotonic()):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def response(self, key, build, status=200, version=None):
+        """key 已快取（且版本相同）時直接送出快取的 bytes，否則以 build() 產生 payload 並序列化"""
+        entry = self._get(key, version)
+        if entry is None:
+            body = (current_app.json.dumps(build()) + "\n").encode("utf-8")
+            entry = _Entry(body, time.monotonic() + self.ttl if self.ttl else None, version)
+            with self._lock:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        encoding = negotiate() if len(entry.body) >= COMPRESS_MIN_BYTES else None
+        data = entry.body
+        if encoding is not None:
+            data = entry.encoded.get(encoding)
+            if data is None:
+                data = entry.encoded[encoding] = encode(entry.body, encoding)
+        response = current_app.response_class(data, status=status, mimetype="application/json")
+        response.vary.add("Accept-Encoding")
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+
+def install(app):
+    app.json = UJSONProvider(app)
+    app.after_request(compress_response)
@@ -0,0 +1,242 @@
+"""登入狀態：短效 access token + 輪替的 refresh token
+
+登入時核對密碼（KDF，耗 CPU）後發兩個 token：
+  access token    JWT，ACCESS_TOKEN_MINUTES 分鐘後過期，內容與原本相同（user_id / name / email）
+  refresh token   隨機字串，資料庫只存 sha256，REFRESH_TOKEN_DAYS 天後過期
+
+access token 過期後前端以 refresh token 呼叫 /api/refresh 換一組新的（一次索引查詢，不必再算 KDF），
+時機為登入回應的 expires_in 秒之前，或任何 API 回 401 且帶 WWW-Authenticate: Bearer error="invalid_token" 時
+（過期的 access token 會帶這個 header，重新 refresh 後重送即可）。
+舊的 refresh token 同時作廢。已作廢的 refresh token 又被拿來使用時，代表可能被竊取，
+同一次登入（family）發出的所有 refresh token 一併撤銷，使用者需要重新登入。
+
+多個分頁同時 refresh 時，晚到的請求帶的是剛作廢的 token：作廢後 REFRESH_REUSE_GRACE_SECONDS 秒內
+再次出現時回傳同一個新 token，不撤銷。新 token 由舊 token 以 HMAC（SECRET_KEY）推導，
+不必保存明文就能再算出同一個；沒有 SECRET_KEY 的人無法從舊 token 算出新 token。
+
+EventSource 無法帶 Authorization header，/api/stats/stream 改用 stream ticket：
+以 access token 換一張 STREAM_TICKET_SECONDS 秒內有效、只能用來訂閱統計的 JWT（aud = stats_stream），
+網址與存取紀錄中不會出現 access token。
+
+密碼 hash / 核對在 KDF_WORKERS 個執行緒中執行，排隊超過 KDF_QUEUE 個時直接回 503，
+不讓登入尖峰佔滿所有 worker 執行緒。
+
+環境變數：
+  ACCESS_TOKEN_MINUTES   預設 15
+  REFRESH_TOKEN_DAYS     預設 30
+  REFRESH_REUSE_GRACE_SECONDS  作廢後仍回傳同一個新 token 的秒數（預設 10）
+  STREAM_TICKET_SECONDS  預設 60
+  KDF_WORKERS            同時計算 KDF 的執行緒數（預設 2）
+  KDF_QUEUE              最多排隊的 KDF 工作數（預設 8）
+  KDF_TIMEOUT_SECONDS    等待 KDF 結果的上限（預設 10）
+"""
+import datetime
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import jwt
+from sqlalchemy import text
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import metrics
+
+ACCESS_TOKEN_MINUTES = int(os.getenv("ACCESS_TOKEN_MINUTES", "15"))
+REFRESH_TOKEN_DAYS = int(os.getenv("REFRESH_TOKEN_DAYS", "30"))
+REFRESH_REUSE_GRACE_SECONDS = int(os.getenv("REFRESH_REUSE_GRACE_SECONDS", "10"))
+STREAM_TICKET_SECONDS = int(os.getenv("STREAM_TICKET_SECONDS", "60"))
+STREAM_TICKET_AUDIENCE = "stats_stream"
+KDF_WORKERS = int(os.getenv("KDF_WORKERS", "2"))
+KDF_QUEUE = int(os.getenv("KDF_QUEUE", "8"))
+KDF_TIMEOUT_SECONDS = float(os.getenv("KDF_TIMEOUT_SECONDS", "10"))
+# 過期或撤銷超過一天的 refresh token 定期刪除
+CLEANUP_INTERVAL_SECONDS = 600
+
+
+class KDFBusy(Exception):
+    """KDF 執行緒與佇列都滿了，或等待超過 KDF_TIMEOUT_SECONDS"""
+
+
+class KDFPool:
+    def __init__(self, workers=KDF_WORKERS, queue=KDF_QUEUE, timeout=KDF_TIMEOUT_SECONDS):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kdf")
+        # 執行中 + 排隊中的工作數上限，工作結束時才釋放（等待逾時的工作仍佔著名額直到算完）
+        self._slots = threading.BoundedSemaphore(workers + queue)
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            metrics.log_event("kdf_busy", level="warning", reason="queue_full")
+            raise KDFBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            metrics.log_event("kdf_busy", level="warning", reason="timeout")
+            raise KDFBusy()
+
+
+kdf_pool = KDFPool()
+
+
+def hash_password(password):
+    return kdf_pool.run(generate_password_hash, password)
+
+
+def check_password(password_hash, password):
+    return kdf_pool.run(check_password_hash, password_hash, password)
+
+
+# ---------- token ----------
+def _digest(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _successor(secret_key, token):
+    """輪替後的新 refresh token：由舊 token 推導，寬限期內重送舊 token 時可以再算出同一個"""
+    mac = hmac.new(secret_key.encode("utf-8"), b"refresh:" + token.encode("utf-8"), hashlib.sha256)
+    return base64.urlsafe_b64encode(mac.digest()).rstrip(b"=").decode("ascii")
+
+
+def access_token(secret_key, user_id, name, email, now=None):
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    payload = {
+        "user_id": user_id,
+        "name": name,
+        "email": email,
+        "exp": now + datetime.timedelta(minutes=ACCESS_TOKEN_MINUTES),
+        "iat": now,
+    }
+    return jwt.encode(payload, secret_key, algorithm="HS256")
+
+
+def decode_access_token(secret_key, token):
+    """驗證 access token 並回傳 payload；無效時丟出 jwt.InvalidTokenError（過期為 ExpiredSignatureError）
+
+    帶 aud 的 JWT（stream ticket）在這裡會被拒絕，不能當作 access token 使用
+    """
+    return jwt.decode(token, secret_key, algorithms=["HS256"])
+
+
+def stream_ticket(secret_key, payload, now=None):
+    """以 access token 的 payload 發一張訂閱統計用的短效票券；連線最長到 access token 過期為止"""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    claims = {
+        "user_id": payload["user_id"],
+        "aud": STREAM_TICKET_AUDIENCE,
+        "exp": now + datetime.timedelta(seconds=STREAM_TICKET_SECONDS),
+        "iat": now,
+        "session_exp": payload.get("exp"),
+    }
+    return jwt.encode(claims, secret_key, algorithm="HS256")
+
+
+def decode_stream_ticket(secret_key, ticket):
+    """驗證 stream ticket 並回傳 payload；access token 沒有 aud，在這裡會被拒絕"""
+    return jwt.decode(ticket, secret_key, algorithms=["HS256"], audience=STREAM_TICKET_AUDIENCE)
+
+
+class SessionStore:
+    def __init__(self):
+        self._cleaned_at = 0.0
+
+    def issue(self, conn, user_id, family_id=None, token=None):
+        """新增一個 refresh token（未指定時隨機產生），回傳明文（只在此時出現，資料庫只存 hash）"""
+        token = token or secrets.token_urlsafe(32)
+        conn.execute(text("""
+            INSERT INTO refresh_tokens (token_hash, family_id, user_id, expires_at)
+            VALUES (:token_hash, :family_id, :user_id, now() + make_interval(days => :days))
+        """), {
+            "token_hash": _digest(token),
+            "family_id": family_id or uuid.uuid4().hex,
+            "user_id": user_id,
+            "days": REFRESH_TOKEN_DAYS,
+        })
+        self._cleanup(conn)
+        return token
+
+    def rotate(self, conn, token, secret_key):
+        """作廢 token 並發一個新的，回傳 (使用者資料, 新 token)；token 無效時回傳 (None, None)
+
+        token 在 REFRESH_REUSE_GRACE_SECONDS 秒內剛被輪替過時（其他分頁同時 refresh），
+        回傳當時發出的同一個新 token，不視為重複使用
+        """
+        token = token or ""
+        token_hash = _digest(token)
+        # 同一個 token 同時送來時，後到的 UPDATE 會等先到的交易提交，之後因 used_at 已設定而不符合
+        row = conn.execute(text("""
+            UPDATE refresh_tokens
+            SET used_at = now()
+            WHERE token_hash = :token_hash AND used_at IS NULL AND revoked_at IS NULL AND expires_at > now()
+            RETURNING family_id, user_id
+        """), {"token_hash": token_hash}).fetchone()
+        rotated = row is not None
+        if not rotated:
+            row = self._recently_rotated(conn, token_hash)
+            if row is None:
+                self._detect_reuse(conn, token_hash)
+                return None, None
+        user = conn.execute(text("SELECT user_id, username, email FROM users WHERE user_id = :user_id"),
+                            {"user_id": row.user_id}).mappings().fetchone()
+        if user is None:
+            return None, None
+        successor = _successor(secret_key, token)
+        if rotated:
+            self.issue(conn, row.user_id, family_id=row.family_id, token=successor)
+        return dict(user), successor
+
+    def _recently_rotated(self, conn, token_hash):
+        """寬限期內剛輪替過、同一次登入也還沒被撤銷的 token，回傳 (family_id, user_id)"""
+        return conn.execute(text("""
+            SELECT family_id, user_id FROM refresh_tokens
+            WHERE token_hash = :token_hash
+              AND used_at > now() - make_interval(secs => :grace)
+              AND revoked_at IS NULL AND expires_at > now()
+        """), {"token_hash": token_hash, "grace": REFRESH_REUSE_GRACE_SECONDS}).fetchone()
+
+    def _detect_reuse(self, conn, token_hash):
+        """已輪替過的 token 又出現：撤銷同一次登入的所有 refresh token"""
+        row = conn.execute(text("""
+            SELECT family_id, user_id FROM refresh_tokens
+            WHERE token_hash = :token_hash AND used_at IS NOT NULL
+        """), {"token_hash": token_hash}).fetchone()
+        if row is None:
+            return
+        revoked = conn.execute(text("""
+            UPDATE refresh_tokens SET revoked_at = now()
+            WHERE family_id = :family_id AND revoked_at IS NULL
+        """), {"family_id": row.family_id}).rowcount
+        metrics.log_event("refresh_token_reuse", level="warning", user_id=row.user_id, revoked=revoked)
+
+    def revoke(self, conn, token):
+        """登出：撤銷 token 所屬登入的所有 refresh token，回傳撤銷的數量"""
+        return conn.execute(text("""
+            UPDATE refresh_tokens SET revoked_at = now()
+            WHERE revoked_at IS NULL AND family_id = (
+                SELECT family_id FROM refresh_tokens WHERE token_hash = :token_hash
+            )
+        """), {"token_hash": _digest(token or "")}).rowcount
+
+    def _cleanup(self, conn):
+        now = time.monotonic()
+        if now - self._cleaned_at < CLEANUP_INTERVAL_SECONDS:
+            return
+        self._cleaned_at = now
+        conn.execute(text("""
+            DELETE FROM refresh_tokens
+            WHERE expires_at < now() - interval '1 day' OR revoked_at < now() - interval '1 day'
+        """))
+
+
+store = SessionStore()
@@ -0,0 +1,236 @@
+"""相同內容的模型呼叫合併（single-flight）
+
+放榜時同系所的人常在同一時間上傳同一份名單，學生證辨識失敗時也會連續重試。
+do(key, fn) 讓相同 key 的並行呼叫只執行一次 fn，其餘等待並共用結果：
+
+  同一個 process       以 threading.Event 等待正在執行的呼叫
+  不同 worker / 機器   以 ai_singleflight 表記錄進行中的 key（configure(engine) 後啟用），
+                       搶 key 時以 pg_advisory_xact_lock 序列化，等待者輪詢該列直到完成
+
+advisory lock 只在交易內持有（xact 版本），經過 PgBouncer transaction pooling 也安全。
+成功的結果保留 SINGLEFLIGHT_RESULT_TTL 秒，期間相同的請求直接取用；失敗的結果只交給正在等待的人，
+下一個請求會重新呼叫。執行者中斷（例如 worker 被砍）時，租約 SINGLEFLIGHT_LEASE_SECONDS 秒後過期，
+由等待者接手。fn 的回傳值必須可以 JSON 序列化。
+
+結果含個人資料時（學生證辨識出的姓名、學校、系所）以 shared=False 呼叫：只在同一個 process 內
+合併進行中的呼叫，結果不寫入 ai_singleflight，也不保留給之後的請求。
+
+環境變數：
+  SINGLEFLIGHT_RESULT_TTL      成功結果保留秒數（預設 600，0 = 只合併進行中的呼叫）
+  SINGLEFLIGHT_LEASE_SECONDS   執行者的租約（預設 180，應大於模型呼叫最長的時間）
+  SINGLEFLIGHT_POLL_MS         跨 worker 等待時的輪詢間隔（預設 200）
+"""
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from sqlalchemy import text
+
+import metrics
+
+RESULT_TTL = float(os.getenv("SINGLEFLIGHT_RESULT_TTL", "600"))
+LEASE_SECONDS = float(os.getenv("SINGLEFLIGHT_LEASE_SECONDS", "180"))
+POLL_INTERVAL = float(os.getenv("SINGLEFLIGHT_POLL_MS", "200")) / 1000
+
+# pg_advisory_xact_lock(namespace, hashtext(key))；migration 用的是單一參數版本，不會互相衝突
+LOCK_NAMESPACE = 727274002
+# 已過期的列保留一段時間再刪，讓還在輪詢的等待者讀得到失敗結果
+CLEANUP_GRACE_SECONDS = 600
+CLEANUP_INTERVAL_SECONDS = 300
+
+
+def content_key(operation, *parts):
+    """以內容雜湊組成 key，例如 content_key("namelist", file_bytes, ".pdf", school_dep)"""
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode("utf-8")
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return f"{operation}:{digest.hexdigest()}"
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.engine = None
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._cleaned_at = 0.0
+        self._host = f"{socket.gethostname()}:{os.getpid()}"
+
+    def configure(self, engine):
+        self.engine = engine
+
+    def do(self, key, fn, ok=None, shared=True):
+        """執行 fn() 或等待相同 key 的呼叫；ok(result) 為 False 的結果不保留給之後的請求
+
+        shared=False 時只合併同一個 process 內進行中的呼叫，結果不寫入資料庫
+        """
+        operation = key.split(":", 1)[0]
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.SINGLEFLIGHT.inc(operation=operation, role="local_wait")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run_shared(key, operation, fn, ok, shared)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    # ---------- 跨 worker ----------
+    def _run_shared(self, key, operation, fn, ok, shared):
+        if self.engine is None or not shared:
+            metrics.SINGLEFLIGHT.inc(operation=operation, role="leader")
+            return fn()
+
+        waited = False
+        while True:
+            try:
+                state, value = self._claim(key)
+            except Exception as e:
+                # 資料庫有問題時只在 process 內合併，不影響呼叫本身
+                metrics.log_event("singleflight_claim_failed", level="warning", key=key, error=str(e))
+                metrics.SINGLEFLIGHT.inc(operation=operation, role="leader")
+                return fn()
+
+            if state == "cached":
+                metrics.SINGLEFLIGHT.inc(operation=operation, role="cached")
+                return value
+            if state == "leader":
+                metrics.SINGLEFLIGHT.inc(operation=operation, role="leader")
+                return self._lead(key, value, fn, ok)
+
+            if not waited:
+                metrics.SINGLEFLIGHT.inc(operation=operation, role="remote_wait")
+                waited = True
+            finished, result = self._wait(key)
+            if finished:
+                return result
+            # 執行者的租約過期或放棄了，重新搶 key
+
+    def _claim(self, key):
+        """回傳 ("cached", result) / ("running", None) / ("leader", owner)"""
+        with self.engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:ns, hashtext(:key))"),
+                         {"ns": LOCK_NAMESPACE, "key": key})
+            row = conn.execute(text("""
+                SELECT status, result, expires_at > now() AS live
+                FROM ai_singleflight WHERE key = :key
+            """), {"key": key}).fetchone()
+            if row is not None and row.live:
+                if row.status == "done":
+                    return "cached", row.result
+                if row.status == "running":
+                    return "running", None
+
+            owner = f"{self._host}:{uuid.uuid4().hex[:12]}"
+            conn.execute(text("""
+                INSERT INTO ai_singleflight (key, status, owner, result, started_at, expires_at)
+                VALUES (:key, 'running', :owner, NULL, now(), now() + make_interval(secs => :lease))
+                ON CONFLICT (key) DO UPDATE
+                SET status = 'running', owner = EXCLUDED.owner, result = NULL,
+                    started_at = EXCLUDED.started_at, expires_at = EXCLUDED.expires_at
+            """), {"key": key, "owner": owner, "lease": LEASE_SECONDS})
+        return "leader", owner
+
+    def _lead(self, key, owner, fn, ok):
+        try:
+            result = fn()
+        except Exception:
+            # 讓等待者重新搶 key 自己呼叫，而不是拿到一個空結果
+            self._release(key, owner)
+            raise
+
+        success = ok(result) if ok is not None else True
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text("""
+                    UPDATE ai_singleflight
+                    SET status = :status, result = CAST(:result AS JSONB),
+                        expires_at = now() + make_interval(secs => :ttl)
+                    WHERE key = :key AND owner = :owner
+                """), {
+                    "key": key,
+                    "owner": owner,
+                    "status": "done" if success else "failed",
+                    "result": json.dumps(result, ensure_ascii=False),
+                    "ttl": RESULT_TTL if success else 0,
+                })
+        except Exception as e:
+            metrics.log_event("singleflight_publish_failed", level="warning", key=key, error=str(e))
+            self._release(key, owner)
+        self._cleanup()
+        return result
+
+    def _release(self, key, owner):
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text("DELETE FROM ai_singleflight WHERE key = :key AND owner = :owner"),
+                             {"key": key, "owner": owner})
+        except Exception as e:
+            metrics.log_event("singleflight_release_failed", level="warning", key=key, error=str(e))
+
+    def _wait(self, key):
+        """輪詢到執行者完成，回傳 (True, result)；租約過期或列被刪除時回傳 (False, None)"""
+        while True:
+            time.sleep(POLL_INTERVAL)
+            with self.engine.connect() as conn:
+                row = conn.execute(text("""
+                    SELECT status, result, expires_at > now() AS live
+                    FROM ai_singleflight WHERE key = :key
+                """), {"key": key}).fetchone()
+            if row is None:
+                return False, None
+            if row.status in ("done", "failed"):
+                return True, row.result
+            if not row.live:
+                return False, None
+
+    def _cleanup(self):
+        now = time.monotonic()
+        if now - self._cleaned_at < CLEANUP_INTERVAL_SECONDS:
+            return
+        self._cleaned_at = now
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text("""
+                    DELETE FROM ai_singleflight WHERE expires_at < now() - make_interval(secs => :grace)
+                """), {"grace": CLEANUP_GRACE_SECONDS})
+        except Exception as e:
+            metrics.log_event("singleflight_cleanup_failed", level="warning", error=str(e))
+
+
+flights = SingleFlight()
+
+
+def configure(engine):
+    """設定後相同 key 的呼叫在不同 worker 之間也會合併"""
+    flights.configure(engine)
+
+
+def do(key, fn, ok=None, shared=True):
+    return flights.do(key, fn, ok, shared)
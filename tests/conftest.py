@@ -0,0 +1,29 @@
+"""測試共用設定
+
+執行：python -m pytest tests
+需要資料庫的測試只在設定 TEST_DATABASE_URL 時執行（會清空該資料庫的 public schema）。
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlalchemy import create_engine, text
+
+
+@pytest.fixture
+def engine():
+    """以 migrations 建好 schema 的空資料庫"""
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL 未設定")
+    import migrations
+
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text("DROP SCHEMA public CASCADE"))
+        conn.execute(text("CREATE SCHEMA public"))
+    migrations.upgrade(engine, log=lambda *args: None)
+    yield engine
+    engine.dispose()
@@ -0,0 +1,34 @@
+"""不需要資料庫的假連線：只回應 choice_matrix 與 cascade 載入時的查詢"""
+import json
+
+
+class _Result:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def fetchall(self):
+        return list(self._rows)
+
+
+class FakeConn:
+    """choices 為 {user_id: (username, [(school, department, degree), ...])}，
+    namelists 為 {(school, department): {degree: {"names", "has_names"}}}"""
+
+    def __init__(self, choices, namelists=None):
+        self.choices = choices
+        self.namelists = namelists or {}
+
+    def execute(self, statement, params=None):
+        sql = str(statement)
+        if "FROM user_choices" in sql:
+            return _Result([
+                (user_id, username, rank, school, department, degree)
+                for user_id, (username, keys) in sorted(self.choices.items())
+                for rank, (school, department, degree) in enumerate(keys, 1)
+            ])
+        if "FROM schools" in sql:
+            return _Result([
+                (school, department, json.dumps(namelist, ensure_ascii=False))
+                for (school, department), namelist in self.namelists.items()
+            ])
+        raise AssertionError(f"unexpected query: {sql}")
@@ -0,0 +1,143 @@
+import random
+from collections import Counter
+
+import namelists
+from cascade import CascadeSimulator
+from fakes import FakeConn
+
+SCHOOLS = ["臺大", "清大", "交大", "成大"]
+DEPARTMENTS = ["電機", "資工", "應數"]
+NAMES = ["王小明", "林小茹", "張德睿", "陳大文", "李四", "趙六", "錢七", "孫八"]
+
+
+def _keys(degree="碩士班"):
+    return [(s, d, degree) for s in SCHOOLS for d in DEPARTMENTS]
+
+
+def _random_namelist(rng):
+    names = rng.sample(NAMES, rng.randint(0, 5))
+    # 部分名單遮蔽中間的字
+    names = [n[0] + "*" + n[2:] if len(n) == 3 and rng.random() < 0.3 else n for n in names]
+    return names, rng.random() < 0.9
+
+
+def _random_state(rng, n_users=30):
+    choices = {u: (NAMES[u % len(NAMES)], rng.sample(_keys(), rng.randint(0, 6)))
+               for u in range(1, n_users + 1)}
+    lists = {}
+    for school, department, degree in _keys():
+        if rng.random() < 0.8:
+            names, has_names = _random_namelist(rng)
+            lists[(school, department)] = {degree: {"names": ",".join(names), "has_names": has_names}}
+    return choices, lists
+
+
+def _naive(choices, lists):
+    """逐輪模擬遞補：每人接受最前面的正取 / 備取上的志願，放棄的名額依志願序、user_id 遞補"""
+    matchers = {}
+    for (school, department), namelist in lists.items():
+        for degree, data in namelist.items():
+            names = namelists.split_names(data["names"])
+            if data["has_names"] and names:
+                matchers[(school, department, degree)] = namelists.NameMatcher(names)
+
+    users = sorted(choices)
+    admitted = {u: [matchers.get(k) is None or matchers[k].match(choices[u][0]) is not None
+                    for k in choices[u][1]] for u in users}
+    applicants = Counter(k for u in users for k in choices[u][1])
+    initial = Counter(k for u in users for k, a in zip(choices[u][1], admitted[u]) if a)
+    promoted = Counter()
+    while True:
+        accepted = {u: admitted[u].index(True) for u in users if True in admitted[u]}
+        vacancies = Counter(k for u in users for i, (k, a) in enumerate(zip(choices[u][1], admitted[u]))
+                            if a and accepted[u] != i)
+        waiting = sorted((choices[u][1][i], i, u) for u in users
+                         for i, a in enumerate(admitted[u]) if not a)
+        taken = False
+        used = Counter()
+        for key, i, u in waiting:
+            if used[key] < vacancies[key] - promoted[key]:
+                used[key] += 1
+                admitted[u][i] = True
+                taken = True
+        promoted.update(used)
+        if not taken:
+            break
+    accepted = Counter(choices[u][1][i] for u, i in accepted.items())
+    return {key: {"applicants": applicants[key], "admitted": initial[key],
+                  "projected_accepted": accepted[key], "projected_vacancies": vacancies[key],
+                  "waitlist_promoted": promoted[key]}
+            for key in applicants}
+
+
+def _results(sim, keys):
+    results = {}
+    for key in keys:
+        result = sim.department_result(key)
+        if result is not None and result["applicants"]:
+            result.pop("seats")
+            results[key] = result
+    return results
+
+
+def test_full_run_matches_naive_simulation():
+    for seed in range(20):
+        rng = random.Random(seed)
+        choices, lists = _random_state(rng)
+        sim = CascadeSimulator()
+        sim.load(FakeConn(choices, lists))
+        assert _results(sim, _keys()) == _naive(choices, lists), seed
+
+
+def test_incremental_updates_match_full_rerun():
+    for seed in range(20):
+        rng = random.Random(seed)
+        choices, lists = _random_state(rng)
+        sim = CascadeSimulator()
+        sim.load(FakeConn(choices, lists))
+
+        extra = _keys("博士班")[:3]
+        for _ in range(15):
+            if rng.random() < 0.6:
+                user_id = rng.randint(1, 40)
+                keys = rng.sample(_keys() + extra, rng.randint(0, 6))
+                name = choices.get(user_id, (NAMES[user_id % len(NAMES)],))[0]
+                choices[user_id] = (name, keys)
+                sim.update_user(user_id, name, keys)
+            else:
+                school, department, degree = rng.choice(_keys() + extra)
+                names, has_names = _random_namelist(rng)
+                lists.setdefault((school, department), {})[degree] = {
+                    "names": ",".join(names), "has_names": has_names}
+                sim.update_namelist((school, department, degree), names, has_names)
+
+        fresh = CascadeSimulator()
+        fresh.load(FakeConn(choices, lists))
+        keys = _keys() + extra
+        assert _results(sim, keys) == _results(fresh, keys), seed
+        assert _results(fresh, keys) == _naive(choices, lists), seed
+        for key in keys:
+            result = sim.department_result(key)
+            if result is not None:
+                assert result["seats"] == (fresh.department_result(key) or result)["seats"]
+
+
+def test_updates_during_load_are_replayed():
+    rng = random.Random(7)
+    choices, lists = _random_state(rng)
+    late_keys = _keys()[:3]
+
+    class SlowConn(FakeConn):
+        def execute(self, statement, params=None):
+            result = super().execute(statement, params)
+            if "FROM user_choices" in str(statement):
+                # 讀完志願後、模擬完成前送出的志願
+                sim.update_user(1, choices[1][0], late_keys)
+            return result
+
+    sim = CascadeSimulator()
+    sim.load(SlowConn(choices, lists))
+    choices[1] = (choices[1][0], late_keys)
+    fresh = CascadeSimulator()
+    fresh.load(FakeConn(choices, lists))
+    assert _results(sim, _keys()) == _results(fresh, _keys())
@@ -0,0 +1,74 @@
+import random
+
+from catalog_search import CatalogIndex
+
+SCHOOLS = ["國立臺灣大學", "國立清華大學", "國立陽明交通大學", "國立成功大學", "臺北科技大學", "國立中央大學"]
+DEPARTMENTS = ["電機工程學系", "資訊工程學系", "應用數學系", "電子研究所", "資訊管理學系", "機械工程學系"]
+QUERIES = ["台大 電機", "臺大", "清大 資工", "交大", "資訊", "電機工程學系", "國立", "應數", "科技 機械",
+           "中央 資管", "成大電", "不存在", "學系", "大學 研究所"]
+
+
+def _snapshot(index):
+    """以名稱（而非內部 id）表示的索引內容，增量與重建的 id 不同"""
+    names = index._names
+
+    def trie(node):
+        return {c: (sorted(names[i] for i in child.ids), trie(child)) for c, child in node.children.items()}
+
+    return {
+        "names": sorted(names.values()),
+        "refs": sorted((names[i], n) for i, n in index._refs.items()),
+        "unigrams": {c: sorted(names[i] for i in ids) for c, ids in index._unigrams.items()},
+        "bigrams": {g: sorted(names[i] for i in ids) for g, ids in index._bigrams.items()},
+        "trie": trie(index._trie),
+        "entries": {key: (names[s], names[d], degrees) for key, (s, d, degrees) in index._entries.items()},
+        "keys": list(index._keys),
+    }
+
+
+def _random_rows(rng):
+    rows = []
+    for school in SCHOOLS:
+        for department in rng.sample(DEPARTMENTS, rng.randint(0, len(DEPARTMENTS))):
+            rows.append((school, department, ",".join(rng.sample(["碩士班", "博士班", "在職專班"], rng.randint(1, 2)))))
+    return rows
+
+
+def test_sync_add_remove_matches_fresh_index():
+    for seed in range(20):
+        rng = random.Random(seed)
+        index = CatalogIndex()
+        for _ in range(6):
+            rows = _random_rows(rng)
+            index.sync(rows)
+            fresh = CatalogIndex()
+            fresh.sync(rows)
+            assert _snapshot(index) == _snapshot(fresh), seed
+            for query in QUERIES:
+                assert index.search(query, limit=20) == fresh.search(query, limit=20), (seed, query)
+
+
+def test_sync_reports_added_and_removed():
+    index = CatalogIndex()
+    assert index.sync([("國立臺灣大學", "電機工程學系", "碩士班"), ("國立臺灣大學", "資訊工程學系", "碩士班")]) == (2, 0)
+    assert index.sync([("國立臺灣大學", "電機工程學系", "碩士班,博士班")]) == (0, 1)
+    assert index.search("臺大 電機")[0]["degrees"] == ["碩士班", "博士班"]
+    assert index.search("資訊") == []
+    assert index.sync([]) == (0, 1)
+    assert _snapshot(index) == _snapshot(CatalogIndex())
+
+
+def test_invalidate_during_load_keeps_index_stale():
+    class Conn:
+        def execute(self, statement, params=None):
+            # 讀取之後、同步之前有人修改了目錄
+            index.invalidate()
+            return self
+
+        def fetchall(self):
+            return [("國立臺灣大學", "電機工程學系", "碩士班")]
+
+    index = CatalogIndex()
+    index.load(Conn())
+    assert index.is_stale()
+    assert index.search("臺大")[0]["department"] == "電機工程學系"
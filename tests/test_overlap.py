@@ -0,0 +1,84 @@
+import random
+from collections import Counter
+
+from fakes import FakeConn
+from overlap import OverlapMatrix
+
+KEYS = [(s, d, "碩士班") for s in ["臺大", "清大", "交大", "成大"] for d in ["電機", "資工", "應數"]]
+
+
+def _naive(choices):
+    """每位使用者的志願（同系所只算一次）兩兩配對計數"""
+    pairs = Counter()
+    applicants = Counter()
+    for _, keys in choices.values():
+        keys = list(dict.fromkeys(keys))
+        applicants.update(keys)
+        pairs.update((a, b) for a in keys for b in keys if a != b)
+    return pairs, applicants
+
+
+def _assert_matches(matrix, choices, keys):
+    pairs, applicants = _naive(choices)
+    for a in keys:
+        expected = {b: pairs[(a, b)] for b in keys if pairs[(a, b)]}
+        assert dict(matrix.top_overlaps(a, limit=len(keys)) or []) == expected
+        assert matrix.applicant_count(a) == applicants[a]
+
+
+def _random_choices(rng, keys, n_users=25):
+    # 偶爾重複填同一個系所，驗證去重
+    return {u: (f"user{u}", rng.choices(keys, k=rng.randint(0, 5))) for u in range(1, n_users + 1)}
+
+
+def test_load_matches_naive_counts():
+    for seed in range(10):
+        choices = _random_choices(random.Random(seed), KEYS)
+        matrix = OverlapMatrix()
+        matrix.load(FakeConn(choices))
+        _assert_matches(matrix, choices, KEYS)
+
+
+def test_deltas_and_compaction_match_full_rebuild():
+    extra = [("中央", "資工", "博士班"), ("中興", "應數", "博士班")]
+    for threshold in (0, 5, 50000):
+        for seed in range(10):
+            rng = random.Random(seed)
+            choices = _random_choices(rng, KEYS)
+            matrix = OverlapMatrix(compact_threshold=threshold)
+            matrix.load(FakeConn(choices))
+            for _ in range(20):
+                user_id = rng.randint(1, 35)
+                keys = rng.choices(KEYS + extra, k=rng.randint(0, 5))
+                choices[user_id] = (f"user{user_id}", keys)
+                matrix.update_user(user_id, f"user{user_id}", keys)
+            if threshold == 0:
+                assert matrix.summary()["pending_updates"] == 0
+            _assert_matches(matrix, choices, KEYS + extra)
+
+            fresh = OverlapMatrix()
+            fresh.load(FakeConn(choices))
+            for key in KEYS + extra:
+                # 同數量時依系所編號排序，增量與重建的編號不同，只比較數量
+                assert [c for _, c in matrix.top_overlaps(key, limit=3) or []] == \
+                    [c for _, c in fresh.top_overlaps(key, limit=3) or []]
+
+            matrix._compact()
+            _assert_matches(matrix, choices, KEYS + extra)
+            assert matrix.summary()["nonzero_pairs"] == fresh.summary()["nonzero_pairs"]
+
+
+def test_updates_during_load_are_replayed():
+    rng = random.Random(3)
+    choices = _random_choices(rng, KEYS)
+
+    class SlowConn(FakeConn):
+        def execute(self, statement, params=None):
+            result = super().execute(statement, params)
+            matrix.update_user(1, "user1", KEYS[:4])
+            return result
+
+    matrix = OverlapMatrix()
+    matrix.load(SlowConn(choices))
+    choices[1] = ("user1", KEYS[:4])
+    _assert_matches(matrix, choices, KEYS)
@@ -0,0 +1,53 @@
+import random
+from collections import Counter, defaultdict
+
+import rankings
+
+
+def _full_stats(rows):
+    """不經過差異，直接由志願列計算每個系所的統計"""
+    stats = defaultdict(lambda: {"total": 0, "first": 0, "fifth": 0, "hist": Counter()})
+    for school, department, degree, rank in rows:
+        s = stats[(school, department, degree)]
+        s["total"] += 1
+        s["first"] += rank == 1
+        s["fifth"] += rank >= 5
+        s["hist"][rank] += 1
+    return stats
+
+
+def test_choice_deltas_unchanged_rows_are_omitted():
+    rows = [("A", "X", "碩士班", 1), ("B", "Y", "碩士班", 2)]
+    assert rankings.choice_deltas(rows, list(reversed(rows))) == {}
+
+
+def test_choice_deltas_moving_rank():
+    old = [("A", "X", "碩士班", 1), ("B", "Y", "碩士班", 2)]
+    new = [("B", "Y", "碩士班", 1), ("A", "X", "碩士班", 5)]
+    assert rankings.choice_deltas(old, new) == {
+        ("A", "X", "碩士班"): {"total": 0, "first": -1, "fifth": 1, "hist": {1: -1, 5: 1}},
+        ("B", "Y", "碩士班"): {"total": 0, "first": 1, "fifth": 0, "hist": {1: 1, 2: -1}},
+    }
+
+
+def test_choice_deltas_match_full_recount():
+    rng = random.Random(29)
+    keys = [(s, d, "碩士班") for s in "ABC" for d in "XYZ"]
+    for _ in range(50):
+        before = {u: rng.sample(keys, rng.randint(0, 6)) for u in range(20)}
+        after = dict(before)
+        user = rng.randrange(20)
+        after[user] = rng.sample(keys, rng.randint(0, 6))
+
+        def rows(choices):
+            return [key + (rank,) for picks in choices.values() for rank, key in enumerate(picks, 1)]
+
+        old_stats, new_stats = _full_stats(rows(before)), _full_stats(rows(after))
+        deltas = rankings.choice_deltas(rows({user: before[user]}), rows({user: after[user]}))
+        for key in keys:
+            d = deltas.get(key, {"total": 0, "first": 0, "fifth": 0, "hist": {}})
+            for field in ("total", "first", "fifth"):
+                assert old_stats[key][field] + d[field] == new_stats[key][field]
+            hist = old_stats[key]["hist"] + Counter()
+            hist.update(d["hist"])
+            assert +hist == +new_stats[key]["hist"]
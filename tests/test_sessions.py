@@ -0,0 +1,104 @@
+import datetime
+
+import jwt
+import pytest
+from sqlalchemy import text
+
+import sessions
+
+SECRET = "test-secret-key-with-at-least-32-bytes"
+
+
+def test_successor_is_deterministic_per_token_and_key():
+    assert sessions._successor(SECRET, "a") == sessions._successor(SECRET, "a")
+    assert sessions._successor(SECRET, "a") != sessions._successor(SECRET, "b")
+    assert sessions._successor(SECRET, "a") != sessions._successor("other", "a")
+
+
+def test_access_token_expiry():
+    payload = sessions.decode_access_token(SECRET, sessions.access_token(SECRET, 1, "王小明", "a@example.com"))
+    assert payload["exp"] - payload["iat"] == sessions.ACCESS_TOKEN_MINUTES * 60
+    past = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=sessions.ACCESS_TOKEN_MINUTES + 1)
+    with pytest.raises(jwt.ExpiredSignatureError):
+        sessions.decode_access_token(SECRET, sessions.access_token(SECRET, 1, "王小明", "a@example.com", now=past))
+
+
+def test_stream_ticket_is_not_an_access_token():
+    payload = sessions.decode_access_token(SECRET, sessions.access_token(SECRET, 1, "王小明", "a@example.com"))
+    ticket = sessions.stream_ticket(SECRET, payload)
+    with pytest.raises(jwt.InvalidTokenError):
+        sessions.decode_access_token(SECRET, ticket)
+    assert sessions.decode_stream_ticket(SECRET, ticket)["user_id"] == 1
+
+
+@pytest.fixture
+def user_id(engine):
+    with engine.begin() as conn:
+        return conn.execute(text("""
+            INSERT INTO users (username, email, password_hash) VALUES ('王小明', 'a@example.com', 'x')
+            RETURNING user_id
+        """)).scalar()
+
+
+def _rotate(engine, token):
+    with engine.begin() as conn:
+        return sessions.SessionStore().rotate(conn, token, SECRET)
+
+
+def _age_used_tokens(engine, seconds):
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE refresh_tokens SET used_at = used_at - make_interval(secs => :s)"), {"s": seconds})
+
+
+def test_rotation_issues_successor(engine, user_id):
+    with engine.begin() as conn:
+        token = sessions.SessionStore().issue(conn, user_id)
+    user, second = _rotate(engine, token)
+    assert user == {"user_id": user_id, "username": "王小明", "email": "a@example.com"}
+    assert second == sessions._successor(SECRET, token)
+    user, third = _rotate(engine, second)
+    assert user["user_id"] == user_id and third not in (token, second)
+
+
+def test_concurrent_refresh_within_grace_gets_same_token(engine, user_id):
+    with engine.begin() as conn:
+        token = sessions.SessionStore().issue(conn, user_id)
+    _, first = _rotate(engine, token)
+    _, again = _rotate(engine, token)
+    assert again == first
+    # 寬限期內重送不會再發新的 token，新 token 仍可正常輪替
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM refresh_tokens")).scalar() == 2
+    assert _rotate(engine, first)[0] is not None
+
+
+def test_reuse_after_grace_revokes_family(engine, user_id):
+    with engine.begin() as conn:
+        store = sessions.SessionStore()
+        token = store.issue(conn, user_id)
+        other = store.issue(conn, user_id)
+    _, second = _rotate(engine, token)
+    _age_used_tokens(engine, sessions.REFRESH_REUSE_GRACE_SECONDS + 1)
+
+    assert _rotate(engine, token) == (None, None)
+    # 同一次登入的 token 全部作廢，其他登入不受影響
+    assert _rotate(engine, second) == (None, None)
+    assert _rotate(engine, other)[0] is not None
+
+
+def test_revoked_family_gets_no_grace(engine, user_id):
+    with engine.begin() as conn:
+        token = sessions.SessionStore().issue(conn, user_id)
+    _rotate(engine, token)
+    with engine.begin() as conn:
+        assert sessions.SessionStore().revoke(conn, token) == 2
+    assert _rotate(engine, token) == (None, None)
+
+
+def test_unknown_and_expired_tokens(engine, user_id):
+    assert _rotate(engine, "nope") == (None, None)
+    assert _rotate(engine, None) == (None, None)
+    with engine.begin() as conn:
+        token = sessions.SessionStore().issue(conn, user_id)
+        conn.execute(text("UPDATE refresh_tokens SET expires_at = now() - interval '1 second'"))
+    assert _rotate(engine, token) == (None, None)
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import text
+
+from singleflight import SingleFlight, content_key
+
+
+def _concurrent(flight, key, n, **kwargs):
+    """n 個執行緒同時以同一個 key 呼叫，回傳 (結果, fn 被呼叫的次數)"""
+    calls = []
+    started = threading.Barrier(n)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def fn():
+        calls.append(1)
+        entered.set()
+        release.wait(5)
+        return {"value": len(calls)}
+
+    results = [None] * n
+
+    def worker(i):
+        started.wait()
+        results[i] = flight.do(key, fn, **kwargs)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    # fn 開始後再等一下，讓其他執行緒都進入 do() 等待
+    entered.wait(5)
+    time.sleep(0.2)
+    release.set()
+    for t in threads:
+        t.join()
+    return results, len(calls)
+
+
+def test_content_key_depends_on_content():
+    assert content_key("parse_id", b"a") == content_key("parse_id", b"a")
+    assert content_key("parse_id", b"a") != content_key("parse_id", b"b")
+    assert content_key("parse_id", b"a").startswith("parse_id:")
+
+
+def test_concurrent_calls_run_once():
+    results, calls = _concurrent(SingleFlight(), "op:1", 4)
+    assert calls == 1
+    assert results == [{"value": 1}] * 4
+
+
+def test_errors_are_shared_and_not_kept():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        flight.do("op:1", fail)
+    assert flight.do("op:1", lambda: 2) == 2
+
+
+def test_shared_results_are_reused_across_instances(engine):
+    first, second = SingleFlight(), SingleFlight()
+    first.configure(engine)
+    second.configure(engine)
+    assert first.do("op:1", lambda: {"n": 1}) == {"n": 1}
+    assert second.do("op:1", lambda: {"n": 2}) == {"n": 1}
+    # ok() 為 False 的結果不保留
+    assert first.do("op:2", lambda: None, ok=lambda r: r is not None) is None
+    assert second.do("op:2", lambda: 3) == 3
+
+
+def test_unshared_results_are_not_stored(engine):
+    flight = SingleFlight()
+    flight.configure(engine)
+    results, calls = _concurrent(flight, "parse_id:1", 3, shared=False)
+    assert calls == 1 and results == [{"value": 1}] * 3
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM ai_singleflight")).scalar() == 0
+    assert flight.do("parse_id:1", lambda: "again", shared=False) == "again"
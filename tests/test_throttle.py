@@ -0,0 +1,106 @@
+import pytest
+from flask import Flask, jsonify
+
+import throttle
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(throttle.time, "monotonic", clock)
+    monkeypatch.setattr(throttle, "local_buckets", throttle.LocalBuckets())
+    monkeypatch.setattr(throttle, "shared_buckets", None)
+    monkeypatch.setattr(throttle, "THROTTLE_ENABLED", True)
+    monkeypatch.setattr(throttle, "PROXY_HOPS", 0)
+    monkeypatch.setitem(throttle.RULES, "test:ip", throttle.parse_rule("3/60"))
+    monkeypatch.setitem(throttle.RULES, "test:email", throttle.parse_rule("2/600"))
+    return clock
+
+
+def test_parse_rule():
+    assert throttle.parse_rule("3/600") == (3.0, 0.005)
+
+
+def test_bucket_refills_at_rule_rate(clock):
+    for _ in range(3):
+        throttle.check("test", {"ip": "1.2.3.4"})
+    with pytest.raises(throttle.Throttled) as e:
+        throttle.check("test", {"ip": "1.2.3.4"})
+    assert e.value.rule == "test:ip"
+    assert e.value.retry_after == pytest.approx(20)
+
+    # 每 20 秒補一個 token
+    clock.now += 15
+    with pytest.raises(throttle.Throttled) as e:
+        throttle.check("test", {"ip": "1.2.3.4"})
+    assert e.value.retry_after == pytest.approx(5)
+    clock.now += 5
+    throttle.check("test", {"ip": "1.2.3.4"})
+    with pytest.raises(throttle.Throttled):
+        throttle.check("test", {"ip": "1.2.3.4"})
+
+    # 補滿後不超過容量
+    clock.now += 3600
+    for _ in range(3):
+        throttle.check("test", {"ip": "1.2.3.4"})
+    with pytest.raises(throttle.Throttled):
+        throttle.check("test", {"ip": "1.2.3.4"})
+    throttle.check("test", {"ip": "5.6.7.8"})
+
+
+def test_rejected_request_takes_no_token_from_other_dimensions(clock):
+    throttle.check("test", {"ip": "1.1.1.1", "email": "a@example.com"})
+    throttle.check("test", {"ip": "1.1.1.1", "email": "a@example.com"})
+    with pytest.raises(throttle.Throttled) as e:
+        throttle.check("test", {"ip": "1.1.1.1", "email": "a@example.com"})
+    assert e.value.rule == "test:email"
+    # ip 維度只扣了兩次，換一個 email 還剩一個
+    throttle.check("test", {"ip": "1.1.1.1", "email": "b@example.com"})
+    with pytest.raises(throttle.Throttled) as e:
+        throttle.check("test", {"ip": "1.1.1.1", "email": "c@example.com"})
+    assert e.value.rule == "test:ip"
+
+
+def test_empty_identities_and_unknown_rules_are_skipped(clock):
+    for _ in range(10):
+        throttle.check("test", {"ip": None, "email": ""})
+        throttle.check("unknown", {"ip": "1.2.3.4"})
+
+
+def test_lru_evicts_oldest_keys():
+    buckets = throttle.LocalBuckets(max_keys=2)
+    for key in ("a", "b", "c"):
+        buckets.take([("test:ip", key, 1.0, 1.0)])
+    assert list(buckets._buckets) == ["b", "c"]
+
+
+def test_limit_returns_429_with_retry_after(clock):
+    app = Flask(__name__)
+
+    @app.route("/send", methods=["POST"])
+    @throttle.limit("test", "ip", "email")
+    def send():
+        return jsonify({"success": True})
+
+    client = app.test_client()
+    for _ in range(2):
+        assert client.post("/send", json={"email": " A@Example.com "}).status_code == 200
+    response = client.post("/send", json={"email": "a@example.com"})
+    assert response.status_code == 429
+    # 600 秒補 2 個，下一個 token 在 300 秒後
+    assert response.headers["Retry-After"] == "300"
+    assert response.get_json()["success"] is False
+
+    clock.now += 299.5
+    response = client.post("/send", json={"email": "a@example.com"})
+    assert response.headers["Retry-After"] == "1"
+    clock.now += 0.5
+    assert client.post("/send", json={"email": "a@example.com"}).status_code == 200
@@ -0,0 +1,202 @@
+"""Token bucket 限流（寄驗證碼、登入、模型呼叫等昂貴端點）
+
+每條規則為「次數/秒數」，例如 "3/600" 代表桶子容量 3、每 600 秒補滿 3 個 token。
+一個端點可以同時以多個維度限流（ip / email / user），任一維度沒有 token 就回 429 與 Retry-After，
+在讀資料庫、寄信或呼叫模型之前就擋下。
+
+狀態預設存在各 worker 的記憶體（OrderedDict，最多 THROTTLE_MAX_KEYS 個 key，最久沒用的先丟）。
+設定 THROTTLE_SHARED=true 後，記憶體通過的請求會再到 throttle_buckets 表扣 token，
+多台機器共用同一個額度；記憶體中的桶子仍會先擋下本機的連續請求，不必每次都查資料庫。
+資料庫有問題時只依記憶體判斷（不因限流讓服務中斷）。
+
+環境變數：
+  THROTTLE_ENABLED     預設 true
+  THROTTLE_RULES       JSON，覆寫預設規則，例如 {"login:ip": "60/60"}
+  THROTTLE_SHARED      預設 false
+  THROTTLE_PROXY_HOPS  前面有幾層 proxy 會在 X-Forwarded-For 附加來源 IP（Cloud Run 為 1，0 = 直接用連線 IP）
+  THROTTLE_MAX_KEYS    記憶體中最多保留的桶子數（預設 100000）
+"""
+import collections
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+from sqlalchemy import text
+
+import metrics
+
+DEFAULT_RULES = {
+    "captcha:ip": "10/600",
+    "captcha:email": "3/600",
+    "register:ip": "10/600",
+    "register:email": "10/600",
+    "login:ip": "30/60",
+    "login:email": "10/300",
+    "refresh:ip": "60/60",
+    "parse_id:ip": "10/60",
+    "upload_namelist:user": "10/300",
+    "upload_namelist:ip": "30/300",
+}
+
+THROTTLE_ENABLED = os.getenv("THROTTLE_ENABLED", "true").lower() == "true"
+THROTTLE_SHARED = os.getenv("THROTTLE_SHARED", "false").lower() == "true"
+PROXY_HOPS = int(os.getenv("THROTTLE_PROXY_HOPS", "1"))
+MAX_KEYS = int(os.getenv("THROTTLE_MAX_KEYS", "100000"))
+# 共用狀態中超過一天沒動的桶子一定已經補滿，可以刪除
+SHARED_CLEANUP_INTERVAL_SECONDS = 600
+
+
+def parse_rule(rule):
+    """ "3/600" -> (容量 3, 每秒補 3/600 個) """
+    count, seconds = rule.split("/")
+    return float(count), float(count) / float(seconds)
+
+
+RULES = {name: parse_rule(rule) for name, rule in
+         {**DEFAULT_RULES, **json.loads(os.getenv("THROTTLE_RULES", "{}"))}.items()}
+
+
+class Throttled(Exception):
+    def __init__(self, rule, retry_after):
+        super().__init__(rule)
+        self.rule = rule
+        self.retry_after = retry_after
+
+
+class LocalBuckets:
+    """記憶體中的 token bucket：key -> (剩餘 token, 上次更新時間)"""
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, keys):
+        """keys 為 [(規則名稱, key, 容量, 每秒補充量)]，全部都有 token 時各扣一個，否則丟出 Throttled"""
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            for rule, key, capacity, rate in keys:
+                tokens, updated = self._buckets.get(key, (capacity, now))
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                if tokens < 1:
+                    raise Throttled(rule, (1 - tokens) / rate)
+                levels.append((key, tokens))
+            for key, tokens in levels:
+                self._buckets[key] = (tokens - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+
+class SharedBuckets:
+    """throttle_buckets 表中的 token bucket，補充與扣除在同一個 UPSERT 中完成"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._cleaned_at = 0.0
+
+    def take(self, keys):
+        with self.engine.begin() as conn:
+            for rule, key, capacity, rate in keys:
+                row = conn.execute(text("""
+                    INSERT INTO throttle_buckets AS b (key, tokens, updated_at)
+                    VALUES (:key, :capacity - 1, now())
+                    ON CONFLICT (key) DO UPDATE SET
+                        tokens = LEAST(:capacity, b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * :rate) - 1,
+                        updated_at = now()
+                    WHERE LEAST(:capacity, b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * :rate) >= 1
+                    RETURNING tokens
+                """), {"key": key, "capacity": capacity, "rate": rate}).fetchone()
+                if row is None:
+                    tokens = conn.execute(text("""
+                        SELECT LEAST(:capacity, tokens + EXTRACT(EPOCH FROM now() - updated_at) * :rate)
+                        FROM throttle_buckets WHERE key = :key
+                    """), {"key": key, "capacity": capacity, "rate": rate}).scalar() or 0
+                    # 丟出例外時整個交易 rollback，前面已扣的維度一併復原
+                    raise Throttled(rule, (1 - float(tokens)) / rate)
+        self._cleanup()
+
+    def _cleanup(self):
+        now = time.monotonic()
+        if now - self._cleaned_at < SHARED_CLEANUP_INTERVAL_SECONDS:
+            return
+        self._cleaned_at = now
+        with self.engine.begin() as conn:
+            conn.execute(text("DELETE FROM throttle_buckets WHERE updated_at < now() - interval '1 day'"))
+
+
+local_buckets = LocalBuckets()
+shared_buckets = None
+
+
+def configure(engine):
+    """THROTTLE_SHARED=true 時以資料庫共用限流狀態"""
+    global shared_buckets
+    shared_buckets = SharedBuckets(engine) if THROTTLE_SHARED else None
+
+
+def check(scope, identities):
+    """identities 為 {維度: 值}，值為空的維度略過；超過限制時丟出 Throttled"""
+    keys = []
+    for dimension, value in identities.items():
+        rule = f"{scope}:{dimension}"
+        if value is None or value == "" or rule not in RULES:
+            continue
+        capacity, rate = RULES[rule]
+        keys.append((rule, f"{rule}:{value}", capacity, rate))
+    if not keys:
+        return
+    local_buckets.take(keys)
+    if shared_buckets is not None:
+        try:
+            shared_buckets.take(keys)
+        except Throttled:
+            raise
+        except Exception as e:
+            metrics.log_event("throttle_shared_failed", level="warning", scope=scope, error=str(e))
+
+
+# ---------- Flask ----------
+def client_ip(request):
+    """經過 PROXY_HOPS 層 proxy 時，取 X-Forwarded-For 由右數來第 PROXY_HOPS 個（proxy 附加的，不可偽造）"""
+    if PROXY_HOPS > 0:
+        forwarded = [p.strip() for p in request.headers.get("X-Forwarded-For", "").split(",") if p.strip()]
+        if len(forwarded) >= PROXY_HOPS:
+            return forwarded[-PROXY_HOPS]
+    return request.remote_addr
+
+
+def limit(scope, *dimensions, user_id=None):
+    """端點裝飾器：dimensions 為 "ip" / "email"（JSON body 的 email）/ "user"（user_id() 的回傳值）"""
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated(*args, **kwargs):
+            if not THROTTLE_ENABLED:
+                return f(*args, **kwargs)
+            from flask import jsonify, request
+
+            identities = {}
+            if "ip" in dimensions:
+                identities["ip"] = client_ip(request)
+            if "email" in dimensions:
+                body = request.get_json(silent=True) or {}
+                email = body.get("email") if isinstance(body, dict) else None
+                identities["email"] = email.strip().lower() if isinstance(email, str) else None
+            if "user" in dimensions and user_id is not None:
+                identities["user"] = user_id()
+            try:
+                check(scope, identities)
+            except Throttled as e:
+                retry_after = max(1, math.ceil(e.retry_after))
+                metrics.THROTTLED.inc(rule=e.rule)
+                metrics.log_event("throttled", rule=e.rule, retry_after=retry_after)
+                response = jsonify({"success": False, "message": f"請求過於頻繁，請於 {retry_after} 秒後再試"})
+                response.headers["Retry-After"] = str(retry_after)
+                return response, 429
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
@@ -1,7 +1,9 @@
 def send_mail(email_address, mail_type, necessary_content):
     import os
+    import time
     import smtplib
     from email.mime.text import MIMEText
+    import metrics
 
     # Brevo SMTP 設定
     SMTP_SERVER = "smtp-relay.brevo.com"
@@ -18,14 +20,17 @@ def send_mail(email_address, mail_type, necessary_content):
         msg["To"] = email_address
         msg["Subject"] = subject
 
+        start = time.perf_counter()
         try:
             with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
                 server.starttls()
                 server.login(SMTP_LOGIN, SMTP_PASSWORD)
                 server.sendmail("tw.graduated.friends@gmail.com", email_address, msg.as_string())
+            metrics.observe_smtp(time.perf_counter() - start, ok=True)
             return True
         except Exception as e:
-            print("寄信失敗:", e)
+            metrics.observe_smtp(time.perf_counter() - start, ok=False)
+            metrics.log_event("send_mail_failed", level="error", mail_type=mail_type, error=str(e))
             return False
         
 
@@ -0,0 +1,108 @@
+"""註冊用的 email 驗證碼
+
+email_verifications 每個 email 只有一列（unique index），申請與註冊各只需要一個 SQL：
+  issue()     INSERT ... ON CONFLICT (email) DO UPDATE 產生或更新驗證碼（嘗試次數歸零）；已註冊過的 email 不會被覆寫
+  check()     計算密碼 hash 之前先核對驗證碼（不消耗），錯誤時累計嘗試次數
+  register()  UPDATE ... RETURNING 核對並消耗驗證碼，同一個語句中新增使用者（CTE）
+
+同一個驗證碼錯誤 CAPTCHA_MAX_ATTEMPTS 次後就不再接受，需要重新申請（申請本身也有限流），
+6 位數的驗證碼無法以重複嘗試猜中。
+只有真的建立了使用者才消耗驗證碼：email 已有帳號時 UPDATE 不會執行，驗證碼不會被用掉。
+重複送出註冊時第二個請求會等第一個的 row lock，之後看到 used = TRUE 而失敗，不會建立兩個帳號。
+時間欄位為 TIMESTAMP（不含時區），一律以 UTC 的 Python datetime 傳入，與原本的資料相同。
+"""
+import datetime
+import os
+
+from sqlalchemy import text
+
+CODE_TTL = datetime.timedelta(minutes=5)
+MAX_ATTEMPTS = int(os.getenv("CAPTCHA_MAX_ATTEMPTS", "5"))
+
+_ISSUE_SQL = text("""
+    INSERT INTO email_verifications (email, verification_code, expires_at, used, created_at)
+    VALUES (:email, :code, :expires_at, FALSE, :now)
+    ON CONFLICT (email) DO UPDATE SET
+        verification_code = EXCLUDED.verification_code,
+        expires_at = EXCLUDED.expires_at,
+        created_at = EXCLUDED.created_at,
+        attempts = 0
+    WHERE NOT email_verifications.used
+    RETURNING id
+""")
+
+_REGISTER_SQL = text("""
+    WITH consumed AS (
+        UPDATE email_verifications
+        SET used = TRUE
+        WHERE email = :email AND verification_code = :code AND NOT used AND expires_at >= :now
+          AND attempts < :max_attempts
+          AND NOT EXISTS (SELECT 1 FROM users WHERE email = :email)
+        RETURNING email
+    )
+    INSERT INTO users (username, email, password_hash, school, department, created_at)
+    SELECT :username, email, :password_hash, :school, :department, :now FROM consumed
+    ON CONFLICT (email) DO NOTHING
+    RETURNING user_id
+""")
+
+# FOR UPDATE：同一個 email 同時送出的嘗試依序累計，不會同時通過次數檢查
+_STATUS_SQL = text("""
+    SELECT v.verification_code, v.expires_at, v.used, v.attempts,
+           EXISTS (SELECT 1 FROM users u WHERE u.email = v.email) AS registered
+    FROM email_verifications v
+    WHERE v.email = :email
+    FOR UPDATE
+""")
+
+
+def issue(conn, email, code, now):
+    """產生或更新 email 的驗證碼，email 已註冊過時回傳 False"""
+    return conn.execute(_ISSUE_SQL, {
+        "email": email, "code": code, "expires_at": now + CODE_TTL, "now": now,
+    }).fetchone() is not None
+
+
+def _failure(conn, email, code, now, count_mismatch):
+    """回傳驗證碼無法使用的原因，可以使用時回傳 None"""
+    verification = conn.execute(_STATUS_SQL, {"email": email}).fetchone()
+    if verification is None:
+        return "missing"
+    if verification.used or verification.registered:
+        return "used"
+    if verification.expires_at.replace(tzinfo=datetime.timezone.utc) < now:
+        return "expired"
+    if verification.attempts >= MAX_ATTEMPTS:
+        return "locked"
+    if verification.verification_code != code:
+        if count_mismatch:
+            conn.execute(text("UPDATE email_verifications SET attempts = attempts + 1 WHERE email = :email"),
+                         {"email": email})
+        return "mismatch"
+    return None
+
+
+def check(conn, email, code, now):
+    """註冊前核對驗證碼（不消耗），回傳失敗原因，可以使用時回傳 None；驗證碼錯誤時累計嘗試次數
+
+    原因為 "missing"（沒有申請過）/ "used"（已註冊）/ "expired" / "locked"（錯誤太多次）/ "mismatch"
+    """
+    return _failure(conn, email, code, now, count_mismatch=True)
+
+
+def register(conn, email, code, now, username, password_hash, school=None, department=None):
+    """驗證碼正確時消耗並建立使用者，回傳 (user_id, None)；失敗時回傳 (None, 原因)，原因同 check()"""
+    row = conn.execute(_REGISTER_SQL, {
+        "email": email,
+        "code": code,
+        "now": now,
+        "max_attempts": MAX_ATTEMPTS,
+        "username": username,
+        "password_hash": password_hash,
+        "school": school,
+        "department": department,
+    }).fetchone()
+    if row is not None:
+        return row.user_id, None
+    # 以下只在失敗時執行，用來回傳原因（check() 已經計算過這次嘗試，不重複累計）
+    return None, _failure(conn, email, code, now, count_mismatch=False) or "used"